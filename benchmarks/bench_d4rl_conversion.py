@@ -0,0 +1,114 @@
+# -*- coding: UTF-8 -*-
+"""Benchmark the vectorized D4RL conversion against the original per-row loop.
+
+    python benchmarks/bench_d4rl_conversion.py --num_steps 2000000
+"""
+import sys
+import time
+import argparse
+from pathlib import Path
+import numpy as np
+
+sys.path.append(str(Path(__file__).parent.parent))
+from datasets.offline_d4rl import qlearning_ant_dataset
+
+
+class SyntheticEnv(object):
+    def __init__(self, max_episode_steps):
+        self._max_episode_steps = max_episode_steps
+
+
+def make_synthetic_dataset(num_steps, max_episode_steps=1000, obs_dim=29, act_dim=8, qpos_dim=15, qvel_dim=14, seed=0):
+    rng = np.random.default_rng(seed)
+    timeouts = np.zeros(num_steps, dtype=bool)
+    timeouts[max_episode_steps - 1::max_episode_steps] = True
+    return {
+        "observations": rng.standard_normal((num_steps, obs_dim), dtype=np.float32),
+        "actions": rng.standard_normal((num_steps, act_dim), dtype=np.float32),
+        "rewards": rng.standard_normal(num_steps, dtype=np.float32),
+        "terminals": rng.random(num_steps) < 1e-3,
+        "timeouts": timeouts,
+        "infos/qpos": rng.standard_normal((num_steps, qpos_dim)),
+        "infos/qvel": rng.standard_normal((num_steps, qvel_dim)),
+        "infos/goal": rng.standard_normal((num_steps, 2), dtype=np.float32),
+    }
+
+
+def legacy_qlearning_ant_dataset(env, dataset, terminate_on_end=False):
+    """The per-row loop that qlearning_ant_dataset used before vectorization."""
+    N = dataset["rewards"].shape[0]
+    obs_, next_obs_, action_, reward_, done_, goal_, xy_, done_bef_, qpos_, qvel_ = ([] for _ in range(10))
+    use_timeouts = "timeouts" in dataset
+    episode_step = 0
+    for i in range(N - 1):
+        obs = dataset["observations"][i].astype(np.float32)
+        new_obs = dataset["observations"][i + 1].astype(np.float32)
+        action = dataset["actions"][i].astype(np.float32)
+        reward = dataset["rewards"][i].astype(np.float32)
+        done_bool = bool(dataset["terminals"][i]) or episode_step == env._max_episode_steps - 1
+        goal = dataset["infos/goal"][i].astype(np.float32)
+        xy = dataset["infos/qpos"][i][:2].astype(np.float32)
+        qpos = dataset["infos/qpos"][i]
+        qvel = dataset["infos/qvel"][i]
+        if use_timeouts:
+            final_timestep = dataset["timeouts"][i]
+            next_final_timestep = dataset["timeouts"][i + 1]
+        else:
+            final_timestep = episode_step == env._max_episode_steps - 1
+            next_final_timestep = episode_step == env._max_episode_steps - 2
+        done_bef = bool(next_final_timestep)
+        if (not terminate_on_end) and final_timestep:
+            episode_step = 0
+            continue
+        if done_bool or final_timestep:
+            episode_step = 0
+        obs_.append(obs)
+        next_obs_.append(new_obs)
+        action_.append(action)
+        reward_.append(reward)
+        done_.append(done_bool)
+        goal_.append(goal)
+        xy_.append(xy)
+        done_bef_.append(done_bef)
+        qpos_.append(qpos)
+        qvel_.append(qvel)
+        episode_step += 1
+    return {
+        "observations": np.array(obs_),
+        "actions": np.array(action_),
+        "next_observations": np.array(next_obs_),
+        "rewards": np.array(reward_),
+        "terminals": np.array(done_),
+        "goals": np.array(goal_),
+        "xys": np.array(xy_),
+        "dones_bef": np.array(done_bef_),
+        "qposes": np.array(qpos_),
+        "qvels": np.array(qvel_),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_steps', type=int, default=2000000, help='rows of the synthetic dataset.')
+    parser.add_argument('--max_episode_steps', type=int, default=1000)
+    parser.add_argument('--skip_legacy', action='store_true', help='only time the vectorized converter.')
+    cfg = parser.parse_args()
+
+    env = SyntheticEnv(cfg.max_episode_steps)
+    dataset = make_synthetic_dataset(cfg.num_steps, cfg.max_episode_steps)
+
+    start = time.perf_counter()
+    vectorized = qlearning_ant_dataset(env, dataset=dataset)
+    # the converter returns LazyColumns, every column is built here so the conversion is timed
+    vectorized.preload(list(vectorized))
+    vectorized_time = time.perf_counter() - start
+    print(f"vectorized: {vectorized_time:.3f}s for {cfg.num_steps} steps")
+
+    if not cfg.skip_legacy:
+        start = time.perf_counter()
+        legacy = legacy_qlearning_ant_dataset(env, dataset)
+        legacy_time = time.perf_counter() - start
+        print(f"legacy loop: {legacy_time:.3f}s for {cfg.num_steps} steps")
+        for key, value in legacy.items():
+            assert value.dtype == vectorized[key].dtype and np.array_equal(value, vectorized[key]), key
+        print(f"outputs identical, speedup x{legacy_time / vectorized_time:.1f}")
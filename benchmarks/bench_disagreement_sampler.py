@@ -0,0 +1,46 @@
+# -*- coding: UTF-8 -*-
+"""Measure disagreement sampler throughput (candidate pairs scored per second).
+
+    python benchmarks/bench_disagreement_sampler.py --pool_sizes 1000 10000 100000 --batch_sizes 1024 4096
+"""
+import sys
+import time
+import argparse
+from pathlib import Path
+import numpy as np
+
+sys.path.append(str(Path(__file__).parent.parent))
+from datasets.dataset_utils import EpisodeIndex
+from datasets.samplers import disagreement_sample
+
+
+def make_dataset(num_steps, episode_length, image):
+    rng = np.random.default_rng(0)
+    terminals = np.zeros(num_steps, dtype=bool)
+    terminals[episode_length - 1::episode_length] = True
+    if image:
+        observations = rng.integers(0, 256, (num_steps, 3, 64, 64), dtype=np.uint8)
+    else:
+        observations = rng.standard_normal((num_steps, 29), dtype=np.float32)
+    datasets = {"observations": observations, "rewards": rng.standard_normal(num_steps, dtype=np.float32)}
+    return datasets, EpisodeIndex.from_terminals(terminals, num_steps).trj_idx_list
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_steps', type=int, default=200000)
+    parser.add_argument('--episode_length', type=int, default=1000)
+    parser.add_argument('--query_length', type=int, default=50)
+    parser.add_argument('--query_num', type=int, default=10)
+    parser.add_argument('--pool_sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1024, 4096, 16384])
+    parser.add_argument('--image', action='store_true', help='score 3x64x64 frames instead of vector observations.')
+    cfg = parser.parse_args()
+
+    datasets, trj_idx_list = make_dataset(cfg.num_steps, cfg.episode_length, cfg.image)
+    for pool_size in cfg.pool_sizes:
+        for batch_size in cfg.batch_sizes:
+            start = time.perf_counter()
+            disagreement_sample(datasets, trj_idx_list, cfg.query_length, cfg.query_num, 2, pool_size=pool_size, batch_size=batch_size)
+            elapsed = time.perf_counter() - start
+            print(f"pool {pool_size:>7} batch {batch_size:>6}: {elapsed:.2f}s, {pool_size / elapsed:.0f} pairs/s end to end")
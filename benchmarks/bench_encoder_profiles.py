@@ -0,0 +1,74 @@
+# -*- coding: UTF-8 -*-
+"""Encode speed, file size and first-frame latency of the encoder profiles.
+
+Encodes a fixed set of synthetic side-by-side clips (moving discs over a
+gradient, closer to rendered frames than noise) with dataset_utils.write_video
+under every profile, then reports the video frames encoded per second, the mean
+bytes per clip and the mean time to open a clip and decode its first frame.
+
+    python benchmarks/bench_encoder_profiles.py --num_clips 20 --query_length 200 --size 500
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+from pathlib import Path
+import numpy as np
+import cv2
+
+sys.path.append(str(Path(__file__).parent.parent))
+import datasets.dataset_utils as dataset_utils
+
+
+def synthetic_clip(query_length, size, sample_num, rng):
+    video, tiles = dataset_utils.video_canvas(query_length, (size, size, 3), sample_num)
+    background = np.linspace(0, 255, size, dtype=np.uint8)[None, :, None].repeat(size, axis=0).repeat(3, axis=2)
+    for tile in tiles:
+        center, velocity = rng.uniform(0, size, (4, 2)), rng.uniform(-4, 4, (4, 2))
+        colors = rng.integers(0, 256, (4, 3))
+        for t in range(query_length):
+            tile[t] = background
+            for position, color in zip((center + t * velocity) % size, colors):
+                cv2.circle(tile[t], tuple(int(x) for x in position), size // 10, tuple(int(c) for c in color), -1)
+    return video
+
+
+def first_frame_latency(video_path):
+    start = time.perf_counter()
+    cap = cv2.VideoCapture(video_path)
+    ret, _ = cap.read()
+    cap.release()
+    assert ret, f"cannot decode {video_path}"
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--profiles', type=str, nargs='+', default=list(dataset_utils.ENCODER_PROFILES), choices=list(dataset_utils.ENCODER_PROFILES))
+    parser.add_argument('--num_clips', type=int, default=20)
+    parser.add_argument('--query_length', type=int, default=200)
+    parser.add_argument('--size', type=int, default=500, help='height and width of every segment.')
+    parser.add_argument('--sample_num', type=int, default=2, help='segments tiled in every clip.')
+    parser.add_argument('--fps', type=int, default=30)
+    parser.add_argument('--threads', type=int, default=None, help='ffmpeg threads per clip, overriding the profiles.')
+    cfg = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    clips = [synthetic_clip(cfg.query_length, cfg.size, cfg.sample_num, rng) for _ in range(cfg.num_clips)]
+    root = tempfile.mkdtemp()
+    try:
+        for name in cfg.profiles:
+            encoder = dataset_utils.encoder_profile({'profile': name} if cfg.threads is None else {'profile': name, 'threads': cfg.threads})
+            paths = [os.path.join(root, f"{name}_{i}.mp4") for i in range(cfg.num_clips)]
+            start = time.perf_counter()
+            for path, clip in zip(paths, clips):
+                dataset_utils.write_video(path, clip, cfg.fps, num_segments=cfg.sample_num, encoder=encoder)
+            elapsed = time.perf_counter() - start
+            clip_bytes = np.mean([os.path.getsize(path) for path in paths])
+            latency = np.mean([first_frame_latency(path) for path in paths])
+            print(f"{name:>10}: {cfg.num_clips * cfg.query_length / elapsed:7.0f} frames/s, {clip_bytes / 1024:8.1f} KiB/clip, "
+                  f"first frame {latency * 1000:6.1f} ms  ({encoder})")
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
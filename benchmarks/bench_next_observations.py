@@ -0,0 +1,60 @@
+# -*- coding: UTF-8 -*-
+"""Measure the memory saved per domain by not materializing next_observations.
+
+    python benchmarks/bench_next_observations.py --num_steps 100000
+"""
+import sys
+import argparse
+import tracemalloc
+from pathlib import Path
+import numpy as np
+
+sys.path.append(str(Path(__file__).parent.parent))
+from datasets.offline_d4rl import qlearning_mujoco_dataset
+from datasets.offline_vd4rl import qlearning_vd4rl_dataset
+from datasets.offline_smarts import qlearning_smarts_dataset
+from bench_d4rl_conversion import SyntheticEnv, make_synthetic_dataset
+
+
+def stored_bytes(column):
+    if isinstance(column, np.ndarray):
+        return 0 if column.base is not None else column.nbytes
+    patch_values = getattr(column, 'patch_values', None)
+    return 0 if patch_values is None else np.asarray(patch_values).nbytes
+
+
+def convert(name, fn):
+    tracemalloc.start()
+    datasets = fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    materialized = int(np.prod(datasets['next_observations'].shape)) * np.dtype(datasets['next_observations'].dtype).itemsize
+    stored = stored_bytes(datasets['next_observations'])
+    print(f"{name:>6}: next_observations materialized {materialized / 2 ** 20:9.1f} MiB, "
+          f"stored {stored / 2 ** 20:7.2f} MiB, saved {(materialized - stored) / 2 ** 20:9.1f} MiB, "
+          f"conversion peak {peak / 2 ** 20:9.1f} MiB")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_steps', type=int, default=100000, help='rows of each synthetic dataset.')
+    cfg = parser.parse_args()
+    rng = np.random.default_rng(0)
+    N = cfg.num_steps
+
+    d4rl_dataset = make_synthetic_dataset(N)
+    convert('d4rl', lambda: qlearning_mujoco_dataset(SyntheticEnv(1000), dataset=d4rl_dataset))
+
+    vd4rl_dataset = {
+        'observation': rng.integers(0, 255, (N, 3, 84, 84), dtype=np.uint8),
+        'action': rng.standard_normal((N, 6), dtype=np.float32),
+        'reward': rng.standard_normal(N, dtype=np.float32),
+    }
+    convert('vd4rl', lambda: qlearning_vd4rl_dataset(vd4rl_dataset))
+
+    smarts_rows = [(np.zeros((64, 64, 3), dtype=np.uint8), rng.standard_normal(55), rng.standard_normal(2), 0., i % 500 == 499)
+                   for i in range(N)]
+    convert('smarts', lambda: qlearning_smarts_dataset(smarts_rows))
+
+    # atari (d4rl_atari get_dataset) and customization (user hdf5) never built next_observations
+    print("atari/customization: next_observations is not materialized by these loaders")
@@ -0,0 +1,61 @@
+# -*- coding: UTF-8 -*-
+"""Scaling of D4RL query rendering with the number of render processes.
+
+Replays random states around the initial pose of a D4RL env and times
+render_queries (render, tile and encode every query) for every worker count.
+Needs gym, d4rl and a working MuJoCo offscreen renderer.
+
+    python benchmarks/bench_parallel_render.py --environment_name hopper-medium-v2 --task mujoco --workers 1 2 4 8
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+from pathlib import Path
+import numpy as np
+import gym
+
+sys.path.append(str(Path(__file__).parent.parent))
+from datasets.offline_d4rl import render_queries
+
+
+def make_requests(env, num_queries, query_length, sample_num, save_dir, rng):
+    requests = []
+    for query in range(num_queries):
+        qposes = env.init_qpos + 0.1 * rng.standard_normal((sample_num, query_length, env.model.nq))
+        qvels = env.init_qvel + 0.1 * rng.standard_normal((sample_num, query_length, env.model.nv))
+        requests.append({"segments": [(0, query_length)] * sample_num, "qposes": list(qposes), "qvels": list(qvels), "goals": [None] * sample_num,
+                         "video_url": os.path.join(save_dir, f"{query}.mp4"), "frames_dir": None})
+    return requests
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--environment_name', type=str, default='hopper-medium-v2')
+    parser.add_argument('--task', type=str, default='mujoco', choices=['mujoco', 'adroit', 'antmaze'])
+    parser.add_argument('--num_queries', type=int, default=32)
+    parser.add_argument('--query_length', type=int, default=50)
+    parser.add_argument('--sample_num', type=int, default=2, choices=[1, 2])
+    parser.add_argument('--size', type=int, default=500, help='width and height of the frames.')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8, os.cpu_count()])
+    cfg = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    env = gym.make(cfg.environment_name)
+    root = tempfile.mkdtemp()
+    try:
+        requests = make_requests(env.unwrapped, cfg.num_queries, cfg.query_length, cfg.sample_num, root, rng)
+        baseline = None
+        for num_workers in sorted(set(cfg.workers)):
+            start = time.perf_counter()
+            for _ in render_queries(cfg.environment_name, cfg.task, requests, cfg.size, cfg.size, 30, num_workers):
+                pass
+            elapsed = time.perf_counter() - start
+            baseline = baseline or elapsed
+            frames = cfg.num_queries * cfg.sample_num * cfg.query_length
+            print(f"workers {num_workers:>3}: {elapsed:7.2f}s, {frames / elapsed:7.0f} frames/s, "
+                  f"speedup x{baseline / elapsed:4.1f} (efficiency {baseline / elapsed / num_workers:.0%})")
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
@@ -0,0 +1,77 @@
+# -*- coding: UTF-8 -*-
+"""Scaling of parallel shard ingestion with the worker count.
+
+Writes synthetic SMARTS pickle shards and VD4RL hdf5 shards to a temporary
+directory, then times the SMARTS columnar conversion and a full-range read of
+the sharded VD4RL observations for every worker count.
+
+    python benchmarks/bench_parallel_shards.py --num_shards 32 --workers 1 2 4 8 16 32
+"""
+import os
+import sys
+import time
+import pickle
+import shutil
+import argparse
+import tempfile
+from pathlib import Path
+import numpy as np
+import h5py
+
+sys.path.append(str(Path(__file__).parent.parent))
+import datasets.dataset_utils as dataset_utils
+from datasets.offline_smarts import convert_smarts_to_columnar
+
+
+def write_smarts_shards(dataset_path, num_shards, shard_steps, rng):
+    os.makedirs(dataset_path)
+    for shard in range(num_shards):
+        rows = [(rng.integers(0, 255, (64, 64, 3), dtype=np.uint8), rng.standard_normal(55), rng.standard_normal(2),
+                 float(rng.standard_normal()), i == shard_steps - 1) for i in range(shard_steps)]
+        with open(os.path.join(dataset_path, f"{shard}_shard.pkl"), 'wb') as f:
+            pickle.dump(rows, f)
+
+
+def write_vd4rl_shards(dataset_path, num_shards, shard_steps, rng):
+    os.makedirs(dataset_path)
+    for shard in range(num_shards):
+        with h5py.File(os.path.join(dataset_path, f"{shard}_shard.hdf5"), 'w') as f:
+            f.create_dataset('observation', data=rng.integers(0, 255, (shard_steps, 3, 84, 84), dtype=np.uint8),
+                             compression='gzip', chunks=(1, 3, 84, 84))
+    return [os.path.join(dataset_path, filename) for filename in sorted(os.listdir(dataset_path))]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_shards', type=int, default=32)
+    parser.add_argument('--shard_steps', type=int, default=1000)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32])
+    cfg = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    root = tempfile.mkdtemp()
+    try:
+        smarts_path = os.path.join(root, 'smarts')
+        write_smarts_shards(smarts_path, cfg.num_shards, cfg.shard_steps, rng)
+        vd4rl_paths = write_vd4rl_shards(os.path.join(root, 'vd4rl'), cfg.num_shards, cfg.shard_steps, rng)
+
+        baseline = {}
+        for num_workers in cfg.workers:
+            start = time.perf_counter()
+            convert_smarts_to_columnar(smarts_path, os.path.join(root, f'smarts_{num_workers}.hdf5'), num_workers=num_workers)
+            smarts_time = time.perf_counter() - start
+
+            datasets = dataset_utils.ShardedHDF5Dataset(vd4rl_paths, num_workers=num_workers)
+            start = time.perf_counter()
+            datasets['observation'][:]
+            vd4rl_time = time.perf_counter() - start
+            datasets.close()
+            # the next row starts its own pool, with its worker count
+            dataset_utils.shutdown_read_pools()
+
+            baseline.setdefault('smarts', smarts_time)
+            baseline.setdefault('vd4rl', vd4rl_time)
+            print(f"workers {num_workers:>3}: smarts {smarts_time:7.2f}s (x{baseline['smarts'] / smarts_time:4.1f})  "
+                  f"vd4rl {vd4rl_time:7.2f}s (x{baseline['vd4rl'] / vd4rl_time:4.1f})")
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
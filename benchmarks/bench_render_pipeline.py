@@ -0,0 +1,51 @@
+# -*- coding: UTF-8 -*-
+"""Overlap of rendering and encoding in dataset_utils.stream_video.
+
+Streams side-by-side videos whose frames are "rendered" by upscaling random
+native frames with cv2, once with a single buffer (render and encode take turns)
+and once per ring size given, and prints the stage utilization of every run.
+With overlap the wall time approaches max(render, encode) instead of their sum.
+
+    python benchmarks/bench_render_pipeline.py --num_buffers 1 2 3 4 --query_length 500
+"""
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+from pathlib import Path
+import numpy as np
+import cv2
+
+sys.path.append(str(Path(__file__).parent.parent))
+import datasets.dataset_utils as dataset_utils
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--native', type=int, default=84, help='height and width of the source frames.')
+    parser.add_argument('--size', type=int, default=500, help='height and width of every rendered frame.')
+    parser.add_argument('--query_length', type=int, default=500)
+    parser.add_argument('--sample_num', type=int, default=2)
+    parser.add_argument('--chunk_frames', type=int, default=dataset_utils.VIDEO_CHUNK_FRAMES)
+    parser.add_argument('--num_buffers', type=int, nargs='+', default=[1, 2, 3, 4])
+    cfg = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    segments = [rng.integers(0, 256, (cfg.query_length, cfg.native, cfg.native, 3), dtype=np.uint8) for _ in range(cfg.sample_num)]
+
+    def fill(tiles, start, stop):
+        for tile, frames in zip(tiles, segments):
+            for t in range(start, stop):
+                tile[t - start] = cv2.resize(frames[t], dsize=(cfg.size, cfg.size), interpolation=cv2.INTER_CUBIC)
+
+    root = tempfile.mkdtemp()
+    try:
+        for num_buffers in cfg.num_buffers:
+            stats = dataset_utils.stream_video(os.path.join(root, f"{num_buffers}.mp4"), cfg.query_length, (cfg.size, cfg.size, 3), 30, fill,
+                                               num_segments=cfg.sample_num, chunk_frames=cfg.chunk_frames, num_buffers=num_buffers)
+            print(f"buffers {num_buffers}: render {stats.render:6.2f}s + encode {stats.encode:6.2f}s, wall {stats.wall:6.2f}s "
+                  f"(max {max(stats.render, stats.encode):6.2f}s)")
+            print(f"    {stats.report()}")
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
@@ -0,0 +1,63 @@
+# -*- coding: UTF-8 -*-
+"""Benchmark the vectorized segment sampler against the original rejection loop.
+
+    python benchmarks/bench_segment_sampler.py --num_queries 100000 --query_length 200
+"""
+import sys
+import time
+import argparse
+from pathlib import Path
+import numpy as np
+
+sys.path.append(str(Path(__file__).parent.parent))
+from datasets.dataset_utils import sample_segments, EpisodeIndex
+
+
+def make_episode_index(num_episodes, mean_length, seed=0):
+    rng = np.random.default_rng(seed)
+    lengths = rng.geometric(1 / mean_length, size=num_episodes)
+    return EpisodeIndex.from_ends(int(lengths.sum()), np.cumsum(lengths) - 1)
+
+
+def legacy_sample(trj_idx_list, query_length, total_sample_num):
+    """The rejection loop every Dataset.sample used before vectorization."""
+    trj_idx_list = np.array(trj_idx_list)
+    trj_len_list = trj_idx_list[:, 1] - trj_idx_list[:, 0] + 1
+    start_indices, end_indices = np.zeros(total_sample_num), np.zeros(total_sample_num)
+    for query_count in range(total_sample_num):
+        while True:
+            trj_idx = np.random.choice(np.arange(len(trj_idx_list) - 1))
+            len_trj = trj_len_list[trj_idx]
+            if len_trj > query_length:
+                start_indices[query_count] = trj_idx_list[trj_idx][0] + np.random.choice(len_trj - query_length + 1)
+                end_indices[query_count] = start_indices[query_count] + query_length
+                break
+    return start_indices, end_indices
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_episodes', type=int, default=20000)
+    parser.add_argument('--mean_episode_length', type=int, default=100, help='episode lengths are geometric, most are short.')
+    parser.add_argument('--query_length', type=int, default=200)
+    parser.add_argument('--num_queries', type=int, default=100000)
+    parser.add_argument('--legacy_queries', type=int, default=1000, help='the rejection loop is timed on fewer queries.')
+    cfg = parser.parse_args()
+
+    episode_index = make_episode_index(cfg.num_episodes, cfg.mean_episode_length)
+    trj_idx_list = episode_index.trj_idx_list
+    lengths = episode_index.lengths[:-1]
+    print(f"{len(episode_index)} episodes, {np.mean(lengths > cfg.query_length):.1%} longer than {cfg.query_length} steps")
+
+    start = time.perf_counter()
+    start_indices, end_indices = sample_segments(trj_idx_list, cfg.query_length, cfg.num_queries)
+    vectorized_time = time.perf_counter() - start
+    episode_ids = episode_index.episode_ids
+    assert np.array_equal(episode_ids[start_indices], episode_ids[end_indices - 1])
+    print(f"vectorized: {vectorized_time * 1e3:.1f}ms for {cfg.num_queries} segments")
+
+    start = time.perf_counter()
+    legacy_sample(trj_idx_list, cfg.query_length, cfg.legacy_queries)
+    legacy_time = (time.perf_counter() - start) * cfg.num_queries / cfg.legacy_queries
+    print(f"legacy loop: {legacy_time:.2f}s for {cfg.num_queries} segments (extrapolated from {cfg.legacy_queries})")
+    print(f"speedup x{legacy_time / vectorized_time:.0f}")
@@ -0,0 +1,64 @@
+# -*- coding: UTF-8 -*-
+"""Resizing frames in Python versus in the ffmpeg filter graph.
+
+Writes side-by-side query videos of random native-resolution frames, once resizing
+every frame with cv2.resize before encoding (the fallback path) and once passing
+the native frames to dataset_utils.write_video with a target size.
+
+    python benchmarks/bench_video_resize.py --native 84 --size 500 --query_length 200 --num_queries 10
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+from pathlib import Path
+import numpy as np
+import cv2
+
+sys.path.append(str(Path(__file__).parent.parent))
+import datasets.dataset_utils as dataset_utils
+
+
+def python_resize(video_path, segments, size, fps):
+    video, tiles = dataset_utils.video_canvas(len(segments[0]), (size[1], size[0]) + segments[0].shape[3:], len(segments))
+    for tile, frames in zip(tiles, segments):
+        for t, frame in enumerate(frames):
+            tile[t] = cv2.resize(frame, dsize=size, interpolation=cv2.INTER_CUBIC)
+    dataset_utils.write_video(video_path, video, fps, num_segments=len(segments))
+
+
+def encoder_resize(video_path, segments, size, fps):
+    video, tiles = dataset_utils.video_canvas(len(segments[0]), segments[0].shape[1:], len(segments))
+    for tile, frames in zip(tiles, segments):
+        tile[:] = frames
+    dataset_utils.write_video(video_path, video, fps, num_segments=len(segments), size=size)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--native', type=int, default=84, help='height and width of the dataset frames.')
+    parser.add_argument('--size', type=int, default=500, help='height and width of every segment in the video.')
+    parser.add_argument('--query_length', type=int, default=200)
+    parser.add_argument('--num_queries', type=int, default=10)
+    parser.add_argument('--sample_num', type=int, default=2, help='segments tiled in every video.')
+    parser.add_argument('--gray', action='store_true', help='single channel frames, like Atari.')
+    cfg = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    shape = (cfg.query_length, cfg.native, cfg.native) + (() if cfg.gray else (3,))
+    queries = [[rng.integers(0, 256, shape, dtype=np.uint8) for _ in range(cfg.sample_num)] for _ in range(cfg.num_queries)]
+    root = tempfile.mkdtemp()
+    try:
+        times = {}
+        for name, write in [('python resize', python_resize), ('encoder resize', encoder_resize)]:
+            start = time.perf_counter()
+            for query, segments in enumerate(queries):
+                write(os.path.join(root, f"{name.split()[0]}_{query}.mp4"), segments, (cfg.size, cfg.size), 30)
+            times[name] = time.perf_counter() - start
+            frames = cfg.num_queries * cfg.query_length
+            print(f"{name:>15}: {times[name]:7.2f}s, {frames / times[name]:7.0f} video frames/s")
+        print(f"speedup x{times['python resize'] / times['encoder resize']:.2f}")
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
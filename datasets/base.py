@@ -1,9 +1,199 @@
 
 
+import os
+import inspect
+import numpy as np
+import cv2
+
+from datasets import dataset_utils, samplers
+from datasets.dataset_cache import source_fingerprint
+from datasets.segment_index import SegmentIndex, DEFAULT_INDEX_DIR, overlapping_in_batch
+from datasets.frame_cache import FrameCache, DEFAULT_FRAME_CACHE_BUDGET
+
+
 class BaseOfflineDataset(object):
-    def __init__(self):
-        pass
+    # converted columns read by each stage of generate_video_resources; the loader
+    # reads only these, every other column is loaded when something first asks for it
+    stage_columns = {}
+    # raw files the dataset is read from, fingerprinted to key the segment index
+    source_paths = []
+    # pixel datasets pass native frames to ffmpeg and let its filter graph scale them
+    resize_in_encoder = True
+
+    def __init__(self, sampler_config=None, encoder_config=None, frame_config=None):
+        self.sampler_config = dict(sampler_config or {})
+        # FrameWriter options of the images of 'visual' and 'keypoint' queries
+        self.frame_config = dict(frame_config or {})
+        # resolved once, so that an unknown profile fails before anything is sampled
+        self.encoder = dataset_utils.encoder_profile(encoder_config)
+        self._frame_cache = None
+        self.pipeline_stats = dataset_utils.PipelineStats()
+
+    def required_columns(self):
+        return sorted({column for columns in self.stage_columns.values() for column in columns})
         
+    def registry_key(self):
+        """Key of the dataset in the registry, which converts it once per server process for every later project."""
+        return (self.domain, self.task, self.environment_name, source_fingerprint(self.source_paths))
+
+    def segment_index(self):
+        fingerprint = source_fingerprint(self.source_paths) or "unversioned"
+        return SegmentIndex.open(os.path.join(DEFAULT_INDEX_DIR, self.domain, self.task, self.environment_name, f"{fingerprint}.npy"))
+
+    def frame_cache(self, camera):
+        """The FrameCache of the rendered frames at the video size, disabled when the files cannot be fingerprinted."""
+        if self._frame_cache is None:
+            fingerprint = source_fingerprint(self.source_paths) if self.source_paths else None
+            self._frame_cache = FrameCache(fingerprint or "unversioned", self.width, self.height, camera,
+                                           max_bytes=DEFAULT_FRAME_CACHE_BUDGET if fingerprint else 0)
+        return self._frame_cache
+
+    def read_frames(self, start, stop):
+        """Native (T, H, W, 3) or (T, H, W) uint8 frames of the timesteps [start, stop) of a pixel dataset."""
+        raise NotImplementedError("read_frames method must be implemented in pixel datasets.")
+
+    def resize_frame(self, frame):
+        return cv2.resize(frame, dsize=(self.width, self.height), interpolation=cv2.INTER_CUBIC)
+
+    def query_segments(self, video_info, seg_idx):
+        """Timestep ranges of the segments of query `seg_idx`, from start_indices_1..k or start_indices."""
+        if "start_indices" in video_info:
+            return [range(video_info["start_indices"][seg_idx], video_info["end_indices"][seg_idx])]
+        segments = []
+        while f"start_indices_{len(segments) + 1}" in video_info:
+            i = len(segments) + 1
+            segments.append(range(video_info[f"start_indices_{i}"][seg_idx], video_info[f"end_indices_{i}"][seg_idx]))
+        return segments
+
+    def write_query_video(self, video_url, segments, frames_dir=None):
+        """Streams the frames of `segments`, tiled in one video, to the encoder, and to `frames_dir` as images."""
+        first = self.read_frames(segments[0].start, segments[0].start + 1)[0]
+        frame_shape = first.shape if self.resize_in_encoder else self.resize_frame(first).shape
+
+        def fill(tiles, start, stop):
+            for tile, indices in zip(tiles, segments):
+                chunk = indices[start:stop]
+                frames = self.read_frames(chunk.start, chunk.stop)
+                if self.resize_in_encoder:
+                    tile[:] = frames
+                    continue
+                for t, frame in enumerate(frames):
+                    tile[t] = self.resize_frame(frame)
+        frame_writer = None if frames_dir is None else dataset_utils.FrameWriter(frames_dir, **self.frame_config)
+        try:
+            dataset_utils.stream_video(video_url, len(segments[0]), frame_shape, self.fps, fill, num_segments=len(segments),
+                                       size=(self.width, self.height) if self.resize_in_encoder else None, stats=self.pipeline_stats,
+                                       encoder=self.encoder, frame_writer=frame_writer)
+        finally:
+            if frame_writer is not None:
+                frame_writer.close()
+
+    def report_render_stats(self):
+        """Trims the frame cache and prints its hit rate and the render/encode pipeline utilization."""
+        cache = self._frame_cache
+        if cache is not None:
+            cache.trim()
+            print("Frame cache: {hits} hits, {misses} misses ({hit_rate:.0%})".format(**cache.stats()))
+        if self.pipeline_stats.frames:
+            print(self.pipeline_stats.report())
+
+    def check_query_length(self, trj_idx_list):
+        """Raises a ValueError naming the longest episode when no episode can hold a query segment."""
+        trj_idx_list = np.asarray(trj_idx_list, dtype=np.int64).reshape(-1, 2)[:-1]
+        longest = int((trj_idx_list[:, 1] - trj_idx_list[:, 0] + 1).max()) if len(trj_idx_list) else 0
+        if longest <= self.query_length:
+            raise ValueError(f"The query length {self.query_length} does not fit in any episode of {self.environment_name}, "
+                             f"the longest complete episode has {longest} steps. Choose a query length below {longest}.")
+
+    def sample_segment_indices(self, trj_idx_list, total_sample_num):
+        """Start and end indices of `total_sample_num` segments, drawn by `self.sampler_type`."""
+        self.check_query_length(trj_idx_list)
+        if self.sampler_type == 'schedule':
+            batches = [np.stack(batch).reshape(2, self.sample_num, -1) for batch in self.sample_segment_batches(trj_idx_list)]
+            start_indices, end_indices = np.concatenate(batches, axis=2).reshape(2, -1)
+            return start_indices, end_indices
+        sampler = {'disagreement': samplers.disagreement_sample,
+                   'diversity': samplers.diversity_sample,
+                   'stratified': samplers.stratified_sample}.get(self.sampler_type)
+        if sampler is not None:
+            def draw(num_queries):
+                return sampler(self.datasets, trj_idx_list, self.query_length, num_queries, self.sample_num,
+                               over_sample=self.over_sample, **self._sampler_kwargs(sampler))
+        else:
+            def draw(num_queries):
+                return dataset_utils.sample_segments(trj_idx_list, self.query_length, num_queries * self.sample_num, over_sample=self.over_sample)
+        start_indices, end_indices = draw(total_sample_num // self.sample_num)
+        return self.redraw_overlapping(start_indices, end_indices, draw)
+
+    def sample_segment_batches(self, trj_idx_list):
+        """Yields (start_indices, end_indices) query batches; only the 'schedule' sampler yields more than one."""
+        if self.sampler_type != 'schedule':
+            yield self.sample_segment_indices(trj_idx_list, self.query_num * self.sample_num)
+            return
+        self.check_query_length(trj_idx_list)
+        for start_indices, end_indices, draw in samplers.schedule_sample(self.datasets, trj_idx_list, self.query_length, self.query_num, self.sample_num,
+                                                                         over_sample=self.over_sample, **self._sampler_kwargs(samplers.schedule_sample)):
+            yield self.redraw_overlapping(start_indices, end_indices, draw)
+
+    def _sampler_kwargs(self, sampler):
+        # the config may carry options of other samplers, e.g. pool_size from the CLI
+        parameters = inspect.signature(sampler).parameters
+        return {key: value for key, value in self.sampler_config.items() if key in parameters}
+
+    def redraw_overlapping(self, start_indices, end_indices, draw, max_rounds=20):
+        """Redraws by `draw` the whole queries overlapping issued segments or each other by more than `max_overlap`."""
+        max_overlap = self.sampler_config.get('max_overlap', 0.5)
+        index = self.segment_index()
+        start_indices = np.array(start_indices, dtype=np.int64).reshape(self.sample_num, -1)
+        end_indices = np.array(end_indices, dtype=np.int64).reshape(self.sample_num, -1)
+        for _ in range(max_rounds):
+            with index.lock:
+                issued_overlap = index.max_overlap(start_indices.reshape(-1), end_indices.reshape(-1))
+            rejected = (issued_overlap > max_overlap) | overlapping_in_batch(start_indices.reshape(-1), end_indices.reshape(-1), max_overlap)
+            rejected = rejected.reshape(self.sample_num, -1).any(axis=0)
+            if not rejected.any():
+                break
+            new_start_indices, new_end_indices = draw(int(rejected.sum()))
+            start_indices[:, rejected] = np.asarray(new_start_indices).reshape(self.sample_num, -1)
+            end_indices[:, rejected] = np.asarray(new_end_indices).reshape(self.sample_num, -1)
+        else:
+            print(f"Warning: {int(rejected.sum())} queries still overlap issued segments after {max_rounds} redraws.")
+        return start_indices.reshape(-1), end_indices.reshape(-1)
+
+    def record_segments(self, start_indices, end_indices):
+        """Adds segments whose videos were rendered to the segment index of the dataset, see `save_segments`."""
+        index = self.segment_index()
+        with index.lock:
+            index.add(start_indices, end_indices)
+
+    def save_segments(self):
+        """Writes the segment index once the batches of generate_video_resources are done."""
+        index = self.segment_index()
+        with index.lock:
+            index.save()
+
+    def generate_video_resources(self):
+        # 1: load offline dataset
+        self.load_offline_dataset()
+        # 2: get episode boundaries
+        trj_idx_list = self.get_episode_boundaries()
+        video_info_list, video_url_list, query_id_list = [], [], []
+        try:
+            # rendering of a batch starts as soon as it is sampled, the 'schedule' sampler yields several
+            for segment_indices in self.sample_segment_batches(trj_idx_list):
+                # 3: get sample indices
+                indices_info = self.sample(trj_idx_list, segment_indices)
+                query_id_list += indices_info['query_id']
+                # 4: visualize query
+                video_url_list += self.visualize_query(indices_info)
+                # only segments that made it into videos count as issued
+                self.record_segments(*segment_indices)
+                # 5: get video info
+                video_info_list += dataset_utils.reformat_video_info(indices_info)
+        finally:
+            self.save_segments()
+        return video_info_list, video_url_list, query_id_list
+
     def load_offline_dataset(self):
         raise NotImplementedError("load_offline_dataset method must be implemented in subclasses.")
         
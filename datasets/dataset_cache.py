@@ -0,0 +1,117 @@
+import os
+import json
+import uuid
+import shutil
+import hashlib
+from pathlib import Path
+import numpy as np
+
+from datasets.dataset_utils import NextObservationView, EpisodeIndex, LazyColumns
+
+
+DEFAULT_CACHE_DIR = str(Path(__file__).parent / "dataset_cache")
+CACHE_VERSION = 2
+
+
+def source_fingerprint(source_paths):
+    """Fingerprint of the raw dataset files (path, size and mtime of every file).
+
+    Directories are expanded to the files they contain. Returns None when a source
+    does not exist yet, e.g. before d4rl has downloaded it.
+    """
+    files = []
+    for source_path in source_paths:
+        if os.path.isdir(source_path):
+            files.extend(os.path.join(source_path, filename) for filename in sorted(os.listdir(source_path)))
+        elif os.path.isfile(source_path):
+            files.append(source_path)
+        else:
+            return None
+    digest = hashlib.sha1()
+    for file in files:
+        stat = os.stat(file)
+        digest.update(f"{os.path.abspath(file)}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+    return digest.hexdigest()
+
+
+class DatasetCache(object):
+    def __init__(self, domain, task, environment_name, source_paths, cache_dir=DEFAULT_CACHE_DIR):
+        """Converted dataset columns and episode index, stored as memory-mappable .npy files.
+
+        Args:
+            domain (str): The domain.
+            task (str): The task.
+            environment_name (str): The environment name.
+            source_paths (list): Raw dataset files or directories the conversion reads.
+            cache_dir (str): Root directory of the cache.
+        """
+        self.root = os.path.join(cache_dir, domain, task, environment_name)
+        self.source_paths = source_paths
+
+    def path(self):
+        fingerprint = source_fingerprint(self.source_paths)
+        return None if fingerprint is None else os.path.join(self.root, fingerprint)
+
+    def _read_manifest(self, path):
+        if not os.path.exists(os.path.join(path, "manifest.json")):
+            return None
+        with open(os.path.join(path, "manifest.json"), "r") as f:
+            manifest = json.load(f)
+        return manifest if manifest.get("version") == CACHE_VERSION else None
+
+    def load(self):
+        """Returns (datasets, episode_index) opened with mmap_mode='r', or None on a miss.
+
+        Only columns that were loaded when the entry was saved are cached, the caller
+        keeps lazy loaders (or lazy views of the source files) for the others.
+        """
+        path = self.path()
+        manifest = None if path is None else self._read_manifest(path)
+        if manifest is None:
+            return None
+        datasets = {}
+        for key, kind in manifest["columns"].items():
+            if kind == "array":
+                datasets[key] = np.load(os.path.join(path, f"{key}.npy"), mmap_mode="r")
+        for key, kind in manifest["columns"].items():
+            if kind == "next_observation_view":
+                datasets[key] = NextObservationView(datasets["observations"],
+                                                    np.load(os.path.join(path, f"{key}.patch_rows.npy")),
+                                                    np.load(os.path.join(path, f"{key}.patch_values.npy"), mmap_mode="r"))
+        episode_index = EpisodeIndex(*(np.load(os.path.join(path, f"episode_{key}.npy"), mmap_mode="r")
+                                       for key in ("starts", "ends", "ids")))
+        print(f"Loaded converted dataset from cache {path}")
+        return datasets, episode_index
+
+    def save(self, datasets, episode_index):
+        path = self.path()
+        if path is None or self._read_manifest(path) is not None:
+            return
+        # drop an entry written by an older cache version
+        shutil.rmtree(path, ignore_errors=True)
+        # write next to the final location and rename, so readers never see a partial entry
+        tmp_path = f"{path}.tmp-{uuid.uuid4().hex}"
+        os.makedirs(tmp_path)
+        columns = {}
+        # columns nobody has asked for yet stay lazy and are not written
+        items = datasets.loaded_items() if isinstance(datasets, LazyColumns) else list(datasets.items())
+        loaded = dict(items)
+        for key, value in items:
+            if isinstance(value, np.ndarray) and value.dtype != object:
+                np.save(os.path.join(tmp_path, f"{key}.npy"), value)
+                columns[key] = "array"
+            elif isinstance(value, NextObservationView) and value.observations is loaded.get("observations"):
+                np.save(os.path.join(tmp_path, f"{key}.patch_rows.npy"), value.patch_rows)
+                np.save(os.path.join(tmp_path, f"{key}.patch_values.npy"), np.asarray(value.patch_values))
+                columns[key] = "next_observation_view"
+        np.save(os.path.join(tmp_path, "episode_starts.npy"), episode_index.starts)
+        np.save(os.path.join(tmp_path, "episode_ends.npy"), episode_index.ends)
+        np.save(os.path.join(tmp_path, "episode_ids.npy"), episode_index.episode_ids)
+        with open(os.path.join(tmp_path, "manifest.json"), "w") as f:
+            json.dump({"version": CACHE_VERSION, "columns": columns, "source_paths": [str(p) for p in self.source_paths]}, f)
+        try:
+            os.replace(tmp_path, path)
+            print(f"Saved converted dataset to cache {path}")
+        except OSError:
+            # another project cached the same dataset first
+            shutil.rmtree(tmp_path, ignore_errors=True)
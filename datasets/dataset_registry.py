@@ -0,0 +1,110 @@
+import os
+import threading
+import functools
+import collections
+from concurrent.futures import Future
+import numpy as np
+
+from datasets.dataset_utils import LazyColumns
+
+
+DEFAULT_MEMORY_BUDGET = int(os.environ.get("DATASET_MEMORY_BUDGET", 8 * 2 ** 30))
+
+
+def _read_only(columns, key):
+    value = columns[key]
+    if isinstance(value, np.ndarray):
+        value = value.view()
+        value.flags.writeable = False
+    return value
+
+
+def _close(columns):
+    # views handed out before the eviction reopen the files if they still load a column
+    if isinstance(columns, LazyColumns):
+        columns.close()
+
+
+def _resident_bytes(columns):
+    # memory-mapped columns live in the page cache and are not charged to the budget
+    items = columns.loaded_items() if isinstance(columns, LazyColumns) else columns.items()
+    return sum(value.nbytes for _, value in items if isinstance(value, np.ndarray) and not isinstance(value, np.memmap))
+
+
+class DatasetRegistry(object):
+    def __init__(self, memory_budget=DEFAULT_MEMORY_BUDGET):
+        """Converted datasets kept resident across Streamlit sessions and project creations.
+
+        Every key is loaded once: concurrent requests for a key that is still loading
+        wait for that load instead of starting their own. Callers get read-only,
+        zero-copy views. Least recently used datasets are evicted once the resident
+        columns exceed memory_budget bytes, and the files their loaders read are closed.
+
+        Args:
+            memory_budget (int): Bytes of in-memory columns to keep resident.
+        """
+        self.memory_budget = memory_budget
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._loading = {}
+
+    def get(self, key, loader):
+        """Returns (datasets, episode_index) for key, calling loader() only if it is not resident."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._view(*self._entries[key])
+            owner = key not in self._loading
+            if owner:
+                self._loading[key] = Future()
+            future = self._loading[key]
+
+        if not owner:
+            return self._view(*future.result())
+        try:
+            entry = loader()
+        except BaseException as e:
+            with self._lock:
+                del self._loading[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            del self._loading[key]
+            self._entries[key] = entry
+            self._evict(keep=key)
+        future.set_result(entry)
+        return self._view(*entry)
+
+    def evict(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        if entry is not None:
+            _close(entry[0])
+
+    def resident_bytes(self):
+        with self._lock:
+            return sum(_resident_bytes(datasets) for datasets, _ in self._entries.values())
+
+    def _evict(self, keep):
+        # columns are loaded lazily, so sizes are re-measured on every insert
+        sizes = {key: _resident_bytes(datasets) for key, (datasets, _) in self._entries.items()}
+        total = sum(sizes.values())
+        for key in list(self._entries):
+            if total <= self.memory_budget:
+                break
+            if key != keep:
+                _close(self._entries.pop(key)[0])
+                total -= sizes[key]
+                print(f"Evicted dataset {key} from the registry")
+
+    def _view(self, datasets, episode_index):
+        view = LazyColumns()
+        for key in datasets:
+            view.set_loader(key, functools.partial(_read_only, datasets, key))
+        for array in (episode_index.starts, episode_index.ends, episode_index.episode_ids):
+            if isinstance(array, np.ndarray) and array.flags.owndata:
+                array.flags.writeable = False
+        return view, episode_index
+
+
+registry = DatasetRegistry()
@@ -1,6 +1,18 @@
 import cv2
 from pathlib import Path
 import os
+import time
+import queue
+import shutil
+import threading
+import collections
+import multiprocessing
+from collections.abc import MutableMapping
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+import h5py
+import imageio
+import imageio_ffmpeg
 
 
 def video_to_frames(video_path, output_path):
@@ -22,6 +34,250 @@ def video_to_frames(video_path, output_path):
         count += 1
     cap.release()
 
+# cv2.imwrite parameter and default of every image format: quality 0-100 for jpg and webp, compression 0-9 for png
+IMAGE_FORMATS = {
+    'jpg': (cv2.IMWRITE_JPEG_QUALITY, 95),
+    'png': (cv2.IMWRITE_PNG_COMPRESSION, 3),
+    'webp': (cv2.IMWRITE_WEBP_QUALITY, 90),
+}
+
+
+class FrameWriter(object):
+    def __init__(self, output_path, image_format='jpg', quality=None, stride=1, num_threads=None):
+        """Writes every `stride`-th frame of a video as an image, encoded in a thread pool."""
+        if image_format not in IMAGE_FORMATS:
+            raise ValueError(f"Unknown image format {image_format}, choices are {sorted(IMAGE_FORMATS)}.")
+        if stride < 1:
+            raise ValueError("The frame stride must be positive.")
+        flag, default = IMAGE_FORMATS[image_format]
+        self.output_path = output_path
+        self.image_format = image_format
+        self.params = [flag, int(default if quality is None else quality)]
+        self.stride = stride
+        os.makedirs(output_path, exist_ok=True)
+        self.pool = ThreadPoolExecutor(num_threads or min(4, os.cpu_count() or 1))
+
+    def write(self, frames, start, num_segments=1, size=None):
+        """Submits the frames of a `video_canvas` chunk starting at frame `start`."""
+        return [self.pool.submit(self._write, frames[i], start + i, num_segments, size)
+                for i in range(-start % self.stride, len(frames), self.stride)]
+
+    def _write(self, frame, index, num_segments, size):
+        if size is not None:
+            rows, columns = tile_grid(num_segments)
+            height, width = frame.shape[0] // rows, frame.shape[1] // columns
+            image = np.empty((rows * size[1], columns * size[0]) + frame.shape[2:], dtype=np.uint8)
+            for row in range(rows):
+                for column in range(columns):
+                    image[row * size[1]:(row + 1) * size[1], column * size[0]:(column + 1) * size[0]] = cv2.resize(
+                        frame[row * height:(row + 1) * height, column * width:(column + 1) * width], dsize=size, interpolation=cv2.INTER_CUBIC)
+            frame = image
+        if frame.ndim == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+        path = os.path.join(self.output_path, f"{index}.{self.image_format}")
+        if not cv2.imwrite(path, frame, self.params):
+            raise IOError(f"Cannot write {path}.")
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+
+
+def tile_grid(num_segments):
+    """(rows, columns) of the grid the segments of a query are tiled in, at most 3 per row."""
+    rows = -(-num_segments // 3)
+    return rows, -(-num_segments // rows)
+
+
+def video_canvas(num_frames, frame_shape, num_segments):
+    """Preallocates a uint8 video of `num_segments` tiles and returns it with the view of every tile."""
+    rows, columns = tile_grid(num_segments)
+    height, width = frame_shape[:2]
+    video = np.zeros((num_frames, rows * height, columns * width) + tuple(frame_shape[2:]), dtype=np.uint8)
+    tiles = [video[:, row * height:(row + 1) * height, column * width:(column + 1) * width]
+             for row, column in (divmod(i, columns) for i in range(num_segments))]
+    return video, tiles
+
+
+def scale_filter(num_segments, tile_width, tile_height, width, height):
+    """ffmpeg filter graph scaling every tile of a `video_canvas` frame to width x height."""
+    scale = f"scale={width}:{height}:flags=bicubic"
+    # yuv420p needs even dimensions
+    pad = "pad=ceil(iw/2)*2:ceil(ih/2)*2"
+    rows, columns = tile_grid(num_segments)
+    if rows * columns == 1:
+        return f"{scale},{pad}"
+    # every cell is cropped and scaled on its own, so that nothing bleeds across the tile borders,
+    # and padded to even dimensions before stacking, odd cells break the stacks of multi-row grids
+    cells = rows * columns
+    graph = [f"split={cells}" + "".join(f"[s{i}]" for i in range(cells))]
+    graph += [f"[s{i}]crop={tile_width}:{tile_height}:{i % columns * tile_width}:{i // columns * tile_height},{scale},{pad}[v{i}]"
+              for i in range(cells)]
+    row_stacks = ["".join(f"[v{row * columns + column}]" for column in range(columns)) + f"hstack=inputs={columns}"
+                  for row in range(rows)]
+    if rows == 1:
+        graph.append(f"{row_stacks[0]},{pad}")
+    else:
+        graph += [f"{stack}[r{row}]" for row, stack in enumerate(row_stacks)]
+        graph.append("".join(f"[r{row}]" for row in range(rows)) + f"vstack=inputs={rows},{pad}")
+    return ";".join(graph)
+
+
+ENCODER_PROFILES = {
+    # what imageio wrote before profiles existed, crf 25 is its quality=5
+    'default': {'codec': 'libx264', 'preset': 'medium', 'crf': 25, 'pix_fmt': 'yuv420p', 'keyint': None, 'threads': None},
+    'fast': {'codec': 'libx264', 'preset': 'veryfast', 'crf': 25, 'pix_fmt': 'yuv420p', 'keyint': None, 'threads': None},
+    'small': {'codec': 'libx264', 'preset': 'slow', 'crf': 30, 'pix_fmt': 'yuv420p', 'keyint': None, 'threads': None},
+    # a keyframe every 30 frames (a second at 30 fps), so the annotation page seeks without decoding from the start
+    'seekable': {'codec': 'libx264', 'preset': 'fast', 'crf': 25, 'pix_fmt': 'yuv420p', 'keyint': 30, 'threads': None},
+}
+
+
+def encoder_profile(encoder_config=None):
+    """The settings of the ENCODER_PROFILES entry `encoder_config['profile']`, overridden by the other keys."""
+    encoder_config = dict(encoder_config or {})
+    name = encoder_config.pop('profile', 'default')
+    if name not in ENCODER_PROFILES:
+        raise ValueError(f"Unknown encoder profile {name}, choices are {sorted(ENCODER_PROFILES)}.")
+    unknown = set(encoder_config) - set(ENCODER_PROFILES[name])
+    if unknown:
+        raise ValueError(f"Unknown encoder settings {sorted(unknown)}.")
+    return dict(ENCODER_PROFILES[name], **encoder_config)
+
+
+def _encoder_params(encoder):
+    """write_frames keyword arguments of an `encoder_profile`."""
+    output_params = []
+    if encoder['preset'] is not None and encoder['codec'] in ('libx264', 'libx265'):
+        output_params += ['-preset', encoder['preset']]
+    if encoder['crf'] is not None:
+        output_params += ['-crf', str(encoder['crf'])]
+        if encoder['codec'] == 'libvpx-vp9':
+            # constant quality mode of vp9
+            output_params += ['-b:v', '0']
+    if encoder['keyint'] is not None:
+        output_params += ['-g', str(encoder['keyint'])]
+    if encoder['threads'] is not None:
+        output_params += ['-threads', str(encoder['threads'])]
+    return {'codec': encoder['codec'], 'pix_fmt_out': encoder['pix_fmt'], 'quality': None, 'output_params': output_params}
+
+
+def _video_writer(video_path, frame_shape, fps, num_segments=1, size=None, encoder=None):
+    """A seeded imageio_ffmpeg.write_frames generator for frames of `frame_shape`, (H, W, 3) or (H, W)."""
+    height, width = frame_shape[:2]
+    pix_fmt_in = "gray" if len(frame_shape) == 2 else "rgb24"
+    params = _encoder_params(encoder or encoder_profile())
+    if size is None:
+        writer = imageio_ffmpeg.write_frames(video_path, (width, height), fps=fps, pix_fmt_in=pix_fmt_in, **params)
+    else:
+        rows, columns = tile_grid(num_segments)
+        graph = scale_filter(num_segments, width // columns, height // rows, *size)
+        params['output_params'] = ["-vf", graph] + params['output_params']
+        writer = imageio_ffmpeg.write_frames(video_path, (width, height), fps=fps, pix_fmt_in=pix_fmt_in, macro_block_size=1, **params)
+    writer.send(None)
+    return writer
+
+
+def write_video(video_path, video, fps, num_segments=1, size=None, encoder=None):
+    """Writes a `video_canvas` video as an mp4; with `size`, (width, height), ffmpeg scales every tile."""
+    writer = _video_writer(video_path, video.shape[1:], fps, num_segments, size, encoder)
+    for frame in video:
+        writer.send(np.ascontiguousarray(frame, dtype=np.uint8))
+    writer.close()
+
+
+VIDEO_CHUNK_FRAMES = 16
+
+
+class PipelineStats(object):
+    def __init__(self):
+        """Time spent by the render and encode stages of `stream_video`, summed over videos."""
+        self.frames = 0
+        self.wall = 0.0
+        self.render = 0.0
+        self.render_blocked = 0.0
+        self.encode = 0.0
+        self.encode_blocked = 0.0
+
+    def add(self, other):
+        for key, value in vars(other).items():
+            setattr(self, key, getattr(self, key) + value)
+        return self
+
+    def report(self):
+        wall = max(self.wall, 1e-9)
+        return (f"Rendered and encoded {self.frames} frames in {self.wall:.2f}s ({self.frames / wall:.0f} frames/s): "
+                f"render busy {self.render / wall:.0%}, blocked on the encoder {self.render_blocked / wall:.0%}; "
+                f"encode busy {self.encode / wall:.0%}, waiting for frames {self.encode_blocked / wall:.0%}")
+
+
+def stream_video(video_path, num_frames, frame_shape, fps, fill, num_segments=1, size=None, chunk_frames=VIDEO_CHUNK_FRAMES,
+                 num_buffers=3, stats=None, encoder=None, frame_writer=None):
+    """Encodes a tiled video chunk by chunk while `fill(tiles, start, stop)` renders into a ring of `num_buffers` chunks."""
+    stats = PipelineStats() if stats is None else stats
+    chunk_frames = min(chunk_frames, num_frames)
+    buffers = [video_canvas(chunk_frames, frame_shape, num_segments) for _ in range(num_buffers)]
+    free, filled = queue.Queue(), queue.Queue()
+    for buffer in buffers:
+        free.put(buffer)
+    writer = _video_writer(video_path, buffers[0][0].shape[1:], fps, num_segments, size, encoder)
+    errors = []
+
+    def encode():
+        while True:
+            wait_start = time.perf_counter()
+            item = filled.get()
+            encode_start = time.perf_counter()
+            stats.encode_blocked += encode_start - wait_start
+            if item is None:
+                break
+            (video, tiles), chunk_start, num_chunk_frames = item
+            if not errors:
+                pending = []
+                try:
+                    if frame_writer is not None:
+                        pending = frame_writer.write(video[:num_chunk_frames], chunk_start, num_segments, size)
+                    for frame in video[:num_chunk_frames]:
+                        writer.send(frame)
+                except Exception as e:
+                    errors.append(e)
+                # the images are read from the buffer, which is reused once they are written
+                for future in pending:
+                    try:
+                        future.result()
+                    except Exception as e:
+                        errors.append(e)
+            stats.encode += time.perf_counter() - encode_start
+            free.put((video, tiles))
+        try:
+            writer.close()
+        except Exception as e:
+            errors.append(e)
+
+    encoder = threading.Thread(target=encode, daemon=True)
+    start_time = time.perf_counter()
+    encoder.start()
+    try:
+        for start in range(0, num_frames, chunk_frames):
+            stop = min(start + chunk_frames, num_frames)
+            wait_start = time.perf_counter()
+            video, tiles = free.get()
+            render_start = time.perf_counter()
+            stats.render_blocked += render_start - wait_start
+            fill([tile[:stop - start] for tile in tiles], start, stop)
+            stats.render += time.perf_counter() - render_start
+            filled.put(((video, tiles), start, stop - start))
+            if errors:
+                break
+    finally:
+        filled.put(None)
+        encoder.join()
+    stats.wall += time.perf_counter() - start_time
+    stats.frames += num_frames
+    if errors:
+        raise errors[0]
+    return stats
+
+
 def reformat_video_info(video_info):
     combined_video_info = []
     n = len(list(video_info.values())[0])
@@ -34,4 +290,465 @@ def reformat_video_info(video_info):
             else:
                 new_dict[key] = value[i]
         combined_video_info.append(new_dict)
-    return combined_video_info
\ No newline at end of file
+    return combined_video_info
+
+class SerialExecutor(object):
+    """Runs submitted calls right away in this process, the pool of `worker_pool` for one worker."""
+    def __init__(self, initializer=None, initargs=()):
+        if initializer is not None:
+            initializer(*initargs)
+
+    def submit(self, fn, *args):
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+    def shutdown(self, wait=True):
+        pass
+
+
+# workers are spawned, a fork of the server process would inherit its threads and open h5py and mujoco handles
+_spawn_context = multiprocessing.get_context('spawn')
+
+
+def worker_pool(num_workers, initializer=None, initargs=()):
+    """A pool for `map_shards` calls: `num_workers` spawned processes, or this process for one."""
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    if num_workers <= 1:
+        return SerialExecutor(initializer, initargs)
+    return ProcessPoolExecutor(max_workers=num_workers, initializer=initializer, initargs=initargs, mp_context=_spawn_context)
+
+
+def worker_threads(num_workers):
+    """Threads each of `num_workers` processes may use so that together they do not oversubscribe the cpus."""
+    return max(1, (os.cpu_count() or 1) // max(num_workers or 1, 1))
+
+
+def map_shards(fn, items, num_workers=1, initializer=None, initargs=(), pool=None):
+    """Yields fn(item) for every item, in order, from at most `num_workers` processes with 2 * num_workers in flight."""
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    if pool is None and (num_workers <= 1 or len(items) <= 1):
+        if initializer is not None and len(items):
+            initializer(*initargs)
+        for item in items:
+            yield fn(item)
+        return
+    if pool is None:
+        with ProcessPoolExecutor(max_workers=min(num_workers, len(items)), initializer=initializer, initargs=initargs,
+                                 mp_context=_spawn_context) as pool:
+            yield from map_shards(fn, items, num_workers, pool=pool)
+        return
+    pending = collections.deque()
+    for item in items:
+        pending.append(pool.submit(fn, item))
+        if len(pending) >= 2 * max(num_workers, 1):
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def _read_hdf5_rows(request):
+    file_path, key, start, stop = request
+    with h5py.File(file_path, 'r') as f:
+        return f[key][start:stop]
+
+
+# range reads smaller than this stay in-process, a round trip to a worker costs more than the read
+PARALLEL_READ_BYTES = 64 * 2 ** 20
+
+_read_pools = {}
+_read_pool_lock = threading.Lock()
+
+
+def _shard_read_pool(num_workers):
+    """The spawned pool of `num_workers` processes reading large shard ranges, kept for the process lifetime."""
+    num_workers = num_workers or os.cpu_count() or 1
+    with _read_pool_lock:
+        if num_workers not in _read_pools:
+            _read_pools[num_workers] = ProcessPoolExecutor(max_workers=num_workers, mp_context=_spawn_context)
+        return _read_pools[num_workers]
+
+
+def shutdown_read_pools():
+    """Shuts down every shard read pool; the next large read starts a new one."""
+    with _read_pool_lock:
+        pools = list(_read_pools.values())
+        _read_pools.clear()
+    for pool in pools:
+        pool.shutdown()
+
+
+def prefix_sums(values):
+    """float64 prefix sums with a leading zero, so sum(values[a:b]) == prefix[b] - prefix[a]."""
+    prefix = np.zeros(len(values) + 1, dtype=np.float64)
+    np.cumsum(np.asarray(values[:], dtype=np.float64).reshape(len(values), -1).sum(axis=1), out=prefix[1:])
+    return prefix
+
+
+def sample_segments(trj_idx_list, query_length, num_samples, over_sample=False):
+    """Draws `num_samples` (start, end) segments of `query_length` steps uniformly over all valid windows."""
+    trj_idx_list = np.asarray(trj_idx_list, dtype=np.int64).reshape(-1, 2)[:-1]
+    starts = trj_idx_list[:, 0]
+    lengths = trj_idx_list[:, 1] - starts + 1
+    eligible = lengths > query_length
+    if not eligible.any():
+        raise ValueError(f"No trajectory is longer than the query length {query_length}.")
+    starts, lengths = starts[eligible], lengths[eligible]
+    num_positions = lengths + 1 if over_sample else lengths - query_length + 1
+    cumulative = np.cumsum(num_positions)
+    draws = np.random.randint(0, cumulative[-1], size=num_samples, dtype=np.int64)
+    trajectories = np.searchsorted(cumulative, draws, side='right')
+    offsets = draws - (cumulative[trajectories] - num_positions[trajectories])
+    if over_sample:
+        offsets = np.minimum(offsets, lengths[trajectories] - query_length)
+    start_indices = starts[trajectories] + offsets
+    return start_indices, start_indices + query_length
+
+
+_reopen_lock = threading.Lock()
+
+
+class ShardedHDF5Column(object):
+    """Read-on-demand view of one key stored across several HDF5 shards."""
+    def __init__(self, datasets, start=0, stop=None, num_workers=1):
+        # shared with every view, so a reopened shard serves all of them
+        self.datasets = datasets
+        self.sources = [(dataset.file.filename, dataset.name) for dataset in datasets]
+        self.num_workers = num_workers
+        lengths = [dataset.shape[0] for dataset in datasets]
+        self.offsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+        self.start = start
+        self.stop = int(self.offsets[-1]) if stop is None else stop
+        self.dtype = datasets[0].dtype
+        self.shape = (self.stop - self.start,) + tuple(datasets[0].shape[1:])
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        array = self[:]
+        return array if dtype is None else array.astype(dtype, copy=False)
+
+    def view(self, start, stop):
+        return ShardedHDF5Column(self.datasets, self.start + start, self.start + stop, self.num_workers)
+
+    def _shard(self, shard):
+        dataset = self.datasets[shard]
+        if not dataset:
+            with _reopen_lock:
+                if not self.datasets[shard]:
+                    file_name, name = self.sources[shard]
+                    self.datasets[shard] = h5py.File(file_name, 'r')[name]
+                dataset = self.datasets[shard]
+        return dataset
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step == 1:
+                return self._read_range(self.start + start, self.start + max(start, stop))
+            index = np.arange(start, stop, step)
+        if np.ndim(index) == 0:
+            index = int(index)
+            if index < 0:
+                index += len(self)
+            if not 0 <= index < len(self):
+                raise IndexError(f"index {index} is out of bounds for axis 0 with size {len(self)}")
+            shard, row = self._locate(self.start + index)
+            return self._shard(shard)[row]
+        return self._read_rows(np.asarray(index, dtype=np.int64))
+
+    def _locate(self, global_index):
+        shard = int(np.searchsorted(self.offsets, global_index, side='right')) - 1
+        return shard, global_index - int(self.offsets[shard])
+
+    def _read_range(self, start, stop):
+        out = np.empty((stop - start,) + self.shape[1:], dtype=self.dtype)
+        first = int(np.searchsorted(self.offsets, start, side='right')) - 1
+        last = int(np.searchsorted(self.offsets, stop, side='left'))
+        parts = []
+        for shard in range(max(first, 0), last):
+            base = int(self.offsets[shard])
+            lo, hi = max(start, base), min(stop, int(self.offsets[shard + 1]))
+            if lo < hi:
+                parts.append((shard, lo - base, hi - base, lo - start))
+        if self.num_workers != 1 and len(parts) > 1 and out.nbytes >= PARALLEL_READ_BYTES:
+            # every shard is decoded in a worker and copied straight to its global position
+            pool = _shard_read_pool(self.num_workers)
+            futures = [pool.submit(_read_hdf5_rows, self.sources[shard] + (lo, hi))
+                       for shard, lo, hi, _ in parts]
+            for (_, lo, hi, pos), future in zip(parts, futures):
+                out[pos:pos + hi - lo] = future.result()
+        else:
+            for shard, lo, hi, pos in parts:
+                self._shard(shard).read_direct(out, np.s_[lo:hi], np.s_[pos:pos + hi - lo])
+        return out
+
+    def _read_rows(self, index):
+        index = np.where(index < 0, index + len(self), index)
+        if index.size and (index.min() < 0 or index.max() >= len(self)):
+            raise IndexError(f"index out of bounds for axis 0 with size {len(self)}")
+        global_index = index + self.start
+        shards = np.searchsorted(self.offsets, global_index, side='right') - 1
+        out = np.empty(index.shape + self.shape[1:], dtype=self.dtype)
+        for shard in np.unique(shards):
+            mask = shards == shard
+            # h5py point selection needs strictly increasing rows
+            rows, inverse = np.unique(global_index[mask] - self.offsets[shard], return_inverse=True)
+            out[mask] = self._shard(shard)[rows][inverse]
+        return out
+
+
+class ShardedHDF5Dataset(object):
+    """Dict-like, lazily read view over every shard file of a directory-based HDF5 dataset."""
+    def __init__(self, file_paths, num_workers=1):
+        if not file_paths:
+            raise ValueError("No dataset shards were found.")
+        self.files = [h5py.File(file_path, 'r') for file_path in file_paths]
+        self.columns = {key: ShardedHDF5Column([f[key] for f in self.files], num_workers=num_workers)
+                        for key in self.files[0].keys()}
+
+    def __getitem__(self, key):
+        return self.columns[key]
+
+    def __contains__(self, key):
+        return key in self.columns
+
+    def keys(self):
+        return self.columns.keys()
+
+    def close(self):
+        for f in self.files:
+            f.close()
+
+
+class NextObservationView(object):
+    """`observations[i + 1]` as a view, with the rows `patch_rows` taken from `patch_values`."""
+    def __init__(self, observations, patch_rows, patch_values):
+        self.observations = observations
+        self.patch_rows = np.asarray(patch_rows, dtype=np.int64)
+        self.patch_values = patch_values
+        self.dtype = observations.dtype
+        self.shape = tuple(observations.shape)
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        array = self[:]
+        return array if dtype is None else array.astype(dtype, copy=False)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            index = np.arange(*index.indices(len(self)))
+        if np.ndim(index) == 0:
+            index = int(index)
+            if index < 0:
+                index += len(self)
+            if not 0 <= index < len(self):
+                raise IndexError(f"index {index} is out of bounds for axis 0 with size {len(self)}")
+            pos = int(np.searchsorted(self.patch_rows, index))
+            if pos < len(self.patch_rows) and self.patch_rows[pos] == index:
+                return self.patch_values[pos]
+            return self.observations[index + 1]
+        index = np.asarray(index, dtype=np.int64)
+        index = np.where(index < 0, index + len(self), index)
+        out = np.array(self.observations[np.minimum(index + 1, len(self) - 1)])
+        pos = np.minimum(np.searchsorted(self.patch_rows, index), max(len(self.patch_rows) - 1, 0))
+        if len(self.patch_rows):
+            patched = self.patch_rows[pos] == index
+            out[patched] = np.asarray(self.patch_values)[pos[patched]]
+        return out
+
+
+class EpisodeIndex(object):
+    """Episode boundaries as compact arrays."""
+    def __init__(self, starts, ends, episode_ids):
+        self.starts = starts
+        self.ends = ends
+        self.episode_ids = episode_ids
+
+    @classmethod
+    def from_ends(cls, num_steps, ends):
+        """Every episode but the last ends at one of `ends`, the last one at row num_steps - 1."""
+        ends = np.append(np.sort(np.asarray(ends, dtype=np.int64), kind='stable'), max(num_steps - 1, 0))
+        starts = np.concatenate(([0], ends[:-1] + 1))
+        lengths = np.maximum(ends - starts + 1, 0)
+        episode_ids = np.repeat(np.arange(len(starts), dtype=np.int32), lengths)[:num_steps]
+        return cls(starts, ends, episode_ids)
+
+    @classmethod
+    def from_terminals(cls, terminals, num_steps=None):
+        """An episode ends on every terminal row except the last row of the dataset."""
+        num_steps = len(terminals) if num_steps is None else num_steps
+        return cls.from_ends(num_steps, np.flatnonzero(np.asarray(terminals[:max(num_steps - 1, 0)], dtype=bool)))
+
+    @property
+    def lengths(self):
+        return self.ends - self.starts + 1
+
+    @property
+    def trj_idx_list(self):
+        """[start, end] pairs, the format Dataset.sample expects."""
+        return np.stack((self.starts, self.ends), axis=1)
+
+    def __len__(self):
+        return len(self.starts)
+
+
+class _Loader(object):
+    def __init__(self, fn):
+        self.fn = fn
+        # one load per column, even when projects sharing a registry entry ask at the same time
+        self.lock = threading.Lock()
+
+
+class LazyColumns(MutableMapping):
+    """Dataset columns loaded on first access by the function given to `set_loader`."""
+    def __init__(self, columns=None):
+        self._columns = {}
+        self.resources = []
+        if columns:
+            self.update(columns)
+
+    def set_loader(self, key, fn):
+        self._columns[key] = _Loader(fn)
+
+    def __getitem__(self, key):
+        value = self._columns[key]
+        if isinstance(value, _Loader):
+            with value.lock:
+                if self._columns[key] is value:
+                    self._columns[key] = value.fn()
+            value = self._columns[key]
+        return value
+
+    def __setitem__(self, key, value):
+        self._columns[key] = value
+
+    def __delitem__(self, key):
+        del self._columns[key]
+
+    def __iter__(self):
+        return iter(self._columns)
+
+    def __len__(self):
+        return len(self._columns)
+
+    def __repr__(self):
+        return "LazyColumns({})".format(", ".join(
+            key if self.is_loaded(key) else f"{key} (lazy)" for key in self._columns))
+
+    def is_loaded(self, key):
+        return not isinstance(self._columns[key], _Loader)
+
+    def loaded_items(self):
+        return [(key, value) for key, value in self._columns.items() if not isinstance(value, _Loader)]
+
+    def preload(self, keys):
+        for key in keys:
+            if key in self._columns:
+                self[key]
+
+    def close(self):
+        for resource in self.resources:
+            resource.close()
+
+
+class HDF5Columns(object):
+    """Reads whole HDF5 datasets by their 'group/name' path on demand."""
+    def __init__(self, file_path, squeeze_keys=()):
+        self.file_path = file_path
+        self.file = h5py.File(file_path, 'r')
+        self.squeeze_keys = squeeze_keys
+        self.column_keys = []
+        self.file.visititems(lambda name, obj: self.column_keys.append(name) if isinstance(obj, h5py.Dataset) else None)
+        self._lock = threading.Lock()
+
+    def _open(self):
+        with self._lock:
+            if not self.file:
+                self.file = h5py.File(self.file_path, 'r')
+            return self.file
+
+    def __getitem__(self, key):
+        value = self._open()[key][()]
+        if key in self.squeeze_keys and value.ndim == 2 and value.shape[1] == 1:
+            value = value[:, 0]
+        return value
+
+    def __contains__(self, key):
+        return key in self.column_keys
+
+    def keys(self):
+        return list(self.column_keys)
+
+    def shape(self, key):
+        return self._open()[key].shape
+
+    def close(self):
+        with self._lock:
+            self.file.close()
+
+
+UPLOAD_CHUNK_SIZE = 16 * 2 ** 20
+
+
+def save_upload(file, save_path, chunk_size=UPLOAD_CHUNK_SIZE):
+    """Copies a file-like upload to `save_path` in chunks and renames it into place when complete."""
+    os.makedirs(os.path.dirname(os.path.abspath(save_path)), exist_ok=True)
+    tmp_path = f"{save_path}.part"
+    file.seek(0)
+    with open(tmp_path, 'wb') as f:
+        shutil.copyfileobj(file, f, chunk_size)
+    os.replace(tmp_path, save_path)
+    return save_path
+
+
+# directories whose hdf5 files may be opened by path from the UI
+SERVER_DATASET_DIRS = [os.environ.get('D4RL_DATASET_DIR', os.path.expanduser('~/.d4rl/datasets')),
+                       os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')]
+
+
+def server_dataset_path(file_path, roots=None):
+    """Resolves `file_path`, links included, and raises a ValueError unless it lies under one of `roots`."""
+    roots = SERVER_DATASET_DIRS if roots is None else roots
+    resolved = os.path.realpath(file_path)
+    for root in roots:
+        root = os.path.realpath(root)
+        if os.path.commonpath([resolved, root]) == root:
+            return resolved
+    raise ValueError(f"{file_path} is not under one of the dataset directories {', '.join(roots)}.")
+
+
+def check_hdf5_schema(file_path):
+    """Checks from the file headers that a custom hdf5 dataset can be annotated, returns its timesteps."""
+    try:
+        f = h5py.File(file_path, 'r')
+    except OSError as e:
+        raise ValueError(f"{file_path} is not a readable hdf5 file ({e}).")
+    with f:
+        for key in ('observations', 'terminals'):
+            if not isinstance(f.get(key), h5py.Dataset):
+                raise ValueError(f"The dataset has no '{key}' array.")
+        observations, terminals = f['observations'], f['terminals']
+        if observations.ndim != 4 or observations.shape[1] not in (1, 3) or observations.dtype != np.uint8:
+            raise ValueError(f"observations must be uint8 frames of shape (N, C, H, W), got {observations.dtype} {observations.shape}.")
+        if terminals.ndim not in (1, 2) or (terminals.ndim == 2 and terminals.shape[1] != 1) or terminals.dtype.kind not in 'biuf':
+            raise ValueError(f"terminals must be a numeric array of shape (N,) or (N, 1), got {terminals.dtype} {terminals.shape}.")
+        if terminals.shape[0] != observations.shape[0]:
+            raise ValueError(f"observations has {observations.shape[0]} timesteps but terminals has {terminals.shape[0]}.")
+        return observations.shape[0]
+
+
+def iter_rows(column, start, stop, chunk_rows=64):
+    """Yields column[start:stop] row by row, reading `chunk_rows` contiguous rows at a time."""
+    for chunk_start in range(start, stop, chunk_rows):
+        yield from column[chunk_start:min(chunk_start + chunk_rows, stop)]
@@ -0,0 +1,188 @@
+import os
+import uuid
+import queue
+import threading
+import numpy as np
+
+from datasets.dataset_cache import DEFAULT_CACHE_DIR
+
+
+DEFAULT_FRAME_CACHE_DIR = os.path.join(DEFAULT_CACHE_DIR, "frames")
+DEFAULT_FRAME_CACHE_BUDGET = int(os.environ.get("FRAME_CACHE_BUDGET", 4 * 2 ** 30))
+# frames waiting for the writer thread, about 50 MB at 500x500
+PENDING_WRITES = 64
+
+
+class FrameCache(object):
+    def __init__(self, fingerprint, width, height, camera, max_bytes=DEFAULT_FRAME_CACHE_BUDGET, cache_dir=DEFAULT_FRAME_CACHE_DIR):
+        """Rendered frames on disk, keyed by (dataset fingerprint, timestep, width, height, camera).
+
+        Every frame is one .npy file under `cache_dir`; a hit refreshes its mtime and
+        `trim` deletes the least recently used files once the whole cache exceeds
+        `max_bytes`. Writes happen on a background thread, see `flush`, and are atomic
+        renames, so render workers in other processes can share the directory. The size
+        of the directory is scanned once and then tracked from the bytes written, so
+        `trim` only walks it again when over budget.
+
+        Args:
+            fingerprint (str): Fingerprint of the dataset files, see `source_fingerprint`.
+            width (int): The width of the frames.
+            height (int): The height of the frames.
+            camera (str): The camera, or whatever else changes how a timestep is drawn.
+            max_bytes (int): Size of the whole cache directory kept by `trim`. 0 disables the cache.
+            cache_dir (str): Root directory of the cache.
+        """
+        self.cache_dir = cache_dir
+        self.root = os.path.join(cache_dir, fingerprint, f"{width}x{height}_{camera}")
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # bytes written by this instance, and the directory size once scanned
+        self.written = 0
+        self._bytes = None
+        self._lock = threading.Lock()
+        self._pending = None
+
+    def __getstate__(self):
+        # the writer thread belongs to the process that started it
+        state = dict(self.__dict__)
+        state.update(_lock=None, _pending=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _path(self, timestep):
+        return os.path.join(self.root, f"{int(timestep)}.npy")
+
+    def get(self, timestep):
+        if not self.enabled:
+            return None
+        path = self._path(timestep)
+        try:
+            frame = np.load(path)
+            os.utime(path)
+        except (OSError, ValueError):
+            # missing, or evicted between the load and the touch
+            return None
+        return frame
+
+    def put(self, timestep, frame):
+        """Queues `frame` to be written by the writer thread; blocks while PENDING_WRITES frames wait."""
+        if not self.enabled:
+            return
+        if self._pending is None:
+            self._pending = queue.Queue(maxsize=PENDING_WRITES)
+            threading.Thread(target=self._write_pending, args=(self._pending,), daemon=True).start()
+        self._pending.put((timestep, np.array(frame)))
+
+    def flush(self):
+        """Waits until every queued frame is written."""
+        if self._pending is not None:
+            self._pending.join()
+
+    def _write_pending(self, pending):
+        while True:
+            timestep, frame = pending.get()
+            try:
+                os.makedirs(self.root, exist_ok=True)
+                tmp_path = f"{self._path(timestep)}.tmp-{uuid.uuid4().hex}.npy"
+                np.save(tmp_path, frame)
+                size = os.path.getsize(tmp_path)
+                os.replace(tmp_path, self._path(timestep))
+                self._add_bytes(size)
+            except OSError:
+                # not cached, the frame is rendered again next time
+                pass
+            finally:
+                pending.task_done()
+
+    def _add_bytes(self, size):
+        with self._lock:
+            self.written += size
+            if self._bytes is not None:
+                self._bytes += size
+
+    def frames(self, timesteps, render, out=None):
+        """Frames of `timesteps`, rendering only the ones that are not cached.
+
+        Args:
+            timesteps (sequence): Dataset indices of the frames.
+            render (callable): Takes the positions in `timesteps` of the missing frames
+                and returns (or yields) their frames, in that order.
+            out (np.ndarray): Written in place when given, e.g. a tile of a `video_canvas`.
+        Returns:
+            np.ndarray: The frames stacked along the first axis.
+        """
+        missing = []
+        for i, timestep in enumerate(timesteps):
+            frame = self.get(timestep)
+            if frame is None:
+                missing.append(i)
+                continue
+            if out is None:
+                out = np.empty((len(timesteps),) + frame.shape, dtype=frame.dtype)
+            out[i] = frame
+        self.hits += len(timesteps) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            for i, frame in zip(missing, render(missing)):
+                if out is None:
+                    out = np.empty((len(timesteps),) + frame.shape, dtype=frame.dtype)
+                out[i] = frame
+                self.put(timesteps[i], frame)
+        return out
+
+    def record(self, hits, misses, written=0):
+        """Adds the counts and bytes written of a copy of this cache, e.g. in a render worker."""
+        self.hits += hits
+        self.misses += misses
+        self._add_bytes(written)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
+
+    def _scan(self):
+        entries = []
+        for dirpath, _, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                if ".tmp-" in filename:
+                    # a frame another process is still writing
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, path))
+        with self._lock:
+            self._bytes = sum(size for _, size, _ in entries)
+        return entries
+
+    def trim(self):
+        """Deletes the least recently used frames of the whole cache once it exceeds `max_bytes`.
+
+        Cheap while under budget: the directory is only walked on the first call and
+        when the tracked size goes over `max_bytes`.
+        """
+        if not self.enabled:
+            return
+        self.flush()
+        if self._bytes is not None and self._bytes <= self.max_bytes:
+            return
+        entries = self._scan()
+        for _, size, path in sorted(entries):
+            if self._bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            with self._lock:
+                self._bytes -= size
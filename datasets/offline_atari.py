@@ -17,11 +17,18 @@ import pathlib
 sys.path.append(str(Path(__file__).parent.parent))
 from datasets.base import BaseOfflineDataset
 import datasets.dataset_utils as dataset_utils
+from datasets.dataset_registry import registry
 
 
 class Dataset(BaseOfflineDataset):
+	stage_columns = {
+		'get_episode_boundaries': ['terminals'],
+		'sample': [],
+		'visualize_query': ['observations'],
+	}
+
 	def __init__(self, project_id, domain, task, environment_name, mode, sampler_type, feedback_type,
-				query_num, query_length, fps, video_width, video_height, save_dir):
+				query_num, query_length, fps, video_width, video_height, save_dir, resize_in_encoder=True, sampler_config=None, encoder_config=None, frame_config=None):
 		"""AtariDataset
 
 		Args:
@@ -30,7 +37,7 @@ class Dataset(BaseOfflineDataset):
 			task (str): The task.
 			environment_name (str): The environment name.
 			mode (str): The mode. Choices are 'online' and 'offline'.
-			sampler_type (str): The sampler type. Choices are 'random', 'disagreement', 'schedule', and 'customization'.
+			sampler_type (str): The sampler type. Choices are 'random', 'disagreement', 'diversity', 'stratified', 'schedule', and 'customization'.
 			feedback_type (str): The feedback type. Choices are 'comparative', 'attribute', 'evaluative', 'visual', and 'keypoint'.
 			query_num (int): The number of queries.
 			query_length (int): The length of each query.
@@ -38,8 +45,12 @@ class Dataset(BaseOfflineDataset):
 			video_width (int): The width of the videos.
 			video_height (int): The height of the videos.                   
 			save_dir (str): The directory to save the videos.
+			resize_in_encoder (bool): Scale frames in the ffmpeg filter graph. False resizes every frame with cv2 before encoding.
+			sampler_config (dict): Options of the sampler, e.g. pool_size and batch_size of 'disagreement' and 'diversity'.
+			encoder_config (dict): The encoder profile of the videos and its overrides, see dataset_utils.encoder_profile.
+			frame_config (dict): Options of the images of 'visual' and 'keypoint' queries, see dataset_utils.FrameWriter.
 		"""
-		super().__init__()
+		super().__init__(sampler_config, encoder_config, frame_config)
 		self.project_id = project_id
 		self.domain = domain
 		self.task = task
@@ -53,12 +64,13 @@ class Dataset(BaseOfflineDataset):
 		self.width = video_width
 		self.height = video_height
 		self.save_dir = save_dir
+		self.resize_in_encoder = resize_in_encoder
 
 		if not os.path.exists(os.path.join(self.save_dir, self.project_id)):
 			os.makedirs(os.path.join(self.save_dir, self.project_id))
 
 		# split episode
-		self.trj_idx_list = []
+		self.episode_index = None
 
 		if self.feedback_type in ['comparative', 'attribute']:
 			self.sample_num = 2
@@ -93,78 +105,48 @@ class Dataset(BaseOfflineDataset):
 		'yars-revenge', 'zaxxon']
 
 		self.gym_env = gym.make(self.environment_name)
-		self.datasets = self.gym_env.get_dataset()
-
+		# the epochs d4rl_atari downloads for this env, fingerprinted to key the registry
+		env = self.gym_env.unwrapped
+		if hasattr(env, 'game') and hasattr(env, 'index'):
+			dataset_dir = os.environ.get('D4RL_DATASET_DIR', os.path.expanduser('~/.d4rl/datasets'))
+			self.source_paths = [os.path.join(dataset_dir, env.game, str(env.index))]
 		try:
 			self.max_episode_steps = self.gym_env._max_episode_steps
 		except:
 			self.max_episode_steps = None
+		self.datasets, self.episode_index = registry.get(self.registry_key(), self._convert_offline_dataset)
 		print("Finished, loaded {} timesteps. Max episode steps {}".format(int(self.datasets["rewards"].shape[0]), self.max_episode_steps))
 		print("Datasets keys: ", self.datasets.keys())
 
+	def _convert_offline_dataset(self):
+		self.datasets = self.gym_env.get_dataset()
+		self.get_episode_boundaries()
+		return self.datasets, self.episode_index
+
 	def get_episode_boundaries(self):
-		trj_idx_list = []
-		N = self.datasets['rewards'].shape[0]
-		
-		episode_step = 0
-		start_idx, data_idx = 0, 0
-		trj_idx_list = []
-		for i in range(N - 1):
-			done_bool = bool(self.datasets['terminals'][i])
-			if done_bool:
-				episode_step = 0
-				trj_idx_list.append([start_idx, data_idx])
-				start_idx = data_idx + 1
-			episode_step += 1
-			data_idx += 1
-		
-		trj_idx_list.append([start_idx, data_idx])
-		print(len(trj_idx_list))
-		return trj_idx_list
-	
-	def sample(self, trj_idx_list):
+		if self.episode_index is None:
+			N = self.datasets['rewards'].shape[0]
+			self.episode_index = dataset_utils.EpisodeIndex.from_terminals(self.datasets['terminals'], N)
+		print(len(self.episode_index))
+		return self.episode_index.trj_idx_list
+
+	def sample(self, trj_idx_list, segment_indices=None):
 		'''
-			sample query_num*query_length sequences
+		sample query_num*query_length sequences, or wrap the (start_indices, end_indices) of one batch
 		'''
-		trj_idx_list = np.array(trj_idx_list)
-		trj_len_list = trj_idx_list[:, 1] - trj_idx_list[:, 0] + 1  # len(trj_len_list) = dataset episode num
-		# print(trj_len_list)
-		
-		assert max(trj_len_list) > self.query_length
-		total_sample_num = self.query_num * self.sample_num
-		start_indices, end_indices = np.zeros(total_sample_num), np.zeros(total_sample_num)
-		
-		for query_count in range(total_sample_num):
-			temp_count = 0
-			while temp_count < 1:
-				trj_idx = np.random.choice(np.arange(len(trj_idx_list) - 1))
-				len_trj = trj_len_list[trj_idx]
-				
-				if len_trj > self.query_length:
-					if not self.over_sample:
-						time_idx = np.random.choice(len_trj - self.query_length + 1)
-					else:
-						time_idx = np.random.choice(len_trj + 1)
-						if time_idx > len_trj - self.query_length:
-							time_idx = len_trj - self.query_length
-					start_idx = trj_idx_list[trj_idx][0] + time_idx
-					end_idx = start_idx + self.query_length
-					
-					assert end_idx <= trj_idx_list[trj_idx][1] + 1
-					
-					if temp_count == 0:
-						start_indices[query_count] = start_idx
-						end_indices[query_count] = end_idx
-					
-					temp_count += 1
-		
-		print(f"Sample query indices {self.query_num} x {self.sample_num} successfully.")
+		if segment_indices is None:
+			total_sample_num = self.query_num * self.sample_num
+			segment_indices = self.sample_segment_indices(trj_idx_list, total_sample_num)
+		start_indices, end_indices = segment_indices
+		query_num = len(start_indices) // self.sample_num
+
+		print(f"Sample query indices {query_num} x {self.sample_num} successfully.")
 
 		if self.sample_num == 2:
-			start_indices_1 = np.array(start_indices[:self.query_num], dtype=np.int32)
-			start_indices_2 = np.array(start_indices[self.query_num:], dtype=np.int32)
-			end_indices_1 = np.array(end_indices[:self.query_num], dtype=np.int32)
-			end_indices_2 = np.array(end_indices[self.query_num:], dtype=np.int32)
+			start_indices_1 = np.array(start_indices[:query_num], dtype=np.int32)
+			start_indices_2 = np.array(start_indices[query_num:], dtype=np.int32)
+			end_indices_1 = np.array(end_indices[:query_num], dtype=np.int32)
+			end_indices_2 = np.array(end_indices[query_num:], dtype=np.int32)
 			return {"start_indices_1": start_indices_1,
 					"end_indices_1": end_indices_1,
 					"start_indices_2": start_indices_2,
@@ -177,71 +159,23 @@ class Dataset(BaseOfflineDataset):
 					"end_indices": end_indices,
 					"query_id": [str(uuid.uuid4().hex) for _ in range(len(start_indices))]}
 
+	def read_frames(self, start, stop):
+		frames = np.asarray(self.datasets["observations"][start:stop])
+		# single channel observations are encoded as gray frames
+		return frames.reshape(len(frames), *np.squeeze(frames[0]).shape)
+
 	def visualize_query(self, video_info):
 		video_url_list = []
-		for seg_idx in trange(self.query_num):
-			frames = []
-			frames_2 = []
-			if self.feedback_type in ['comparative', 'attribute']:			
-				start_1, start_2, end_1, end_2, query_id = (
-					video_info["start_indices_1"][seg_idx],
-					video_info["start_indices_2"][seg_idx],
-					video_info["end_indices_1"][seg_idx],
-					video_info["end_indices_2"][seg_idx],
-					video_info["query_id"][seg_idx],
-				)
-				start_indices = range(start_1, end_1)
-				start_indices_2 = range(start_2, end_2)
-			elif self.feedback_type in ['evaluative', 'visual', 'keypoint']:
-				start, end, query_id = (
-					video_info["start_indices"][seg_idx],
-					video_info["end_indices"][seg_idx],
-					video_info["query_id"][seg_idx],
-				)
-				start_indices = range(start, end)
-			else:
-				raise ValueError("The dataset does not support this feedback type.")
-
-			for t in trange(self.query_length, leave=False):
-				obs = self.datasets["observations"][start_indices[t]]
-				frame = cv2.resize(np.squeeze(obs), dsize=(self.width, self.height), interpolation=cv2.INTER_CUBIC)
-				frames.append(frame)
-	
-			if self.feedback_type in ['comparative', 'attribute']:	
-				for t in trange(self.query_length, leave=False):
-					obs_2 = self.datasets["observations"][start_indices_2[t]]
-					frame = cv2.resize(np.squeeze(obs_2), dsize=(self.width, self.height), interpolation=cv2.INTER_CUBIC)
-					frames_2.append(frame)
-			
-			if self.feedback_type in ['comparative', 'attribute']:	
-				video = np.concatenate((np.array(frames), np.array(frames_2)), axis=2)
-			else:
-				video = np.array(frames)
-
-			imageio.mimsave(os.path.join(self.save_dir, self.project_id, f"{self.gym_env.spec.id}_{query_id}.mp4"), video, fps=self.fps)
-			video_url = os.path.join(self.save_dir, self.project_id, f"{self.gym_env.spec.id}_{query_id}.mp4")
-			video_url_list.append(video_url)
-
-			if self.feedback_type in ['visual', 'keypoint']:
-				dataset_utils.video_to_frames(video_url, os.path.join(self.save_dir, self.project_id, f"{self.gym_env.spec.id}_{query_id}_img"))
+		for seg_idx in trange(len(video_info["query_id"])):
+			query_id = video_info["query_id"][seg_idx]
+			video_name = os.path.join(self.save_dir, self.project_id, f"{self.gym_env.spec.id}_{query_id}")
+			frames_dir = f"{video_name}_img" if self.feedback_type in ['visual', 'keypoint'] else None
+			self.write_query_video(f"{video_name}.mp4", self.query_segments(video_info, seg_idx), frames_dir)
+			video_url_list.append(f"{video_name}.mp4")
 	
+		self.report_render_stats()
 		return video_url_list
 
-	def generate_video_resources(self):
-		# 1: load offline dataset
-		self.load_offline_dataset()
-		# 2: get episode boundaries
-		trj_idx_list = self.get_episode_boundaries()
-		# 3: get sample indices
-		indices_info = self.sample(trj_idx_list)
-		query_id_list = indices_info['query_id']
-		# 4: visualize query
-		video_url_list = self.visualize_query(indices_info)
-		# 5: get video info
-		video_info_list = dataset_utils.reformat_video_info(indices_info)
-
-		return video_info_list, video_url_list, query_id_list
-
 
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser()
@@ -251,7 +185,7 @@ if __name__ == '__main__':
 	parser.add_argument('--task', type=str, default='alien')
 	parser.add_argument('--environment_name', type=str, default='alien-medium-v0')
 	parser.add_argument('--mode', type=str, default='offline', choices=['online', 'offline'])
-	parser.add_argument('--sampler_type', type=str, default='random', choices=['random', 'disagreement', 'schedule', 'customization'])
+	parser.add_argument('--sampler_type', type=str, default='random', choices=['random', 'disagreement', 'diversity', 'stratified', 'schedule', 'customization'])
 	parser.add_argument('--feedback_type', type=str, default='visual', choices=['comparative', 'attribute', 'evaluative', 'visual', 'keypoint'])
 	parser.add_argument('--query_num', type=int, default=2, help='number of query.')
 	parser.add_argument('--query_length', type=int, default=200, help='length of each query.')
@@ -260,12 +194,25 @@ if __name__ == '__main__':
 	parser.add_argument('--video_height', type=int, default=500, help='height of videos.')
 
 	parser.add_argument('--save_dir', type=str, default=f'video/', help='save dir')
+	parser.add_argument('--pool_size', type=int, default=1000, help='candidates scored by the disagreement and diversity samplers.')
+	parser.add_argument('--score_batch_size', type=int, default=4096, help='steps per batch of the disagreement and diversity samplers.')
+	parser.add_argument('--max_overlap', type=float, default=0.5, help='largest overlap with an issued segment, as a fraction of its length.')
+	parser.add_argument('--schedule', type=str, default='position', choices=['position', 'return'], help='curriculum of the schedule sampler.')
+	parser.add_argument('--queries_per_batch', type=int, default=8, help='queries the schedule sampler yields per batch.')
+	parser.add_argument('--python_resize', action='store_true', help='resize frames with cv2 instead of in the ffmpeg filter graph.')
+	parser.add_argument('--encoder_profile', type=str, default='default', choices=sorted(dataset_utils.ENCODER_PROFILES), help='codec settings of the videos.')
+	parser.add_argument('--image_format', type=str, default='jpg', choices=sorted(dataset_utils.IMAGE_FORMATS), help="images of the 'visual' and 'keypoint' queries.")
+	parser.add_argument('--image_quality', type=int, default=None, help='jpg/webp quality or png compression of the images.')
+	parser.add_argument('--frame_stride', type=int, default=1, help='write every n-th frame as an image.')
 	cfg = parser.parse_args()
 	
 	dataset = Dataset(project_id=cfg.project_id, domain=cfg.domain, task=cfg.task, environment_name=cfg.environment_name, mode=cfg.mode,
 					sampler_type=cfg.sampler_type, feedback_type=cfg.feedback_type, query_num=cfg.query_num,
 					query_length=cfg.query_length, fps=cfg.fps, video_width=cfg.video_width, video_height=cfg.video_height,
-					save_dir=cfg.save_dir)
+					save_dir=cfg.save_dir, resize_in_encoder=not cfg.python_resize, sampler_config={'pool_size': cfg.pool_size, 'batch_size': cfg.score_batch_size, 'max_overlap': cfg.max_overlap,
+								'schedule': cfg.schedule, 'queries_per_batch': cfg.queries_per_batch},
+					encoder_config={'profile': cfg.encoder_profile},
+					frame_config={'image_format': cfg.image_format, 'quality': cfg.image_quality, 'stride': cfg.frame_stride})
 	
 	video_info_list, video_url_list, query_id_list = dataset.generate_video_resources()
 	print(video_info_list, video_url_list, query_id_list)
@@ -1,13 +1,15 @@
 # -*- coding: UTF-8 -*-
 import os
 import sys
+import copy
 import pickle
 import uuid
 import shortuuid
 import argparse
-from tqdm import tqdm, trange
+from tqdm import tqdm
 import gym
 import d4rl
+from d4rl.offline_env import download_dataset_from_url
 import numpy as np
 import imageio
 import cv2
@@ -16,11 +18,19 @@ from pathlib import Path
 sys.path.append(str(Path(__file__).parent.parent))
 from datasets.base import BaseOfflineDataset
 import datasets.dataset_utils as dataset_utils
+from datasets.dataset_cache import DatasetCache
+from datasets.dataset_registry import registry
 
 
 class Dataset(BaseOfflineDataset):
+	stage_columns = {
+		'get_episode_boundaries': ['terminals', 'goals'],
+		'sample': [],
+		'visualize_query': ['qposes', 'qvels', 'goals'],
+	}
+
 	def __init__(self, project_id, domain, task, environment_name, mode, sampler_type, feedback_type,
-				query_num, query_length, fps, video_width, video_height, save_dir):
+				query_num, query_length, fps, video_width, video_height, save_dir, num_workers=None, sampler_config=None, encoder_config=None, frame_config=None):
 		"""D4RLDataset
 
 		Args:
@@ -29,7 +39,7 @@ class Dataset(BaseOfflineDataset):
 			task (str): The task.
 			environment_name (str): The environment name.
 			mode (str): The mode. Choices are 'online' and 'offline'.
-			sampler_type (str): The sampler type. Choices are 'random', 'disagreement', 'schedule', and 'customization'.
+			sampler_type (str): The sampler type. Choices are 'random', 'disagreement', 'diversity', 'stratified', 'schedule', and 'customization'.
 			feedback_type (str): The feedback type. Choices are 'comparative', 'attribute', 'evaluative', 'visual', and 'keypoint'.
 			query_num (int): The number of queries.
 			query_length (int): The length of each query.
@@ -37,8 +47,13 @@ class Dataset(BaseOfflineDataset):
 			video_width (int): The width of the videos.
 			video_height (int): The height of the videos.                   
 			save_dir (str): The directory to save the videos.
+			num_workers (int): Worker processes rendering queries, each with its own env. Defaults to the cpu count,
+				at most query_num.
+			sampler_config (dict): Options of the sampler, e.g. pool_size and batch_size of 'disagreement' and 'diversity'.
+			encoder_config (dict): The encoder profile of the videos and its overrides, see dataset_utils.encoder_profile.
+			frame_config (dict): Options of the images of 'visual' and 'keypoint' queries, see dataset_utils.FrameWriter.
 		"""
-		super().__init__()
+		super().__init__(sampler_config, encoder_config, frame_config)
 		self.project_id = project_id
 		self.domain = domain
 		self.task = task
@@ -52,12 +67,16 @@ class Dataset(BaseOfflineDataset):
 		self.width = video_width
 		self.height = video_height
 		self.save_dir = save_dir
+		# no more render processes than queries
+		self.num_workers = max(1, min(os.cpu_count() if num_workers is None else num_workers, query_num))
+		# render workers kept for a whole generate_video_resources, the 'schedule' sampler renders several batches
+		self.render_pool = None
 
 		if not os.path.exists(os.path.join(self.save_dir, self.project_id)):
 			os.makedirs(os.path.join(self.save_dir, self.project_id))
 
 		# split episode
-		self.trj_idx_list = []
+		self.episode_index = None
 
 		if self.feedback_type in ['comparative', 'attribute']:
 			self.sample_num = 2
@@ -79,6 +98,7 @@ class Dataset(BaseOfflineDataset):
 			self.width, self.height = video_size["large"]
 		elif "umaze" in self.environment_name:
 			self.width, self.height = video_size["large"]
+		# adroit episodes are short (pen has 100 steps), segments must fit inside one
 		if self.task == "adroit":
 			if "pen" in self.environment_name:
 				self.query_length = min(self.query_length, 80)
@@ -88,104 +108,83 @@ class Dataset(BaseOfflineDataset):
 	def load_offline_dataset(self):
 		assert self.task in ['mujoco', 'adroit', 'antmaze']
 		self.gym_env = gym.make(self.environment_name)
+		# downloaded before the registry key is taken, a missing file has no fingerprint
+		self.source_paths = [download_dataset_from_url(self.gym_env.dataset_url)]
+		try:
+			self.max_episode_steps = self.gym_env._max_episode_steps
+		except:
+			self.max_episode_steps = None
+		self.datasets, self.episode_index = registry.get(self.registry_key(), self._convert_offline_dataset)
+		self.datasets.preload(self.required_columns())
+		print("Finished, loaded {} timesteps. Max episode steps {}".format(int(self.datasets["terminals"].shape[0]), self.max_episode_steps))
+		print("Datasets keys: ", self.datasets.keys())
+
+	def _convert_offline_dataset(self):
+		# read the raw hdf5 file column by column, env.get_dataset() would load every key
+		raw_dataset = dataset_utils.HDF5Columns(self.source_paths[0],
+												squeeze_keys=('rewards', 'terminals', 'timeouts'))
 		if self.task == 'mujoco':
-			self.datasets = qlearning_mujoco_dataset(self.gym_env)
+			self.datasets = qlearning_mujoco_dataset(self.gym_env, dataset=raw_dataset)
 		elif self.task == 'adroit':
-			self.datasets = qlearning_adroit_dataset(self.gym_env)
+			self.datasets = qlearning_adroit_dataset(self.gym_env, dataset=raw_dataset)
 		elif self.task == 'antmaze':
-			self.datasets = qlearning_ant_dataset(self.gym_env)
+			self.datasets = qlearning_ant_dataset(self.gym_env, dataset=raw_dataset)
 		else:
 			raise ValueError(f"{self.task} undefined")
+		# the hdf5 handle stays open for the lazy columns until the registry evicts them
+		self.datasets.resources.append(raw_dataset)
 
-		try:
-			self.max_episode_steps = self.gym_env._max_episode_steps
-		except:
-			self.max_episode_steps = None
-		print("Finished, loaded {} timesteps. Max episode steps {}".format(int(self.datasets["rewards"].shape[0]), self.max_episode_steps))
-		print("Datasets keys: ", self.datasets.keys())
+		dataset_cache = DatasetCache(self.domain, self.task, self.environment_name, self.source_paths)
+		cached = dataset_cache.load()
+		if cached is not None:
+			cached_columns, self.episode_index = cached
+			self.datasets.update(cached_columns)
+		self.datasets.preload(self.required_columns())
+		if cached is None:
+			self.get_episode_boundaries()
+			dataset_cache.save(self.datasets, self.episode_index)
+		return self.datasets, self.episode_index
 
 	def get_episode_boundaries(self):
-		trj_idx_list = []
-		N = self.datasets['rewards'].shape[0]
-		
-		# The newer version of the dataset adds an explicit
-		# timeouts field. Keep old method for backwards compatability.
-		use_timeouts = False
-		if 'timeouts' in self.datasets:
-			use_timeouts = True
-		
-		episode_step = 0
-		start_idx, data_idx = 0, 0
-
-		for i in range(N - 1):
+		if self.episode_index is None:
+			N = self.datasets['terminals'].shape[0]
 			if 'maze' in self.environment_name:
-				done_bool = sum(self.datasets['goals'][i + 1] - self.datasets['goals'][i]) > 0
+				goals = self.datasets['goals']
+				done_bool = (goals[1:N] - goals[:N - 1]).sum(axis=1) > 0
 			else:
-				done_bool = bool(self.datasets['terminals'][i])
-			if use_timeouts:
-				final_timestep = self.datasets['timeouts'][i]
+				done_bool = np.asarray(self.datasets['terminals'][:N - 1], dtype=bool)
+
+			# The newer version of the dataset adds an explicit
+			# timeouts field. Keep old method for backwards compatability.
+			if 'timeouts' in self.datasets:
+				final_timestep = np.asarray(self.datasets['timeouts'][:N - 1], dtype=bool)
 			else:
-				final_timestep = (episode_step == self.max_episode_steps - 1)
-			if final_timestep:
-				# Skip this transition and don't apply terminals on the last step of an episode
-				episode_step = 0
-				trj_idx_list.append([start_idx, data_idx - 1])
-				start_idx = data_idx
-			if done_bool:
-				episode_step = 0
-				trj_idx_list.append([start_idx, data_idx])
-				start_idx = data_idx + 1
-			
-			episode_step += 1
-			data_idx += 1
-		
-		trj_idx_list.append([start_idx, data_idx])
-		# print(trj_idx_list)
-		return trj_idx_list
+				# the step counter restarts at 1 after every done or final timestep
+				episode_step = _ramp_with_wrap(done_bool, np.ones(N - 1, dtype=np.int64), self.max_episode_steps - 1, 1)
+				final_timestep = episode_step == self.max_episode_steps - 1
+
+			# a final timestep closes the episode before it, a done closes the episode at it
+			ends = np.concatenate((np.flatnonzero(final_timestep) - 1, np.flatnonzero(done_bool)))
+			self.episode_index = dataset_utils.EpisodeIndex.from_ends(N, ends)
+		return self.episode_index.trj_idx_list
 
-	def sample(self, trj_idx_list):
+	def sample(self, trj_idx_list, segment_indices=None):
 		'''
-			sample query_num*query_length sequences
+		sample query_num*query_length sequences, or wrap the (start_indices, end_indices) of one batch
 		'''
-		trj_idx_list = np.array(trj_idx_list)
-		trj_len_list = trj_idx_list[:, 1] - trj_idx_list[:, 0] + 1  # len(trj_len_list) = dataset episode num
-		# print(trj_len_list)
-		
-		assert max(trj_len_list) > self.query_length
-		total_sample_num = self.query_num * self.sample_num
-		start_indices, end_indices = np.zeros(total_sample_num), np.zeros(total_sample_num)
-		
-		for query_count in range(total_sample_num):
-			temp_count = 0
-			while temp_count < 1:
-				trj_idx = np.random.choice(np.arange(len(trj_idx_list) - 1))
-				len_trj = trj_len_list[trj_idx]
-				
-				if len_trj > self.query_length:
-					if not self.over_sample:
-						time_idx = np.random.choice(len_trj - self.query_length + 1)
-					else:
-						time_idx = np.random.choice(len_trj + 1)
-						if time_idx > len_trj - self.query_length:
-							time_idx = len_trj - self.query_length
-					start_idx = trj_idx_list[trj_idx][0] + time_idx
-					end_idx = start_idx + self.query_length
-					
-					assert end_idx <= trj_idx_list[trj_idx][1] + 1
-					
-					if temp_count == 0:
-						start_indices[query_count] = start_idx
-						end_indices[query_count] = end_idx
-					
-					temp_count += 1
-		
-		print(f"Sample query indices {self.query_num} x {self.sample_num} successfully.")
+		if segment_indices is None:
+			total_sample_num = self.query_num * self.sample_num
+			segment_indices = self.sample_segment_indices(trj_idx_list, total_sample_num)
+		start_indices, end_indices = segment_indices
+		query_num = len(start_indices) // self.sample_num
+
+		print(f"Sample query indices {query_num} x {self.sample_num} successfully.")
 
 		if self.sample_num == 2:
-			start_indices_1 = np.array(start_indices[:self.query_num], dtype=np.int32)
-			start_indices_2 = np.array(start_indices[self.query_num:], dtype=np.int32)
-			end_indices_1 = np.array(end_indices[:self.query_num], dtype=np.int32)
-			end_indices_2 = np.array(end_indices[self.query_num:], dtype=np.int32)
+			start_indices_1 = np.array(start_indices[:query_num], dtype=np.int32)
+			start_indices_2 = np.array(start_indices[query_num:], dtype=np.int32)
+			end_indices_1 = np.array(end_indices[:query_num], dtype=np.int32)
+			end_indices_2 = np.array(end_indices[query_num:], dtype=np.int32)
 			return {"start_indices_1": start_indices_1,
 					"end_indices_1": end_indices_1,
 					"start_indices_2": start_indices_2,
@@ -201,131 +200,180 @@ class Dataset(BaseOfflineDataset):
 	def visualize_query(self, video_info):
 		# mujoco/adroit/antmaze
 		assert self.task in ["mujoco", "adroit", "antmaze"]
-		
-		video_url_list = []
-		for seg_idx in trange(self.query_num):
-			if self.feedback_type in ['comparative', 'attribute']:			
-				start_1, start_2, end_1, end_2, query_id = (
-					video_info["start_indices_1"][seg_idx],
-					video_info["start_indices_2"][seg_idx],
-					video_info["end_indices_1"][seg_idx],
-					video_info["end_indices_2"][seg_idx],
-					video_info["query_id"][seg_idx],
-				)
-				start_indices = range(start_1, end_1)
-				start_indices_2 = range(start_2, end_2)
-			elif self.feedback_type in ['evaluative', 'visual', 'keypoint']:
-				start, end, query_id = (
-					video_info["start_indices"][seg_idx],
-					video_info["end_indices"][seg_idx],
-					video_info["query_id"][seg_idx],
-				)
-				start_indices = range(start, end)
-			else:
-				raise ValueError("The dataset does not support this feedback type.")
-
-			# camera
-			if self.task == "mujoco":
-				camera_name = "track"
-			elif self.task == "antmaze":
-				if "medium" in self.gym_env.spec.id:
-					dist_per_pixel = 15
-					start_x = 95
-					start_y = 95
-					camera_name = "birdview"
-				else:
-					dist_per_pixel = 11
-					start_x = 80
-					start_y = 110
-					camera_name = "birdview_large"
-			elif self.task == "adroit":
-				camera_name = "fixed"
-			
-			frames = []
-			self.gym_env.reset()
-			for t in trange(self.query_length, leave=False):
-				self.gym_env.set_state(self.datasets["qposes"][start_indices[t]], self.datasets["qvels"][start_indices[t]])
-				
-				if self.task == "antmaze":
-					if "diverse" in self.gym_env.spec.id:
-						goal_x, goal_y = map(lambda x: round(x), self.datasets["goals"][start_indices[t]])
-					else:
-						goal_x, goal_y = map(lambda x: round(x), self.gym_env.target_goal)
-					curr_frame = self.gym_env.physics.render(width=self.width, height=self.height, mode="offscreen",
-														camera_name=camera_name)
-					curr_frame[
-					start_y + int(goal_y * dist_per_pixel): start_y + int(goal_y * dist_per_pixel) + 10,
-					start_x + int(goal_x * dist_per_pixel): start_x + int(goal_x * dist_per_pixel) + 10,
-					] = np.array((255, 0, 0)).astype(np.uint8)
-					
-					for i in range(1):
-						frames.append(curr_frame)
-				elif self.task == "mujoco" or self.task == "adroit":
-					curr_frame = self.gym_env.sim.render(width=self.width, height=self.height, mode="offscreen", camera_name=camera_name)
-					frames.append(np.flipud(curr_frame))
-				else:
-					raise ValueError(f"{self.task} undefined")
-
-			if self.feedback_type in ['comparative', 'attribute']:	
-				frames_2 = []
-				self.gym_env.reset()
-				for t in trange(self.query_length, leave=False):
-					self.gym_env.set_state(
-						self.datasets["qposes"][start_indices_2[t]],
-						self.datasets["qvels"][start_indices_2[t]],
-					)
-					if self.task == "antmaze":
-						if "diverse" in self.gym_env.spec.id:
-							goal_x, goal_y = map(lambda x: round(x), self.datasets["goals"][start_indices_2[t]])
-						else:
-							goal_x, goal_y = map(lambda x: round(x), self.gym_env.target_goal)
-						
-						curr_frame = self.gym_env.physics.render(width=self.width, height=self.height, mode="offscreen",
-															camera_name=camera_name)
-						curr_frame[
-						start_y + int(goal_y * dist_per_pixel): start_y + int(goal_y * dist_per_pixel) + 10,
-						start_x + int(goal_x * dist_per_pixel): start_x + int(goal_x * dist_per_pixel) + 10,
-						] = np.array([255, 0, 0]).astype(np.uint8)
-						
-						for i in range(1):
-							frames_2.append(curr_frame)
-					elif self.task == "mujoco" or "adroit":
-						curr_frame = self.gym_env.sim.render(width=self.width, height=self.height, mode="offscreen", camera_name=camera_name)
-						frames_2.append(np.flipud(curr_frame))
-					else:
-						raise ValueError(f"{domain} undefined")
-			
-			if self.feedback_type in ['comparative', 'attribute']:	
-				video = np.concatenate((np.array(frames), np.array(frames_2)), axis=2)
-			else:
-				video = np.array(frames)
-	
-			writer = imageio.get_writer(os.path.join(self.save_dir, self.project_id, f"{self.gym_env.spec.id}_{query_id}.mp4"), fps=self.fps)
-			for frame in tqdm(video, leave=False):
-				writer.append_data(frame)
-			writer.close()
-			video_url = os.path.join(self.save_dir, self.project_id, f"{self.gym_env.spec.id}_{query_id}.mp4")
-			video_url_list.append(video_url)
-
-			if self.feedback_type in ['visual', 'keypoint']:
-				dataset_utils.video_to_frames(video_url, os.path.join(self.save_dir, self.project_id, f"{self.gym_env.spec.id}_{query_id}_img"))
-	
+
+		# one render request per query: the state slices of its segments and its video path
+		requests = []
+		for seg_idx in range(len(video_info["query_id"])):
+			segments = [(indices.start, indices.stop) for indices in self.query_segments(video_info, seg_idx)]
+			video_name = os.path.join(self.save_dir, self.project_id, f"{self.gym_env.spec.id}_{video_info['query_id'][seg_idx]}")
+			requests.append({
+				"segments": segments,
+				"qposes": [self.datasets["qposes"][start:end] for start, end in segments],
+				"qvels": [self.datasets["qvels"][start:end] for start, end in segments],
+				"goals": [self.datasets["goals"][start:end] if "goals" in self.datasets else None for start, end in segments],
+				"video_url": f"{video_name}.mp4",
+				"frames_dir": f"{video_name}_img" if self.feedback_type in ['visual', 'keypoint'] else None,
+				"frame_config": self.frame_config,
+			})
+
+		frame_cache = self.frame_cache(camera_name(self.task, self.gym_env.spec.id))
+		if self.render_pool is None:
+			self.render_pool = render_pool(self.environment_name, self.num_workers, frame_cache)
+		video_url_list = list(tqdm(render_queries(self.environment_name, self.task, requests, self.width, self.height, self.fps,
+												  self.num_workers, frame_cache=frame_cache, pipeline_stats=self.pipeline_stats,
+												  encoder=self.encoder, pool=self.render_pool), total=len(requests)))
+		self.report_render_stats()
 		return video_url_list
 
 	def generate_video_resources(self):
-		# 1: load offline dataset
-		self.load_offline_dataset()
-		# 2: get episode boundaries
-		trj_idx_list = self.get_episode_boundaries()
-		# 3: get sample indices
-		indices_info = self.sample(trj_idx_list)
-		query_id_list = indices_info['query_id']
-		# 4: visualize query
-		video_url_list = self.visualize_query(indices_info)
-		# 5: get video info
-		video_info_list = dataset_utils.reformat_video_info(indices_info)
+		try:
+			return super().generate_video_resources()
+		finally:
+			if self.render_pool is not None:
+				self.render_pool.shutdown()
+				self.render_pool = None
+
+
+# the env and frame cache of a render worker, set up once by _init_render_worker
+_render_env = None
+_render_frame_cache = None
 
-		return video_info_list, video_url_list, query_id_list
+
+def _init_render_worker(environment_name, frame_cache):
+	global _render_env, _render_frame_cache
+	_render_env = gym.make(environment_name)
+	# a copy, so that without a pool the caller's counts are not bumped twice
+	_render_frame_cache = None if frame_cache is None else copy.copy(frame_cache)
+
+
+def render_pool(environment_name, num_workers, frame_cache=None):
+	"""`num_workers` render processes, each with its env and a copy of `frame_cache`, to pass to several render_queries calls."""
+	return dataset_utils.worker_pool(num_workers, initializer=_init_render_worker, initargs=(environment_name, frame_cache))
+
+
+def render_queries(environment_name, task, requests, width, height, fps, num_workers=1, frame_cache=None, pipeline_stats=None, encoder=None,
+				   pool=None):
+	"""Renders and encodes the video of every query request, yielding the video paths in request order.
+
+	Each of the `num_workers` processes builds its own env once and then renders
+	whole queries: it replays the qpos/qvel slices of every segment of a request,
+	chunk by chunk, into its tile of the ring buffer of `dataset_utils.stream_video`
+	(side by side for pairs) while an encoder thread pipes the filled chunks to
+	ffmpeg and, for the 'visual' and 'keypoint' feedback, writes the frames of
+	every chunk as images with a `dataset_utils.FrameWriter`. The ffmpeg and image
+	threads of a worker are capped to its share of the cpus. Only state slices and
+	paths cross process boundaries and memory does not depend on the segment length.
+	Timesteps found in `frame_cache` are not rendered again.
+
+	Args:
+		environment_name (str): The gym id of the env, built by every worker.
+		task (str): 'mujoco', 'adroit' or 'antmaze'.
+		requests (list): Dicts with 'segments' ((start, end) dataset indices), 'qposes', 'qvels'
+			and 'goals' lists (one slice per segment), 'video_url', 'frames_dir' (None to
+			skip the images) and optionally 'frame_config', the FrameWriter options.
+		width (int): The width of the frames.
+		height (int): The height of the frames.
+		fps (int): The frames per second of the videos.
+		num_workers (int): Render processes. Defaults to the cpu count.
+		frame_cache (FrameCache): Cache of the rendered frames, its hit and miss counts include every worker.
+		pipeline_stats (dataset_utils.PipelineStats): Accumulates the render and encode times of every worker.
+		encoder (dict): The `dataset_utils.encoder_profile` of the videos, None for the default one.
+		pool: A `render_pool` of `num_workers` processes for `environment_name` and `frame_cache`,
+			None starts one for this call.
+	"""
+	num_workers = os.cpu_count() if num_workers is None else num_workers
+	if pool is None:
+		num_workers = max(1, min(num_workers, len(requests)))
+	# ffmpeg and the image writers of all workers share the cpus instead of each taking all of them
+	threads = dataset_utils.worker_threads(num_workers)
+	encoder = dataset_utils.encoder_profile() if encoder is None else encoder
+	if num_workers > 1 and encoder['threads'] is None:
+		encoder = dict(encoder, threads=threads)
+	requests = [dict(request, task=task, width=width, height=height, fps=fps, encoder=encoder,
+					 frame_config=dict({'num_threads': min(4, threads)}, **request.get("frame_config", {}))) for request in requests]
+	if pool is None:
+		results = dataset_utils.map_shards(_render_query, requests, num_workers, initializer=_init_render_worker, initargs=(environment_name, frame_cache))
+	else:
+		results = dataset_utils.map_shards(_render_query, requests, num_workers, pool=pool)
+	for video_url, hits, misses, written, stats in results:
+		if frame_cache is not None:
+			frame_cache.record(hits, misses, written)
+		if pipeline_stats is not None:
+			pipeline_stats.add(stats)
+		yield video_url
+
+
+def _render_query(request):
+	cache = _render_frame_cache
+	hits, misses, written = (cache.hits, cache.misses, cache.written) if cache is not None else (0, 0, 0)
+	segments = request["segments"]
+
+	def fill(tiles, chunk_start, chunk_stop):
+		# rows chunk_start..chunk_stop of every segment, rendered into their tile of the ring buffer
+		for tile, (start, end), qposes, qvels, goals in zip(tiles, segments, request["qposes"], request["qvels"], request["goals"]):
+			if chunk_start == 0:
+				# once per segment, every frame sets the full state
+				_render_env.reset()
+			def render(rows):
+				rows = chunk_start + np.asarray(rows)
+				return render_frames(_render_env, request["task"], qposes[rows], qvels[rows], None if goals is None else goals[rows],
+									 request["width"], request["height"])
+			if cache is None:
+				for t, frame in enumerate(render(np.arange(chunk_stop - chunk_start))):
+					tile[t] = frame
+			else:
+				cache.frames(range(start + chunk_start, start + chunk_stop), render, out=tile)
+	frame_writer = None
+	if request["frames_dir"] is not None:
+		frame_writer = dataset_utils.FrameWriter(request["frames_dir"], **request.get("frame_config", {}))
+	try:
+		stats = dataset_utils.stream_video(request["video_url"], segments[0][1] - segments[0][0], (request["height"], request["width"], 3),
+										   request["fps"], fill, num_segments=len(segments), encoder=request["encoder"], frame_writer=frame_writer)
+	finally:
+		if frame_writer is not None:
+			frame_writer.close()
+	if cache is None:
+		return request["video_url"], 0, 0, 0, stats
+	# keep the budget after every query, not only once the batch is rendered
+	cache.trim()
+	return request["video_url"], cache.hits - hits, cache.misses - misses, cache.written - written, stats
+
+
+def camera_name(task, env_id):
+	if task == "mujoco":
+		return "track"
+	elif task == "antmaze":
+		return "birdview" if "medium" in env_id else "birdview_large"
+	elif task == "adroit":
+		return "fixed"
+	raise ValueError(f"{task} undefined")
+
+
+def render_frames(env, task, qposes, qvels, goals, width, height):
+	"""Yields the (height, width, 3) frames of one segment, replayed by setting the env state to every row of `qposes` and `qvels`.
+
+	The env is not reset here, the caller resets it once per segment.
+	"""
+	camera = camera_name(task, env.spec.id)
+	if task == "antmaze":
+		dist_per_pixel, start_x, start_y = (15, 95, 95) if camera == "birdview" else (11, 80, 110)
+
+	for t in range(len(qposes)):
+		env.set_state(qposes[t], qvels[t])
+		if task == "antmaze":
+			if "diverse" in env.spec.id:
+				goal_x, goal_y = map(lambda x: round(x), goals[t])
+			else:
+				goal_x, goal_y = map(lambda x: round(x), env.target_goal)
+			curr_frame = env.physics.render(width=width, height=height, mode="offscreen", camera_name=camera)
+			curr_frame[
+			start_y + int(goal_y * dist_per_pixel): start_y + int(goal_y * dist_per_pixel) + 10,
+			start_x + int(goal_x * dist_per_pixel): start_x + int(goal_x * dist_per_pixel) + 10,
+			] = np.array((255, 0, 0)).astype(np.uint8)
+			yield curr_frame
+		else:
+			curr_frame = env.sim.render(width=width, height=height, mode="offscreen", camera_name=camera)
+			yield np.flipud(curr_frame)
 
 
 def qlearning_mujoco_dataset(env, dataset=None, terminate_on_end=False, **kwargs):
@@ -349,78 +397,7 @@ def qlearning_mujoco_dataset(env, dataset=None, terminate_on_end=False, **kwargs
 			rewards: An N-dim float array of rewards.
 			terminals: An N-dim boolean array of "done" or episode termination flags.
 	"""
-	if dataset is None:
-		dataset = env.get_dataset(**kwargs)
-	
-	N = dataset["rewards"].shape[0]
-	obs_ = []
-	next_obs_ = []
-	action_ = []
-	reward_ = []
-	done_ = []
-	xy_ = []
-	done_bef_ = []
-	
-	qpos_ = []
-	qvel_ = []
-	
-	# The newer version of the dataset adds an explicit
-	# timeouts field. Keep old method for backwards compatability.
-	use_timeouts = False
-	if "timeouts" in dataset:
-		use_timeouts = True
-	
-	episode_step = 0
-	for i in range(N - 1):
-		obs = dataset["observations"][i].astype(np.float32)
-		new_obs = dataset["observations"][i + 1].astype(np.float32)
-		action = dataset["actions"][i].astype(np.float32)
-		reward = dataset["rewards"][i].astype(np.float32)
-		done_bool = bool(dataset["terminals"][i]) or episode_step == env._max_episode_steps - 1
-		xy = dataset["infos/qpos"][i][:2].astype(np.float32)
-		
-		qpos = dataset["infos/qpos"][i]
-		qvel = dataset["infos/qvel"][i]
-		
-		if use_timeouts:
-			final_timestep = dataset["timeouts"][i]
-			next_final_timestep = dataset["timeouts"][i + 1]
-		else:
-			final_timestep = episode_step == env._max_episode_steps - 1
-			next_final_timestep = episode_step == env._max_episode_steps - 2
-		
-		done_bef = bool(next_final_timestep)
-		
-		if (not terminate_on_end) and final_timestep:
-			# Skip this transition and don't apply terminals on the last step of an episode
-			episode_step = 0
-			continue
-		if done_bool or final_timestep:
-			episode_step = 0
-		
-		obs_.append(obs)
-		next_obs_.append(new_obs)
-		action_.append(action)
-		reward_.append(reward)
-		done_.append(done_bool)
-		xy_.append(xy)
-		done_bef_.append(done_bef)
-		
-		qpos_.append(qpos)
-		qvel_.append(qvel)
-		episode_step += 1
-	
-	return {
-		"observations": np.array(obs_),
-		"actions": np.array(action_),
-		"next_observations": np.array(next_obs_),
-		"rewards": np.array(reward_),
-		"terminals": np.array(done_),
-		"xys": np.array(xy_),
-		"dones_bef": np.array(done_bef_),
-		"qposes": np.array(qpos_),
-		"qvels": np.array(qvel_),
-	}
+	return qlearning_d4rl_dataset(env, dataset=dataset, terminate_on_end=terminate_on_end, **kwargs)
 
 
 def qlearning_ant_dataset(env, dataset=None, terminate_on_end=False, **kwargs):
@@ -444,82 +421,7 @@ def qlearning_ant_dataset(env, dataset=None, terminate_on_end=False, **kwargs):
 			rewards: An N-dim float array of rewards.
 			terminals: An N-dim boolean array of "done" or episode termination flags.
 	"""
-	if dataset is None:
-		dataset = env.get_dataset(**kwargs)
-	
-	N = dataset["rewards"].shape[0]
-	obs_ = []
-	next_obs_ = []
-	action_ = []
-	reward_ = []
-	done_ = []
-	goal_ = []
-	xy_ = []
-	done_bef_ = []
-	
-	qpos_ = []
-	qvel_ = []
-	
-	# The newer version of the dataset adds an explicit
-	# timeouts field. Keep old method for backwards compatability.
-	use_timeouts = False
-	if "timeouts" in dataset:
-		use_timeouts = True
-	
-	episode_step = 0
-	for i in range(N - 1):
-		obs = dataset["observations"][i].astype(np.float32)
-		new_obs = dataset["observations"][i + 1].astype(np.float32)
-		action = dataset["actions"][i].astype(np.float32)
-		reward = dataset["rewards"][i].astype(np.float32)
-		done_bool = bool(dataset["terminals"][i]) or episode_step == env._max_episode_steps - 1
-		goal = dataset["infos/goal"][i].astype(np.float32)
-		xy = dataset["infos/qpos"][i][:2].astype(np.float32)
-		
-		qpos = dataset["infos/qpos"][i]
-		qvel = dataset["infos/qvel"][i]
-		
-		if use_timeouts:
-			final_timestep = dataset["timeouts"][i]
-			next_final_timestep = dataset["timeouts"][i + 1]
-		else:
-			final_timestep = episode_step == env._max_episode_steps - 1
-			next_final_timestep = episode_step == env._max_episode_steps - 2
-		
-		done_bef = bool(next_final_timestep)
-		
-		if (not terminate_on_end) and final_timestep:
-			# Skip this transition and don't apply terminals on the last step of an episode
-			episode_step = 0
-			continue
-		if done_bool or final_timestep:
-			episode_step = 0
-		
-		obs_.append(obs)
-		next_obs_.append(new_obs)
-		action_.append(action)
-		reward_.append(reward)
-		done_.append(done_bool)
-		goal_.append(goal)
-		xy_.append(xy)
-		done_bef_.append(done_bef)
-		
-		qpos_.append(qpos)
-		qvel_.append(qvel)
-		episode_step += 1
-	
-	return {
-		"observations": np.array(obs_),
-		"actions": np.array(action_),
-		"next_observations": np.array(next_obs_),
-		"rewards": np.array(reward_),
-		"terminals": np.array(done_),
-		"goals": np.array(goal_),
-		"xys": np.array(xy_),
-		"dones_bef": np.array(done_bef_),
-		"qposes": np.array(qpos_),
-		"qvels": np.array(qvel_),
-	}
+	return qlearning_d4rl_dataset(env, dataset=dataset, terminate_on_end=terminate_on_end, with_goals=True, **kwargs)
 
 
 def qlearning_adroit_dataset(env, dataset=None, terminate_on_end=False, **kwargs):
@@ -543,78 +445,135 @@ def qlearning_adroit_dataset(env, dataset=None, terminate_on_end=False, **kwargs
 			rewards: An N-dim float array of rewards.
 			terminals: An N-dim boolean array of "done" or episode termination flags.
 	"""
+	return qlearning_d4rl_dataset(env, dataset=dataset, terminate_on_end=terminate_on_end, **kwargs)
+
+
+def qlearning_d4rl_dataset(env, dataset=None, terminate_on_end=False, with_goals=False, **kwargs):
+	"""
+	Vectorized conversion shared by the mujoco, antmaze and adroit tasks.
+	Produces exactly the arrays of the original per-row loop, but builds the
+	timeout/terminal masks with a few whole-array passes and gathers every
+	kept transition with a single fancy index per column.
+	Args:
+		env: An OfflineEnv object.
+		dataset: An optional dataset to pass in for processing, e.g. a
+			dataset_utils.HDF5Columns over the raw file. If None, the dataset
+			will default to env.get_dataset()
+		terminate_on_end (bool): Set done=True on the last timestep
+			in a trajectory. Default is False, and will discard the
+			last timestep in each trajectory.
+		with_goals (bool): Also return the `infos/goal` column as "goals" (antmaze).
+		**kwargs: Arguments to pass to env.get_dataset().
+	Returns:
+		A dataset_utils.LazyColumns with keys observations, actions, next_observations,
+		rewards, terminals, xys, dones_bef, qposes, qvels (and goals). Only terminals
+		and dones_bef are computed eagerly. next_observations is a
+		dataset_utils.NextObservationView over observations.
+	"""
 	if dataset is None:
 		dataset = env.get_dataset(**kwargs)
-	
-	N = dataset["rewards"].shape[0]
-	obs_ = []
-	next_obs_ = []
-	action_ = []
-	reward_ = []
-	done_ = []
-	xy_ = []
-	done_bef_ = []
-	
-	qpos_ = []
-	qvel_ = []
-	
+
+	terminals = np.asarray(dataset["terminals"]).astype(bool)
+	N = terminals.shape[0]
+	terminals = terminals[:N - 1]
+	max_episode_steps = env._max_episode_steps
+
 	# The newer version of the dataset adds an explicit
 	# timeouts field. Keep old method for backwards compatability.
-	use_timeouts = False
-	if "timeouts" in dataset:
-		use_timeouts = True
-	
-	episode_step = 0
-	for i in range(N - 1):
-		obs = dataset["observations"][i].astype(np.float32)
-		new_obs = dataset["observations"][i + 1].astype(np.float32)
-		action = dataset["actions"][i].astype(np.float32)
-		reward = dataset["rewards"][i].astype(np.float32)
-		done_bool = bool(dataset["terminals"][i]) or episode_step == env._max_episode_steps - 1
-		xy = dataset["infos/qpos"][i][:2].astype(np.float32)
-		
-		qpos = dataset["infos/qpos"][i]
-		qvel = dataset["infos/qvel"][i]
-		
-		if use_timeouts:
-			final_timestep = dataset["timeouts"][i]
-			next_final_timestep = dataset["timeouts"][i + 1]
-		else:
-			final_timestep = episode_step == env._max_episode_steps - 1
-			next_final_timestep = episode_step == env._max_episode_steps - 2
-		
-		done_bef = bool(next_final_timestep)
-		
-		if (not terminate_on_end) and final_timestep:
-			# Skip this transition and don't apply terminals on the last step of an episode
-			episode_step = 0
-			continue
-		if done_bool or final_timestep:
-			episode_step = 0
-		
-		obs_.append(obs)
-		next_obs_.append(new_obs)
-		action_.append(action)
-		reward_.append(reward)
-		done_.append(done_bool)
-		xy_.append(xy)
-		done_bef_.append(done_bef)
-		
-		qpos_.append(qpos)
-		qvel_.append(qvel)
-		episode_step += 1
-	
-	return {
-		"observations": np.array(obs_),
-		"actions": np.array(action_),
-		"next_observations": np.array(next_obs_),
-		"rewards": np.array(reward_),
-		"terminals": np.array(done_),
-		"xys": np.array(xy_),
-		"dones_bef": np.array(done_bef_),
-		"qposes": np.array(qpos_),
-		"qvels": np.array(qvel_),
-	}
+	use_timeouts = "timeouts" in dataset
+	timeouts = np.asarray(dataset["timeouts"]).astype(bool) if use_timeouts else None
+	episode_step = _episode_steps(terminals, timeouts, max_episode_steps, terminate_on_end)
+
+	if use_timeouts:
+		final_timestep = timeouts[:N - 1]
+		done_bef = timeouts[1:N]
+	else:
+		final_timestep = episode_step == max_episode_steps - 1
+		done_bef = episode_step == max_episode_steps - 2
+	done_bool = terminals | (episode_step == max_episode_steps - 1)
+
+	# Skip the transition and don't apply terminals on the last step of an episode
+	keep = np.ones(N - 1, dtype=bool) if terminate_on_end else ~final_timestep
+	idx = np.flatnonzero(keep)
+
+	# only the masks above are computed here, every other column reads its source
+	# column when it is first accessed
+	datasets = dataset_utils.LazyColumns()
+	datasets.set_loader("observations", lambda: np.asarray(dataset["observations"])[idx].astype(np.float32))
+	datasets.set_loader("actions", lambda: np.asarray(dataset["actions"])[idx].astype(np.float32))
+	datasets.set_loader("next_observations", lambda: _next_observation_view(datasets["observations"], dataset, idx))
+	datasets.set_loader("rewards", lambda: np.asarray(dataset["rewards"])[idx].astype(np.float32))
+	datasets["terminals"] = done_bool[idx]
+	if with_goals:
+		datasets.set_loader("goals", lambda: np.asarray(dataset["infos/goal"])[idx].astype(np.float32))
+	datasets.set_loader("xys", lambda: datasets["qposes"][:, :2].astype(np.float32))
+	datasets["dones_bef"] = done_bef[idx]
+	datasets.set_loader("qposes", lambda: np.asarray(dataset["infos/qpos"])[idx])
+	datasets.set_loader("qvels", lambda: np.asarray(dataset["infos/qvel"])[idx])
+	return datasets
+
+
+def _next_observation_view(observations, dataset, idx):
+	# next_observations is observations shifted by one row, except where the successor
+	# was a skipped final timestep; only those rows (and the last one) are stored
+	successors = idx + 1
+	episode_ends = np.ones(len(idx), dtype=bool)
+	episode_ends[:-1] = idx[1:] != successors[:-1]
+	patch_rows = np.flatnonzero(episode_ends)
+	return dataset_utils.NextObservationView(
+		observations, patch_rows, np.asarray(dataset["observations"])[successors[patch_rows]].astype(np.float32))
+
+
+def _episode_steps(terminals, timeouts, max_episode_steps, terminate_on_end=False):
+	"""Value of the loop counter `episode_step` at every row of the legacy qlearning_* loops.
+
+	The counter restarts after every terminal/timeout ("hard" resets, independent of
+	the counter) and wraps on its own once it reaches max_episode_steps - 1 ("soft"
+	resets). Between two hard resets it is an affine ramp followed by a sawtooth, so
+	every row can be computed in closed form from the last hard reset before it.
+
+	Args:
+		terminals (np.ndarray): Boolean terminal flags of rows 0..N-2.
+		timeouts (np.ndarray): Boolean timeout flags of rows 0..N-1, or None for old datasets.
+		max_episode_steps (int): The env._max_episode_steps.
+		terminate_on_end (bool): Same as in qlearning_d4rl_dataset.
+	Returns:
+		An int64 array with the same length as terminals.
+	"""
+	n = terminals.shape[0]
+	wrap_at = max_episode_steps - 1
+	if timeouts is not None:
+		# a timeout is skipped (-> 0) unless terminate_on_end, a terminal or a soft wrap restarts at 1
+		timeouts = timeouts[:n]
+		resets = terminals | timeouts
+		bases = np.where(timeouts & (not terminate_on_end), 0, 1)
+		return _ramp_with_wrap(resets, bases, wrap_at, 1)
+
+	# old datasets: reaching wrap_at is itself the final timestep, which is skipped (-> 0)
+	wrap_to = 1 if terminate_on_end else 0
+	resets = terminals.copy()
+	while True:
+		episode_step = _ramp_with_wrap(resets, np.ones(n, dtype=np.int64), wrap_at, wrap_to)
+		# a terminal that coincides with the final timestep is skipped like any other final timestep
+		updated = terminals & (terminate_on_end | (episode_step != wrap_at))
+		if np.array_equal(updated, resets):
+			return episode_step
+		resets = updated
+
+
+def _ramp_with_wrap(resets, bases, wrap_at, wrap_to):
+	n = resets.shape[0]
+	rows = np.arange(n, dtype=np.int64)
+	# row i + 1 starts a new ramp with value bases[i] whenever resets[i]
+	starts = np.zeros(n, dtype=np.int64)
+	start_values = np.zeros(n, dtype=np.int64)
+	reset_rows = np.flatnonzero(resets[:n - 1])
+	starts[reset_rows + 1] = reset_rows + 1
+	start_values[reset_rows + 1] = np.asarray(bases)[reset_rows]
+	starts = np.maximum.accumulate(starts)
+	ramp = start_values[starts] + (rows - starts)
+	period = wrap_at - wrap_to + 1
+	return np.where(ramp <= wrap_at, ramp, wrap_to + (ramp - wrap_at - 1) % period)
 
 
 if __name__ == '__main__':
@@ -625,7 +584,7 @@ if __name__ == '__main__':
 	parser.add_argument('--task', type=str, default='antmaze')
 	parser.add_argument('--environment_name', type=str, default='antmaze-medium-play-v2')
 	parser.add_argument('--mode', type=str, default='offline', choices=['online', 'offline'])
-	parser.add_argument('--sampler_type', type=str, default='random', choices=['random', 'disagreement', 'schedule', 'customization'])
+	parser.add_argument('--sampler_type', type=str, default='random', choices=['random', 'disagreement', 'diversity', 'stratified', 'schedule', 'customization'])
 	parser.add_argument('--feedback_type', type=str, default='comparative', choices=['comparative', 'attribute', 'evaluative', 'visual', 'keypoint'])
 	parser.add_argument('--query_num', type=int, default=5, help='number of query.')
 	parser.add_argument('--query_length', type=int, default=200, help='length of each query.')
@@ -634,12 +593,25 @@ if __name__ == '__main__':
 	parser.add_argument('--video_height', type=int, default=500, help='height of videos.')
 
 	parser.add_argument('--save_dir', type=str, default=f'video/', help='save dir')
+	parser.add_argument('--pool_size', type=int, default=1000, help='candidates scored by the disagreement and diversity samplers.')
+	parser.add_argument('--score_batch_size', type=int, default=4096, help='steps per batch of the disagreement and diversity samplers.')
+	parser.add_argument('--max_overlap', type=float, default=0.5, help='largest overlap with an issued segment, as a fraction of its length.')
+	parser.add_argument('--schedule', type=str, default='position', choices=['position', 'return'], help='curriculum of the schedule sampler.')
+	parser.add_argument('--queries_per_batch', type=int, default=8, help='queries the schedule sampler yields per batch.')
+	parser.add_argument('--num_workers', type=int, default=None, help='worker processes rendering queries.')
+	parser.add_argument('--encoder_profile', type=str, default='default', choices=sorted(dataset_utils.ENCODER_PROFILES), help='codec settings of the videos.')
+	parser.add_argument('--image_format', type=str, default='jpg', choices=sorted(dataset_utils.IMAGE_FORMATS), help="images of the 'visual' and 'keypoint' queries.")
+	parser.add_argument('--image_quality', type=int, default=None, help='jpg/webp quality or png compression of the images.')
+	parser.add_argument('--frame_stride', type=int, default=1, help='write every n-th frame as an image.')
 	cfg = parser.parse_args()
 	
 	dataset = Dataset(project_id=cfg.project_id, domain=cfg.domain, task=cfg.task, environment_name=cfg.environment_name, mode=cfg.mode,
 						sampler_type=cfg.sampler_type, feedback_type=cfg.feedback_type, query_num=cfg.query_num,
 						query_length=cfg.query_length, fps=cfg.fps, video_width=cfg.video_width, video_height=cfg.video_height,
-						save_dir=cfg.save_dir)
+						save_dir=cfg.save_dir, num_workers=cfg.num_workers, sampler_config={'pool_size': cfg.pool_size, 'batch_size': cfg.score_batch_size, 'max_overlap': cfg.max_overlap,
+								'schedule': cfg.schedule, 'queries_per_batch': cfg.queries_per_batch},
+						encoder_config={'profile': cfg.encoder_profile},
+						frame_config={'image_format': cfg.image_format, 'quality': cfg.image_quality, 'stride': cfg.frame_stride})
 
 	video_info_list, video_url_list, query_id_list = dataset.generate_video_resources()
 	
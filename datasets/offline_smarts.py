@@ -16,11 +16,19 @@ import h5py
 sys.path.append(str(Path(__file__).parent.parent))
 from datasets.base import BaseOfflineDataset
 import datasets.dataset_utils as dataset_utils
+from datasets.dataset_cache import DatasetCache, source_fingerprint
+from datasets.dataset_registry import registry
 
 
 class Dataset(BaseOfflineDataset):
+    stage_columns = {
+        'get_episode_boundaries': ['terminals'],
+        'sample': [],
+        'visualize_query': ['pictures'],
+    }
+
     def __init__(self, project_id, domain, task, environment_name, mode, sampler_type, feedback_type,
-                query_num, query_length, fps, video_width, video_height, save_dir):
+                query_num, query_length, fps, video_width, video_height, save_dir, num_workers=None, resize_in_encoder=True, sampler_config=None, encoder_config=None, frame_config=None):
         """AtariDataset
 
         Args:
@@ -29,7 +37,7 @@ class Dataset(BaseOfflineDataset):
             task (str): The task.
             environment_name (str): The environment name.
             mode (str): The mode. Choices are 'online' and 'offline'.
-            sampler_type (str): The sampler type. Choices are 'random', 'disagreement', 'schedule', and 'customization'.
+            sampler_type (str): The sampler type. Choices are 'random', 'disagreement', 'diversity', 'stratified', 'schedule', and 'customization'.
             feedback_type (str): The feedback type. Choices are 'comparative', 'attribute', 'evaluative', 'visual', and 'keypoint'.
             query_num (int): The number of queries.
             query_length (int): The length of each query.
@@ -37,8 +45,13 @@ class Dataset(BaseOfflineDataset):
             video_width (int): The width of the videos.
             video_height (int): The height of the videos.                   
             save_dir (str): The directory to save the videos.
+            num_workers (int): Worker processes decoding dataset shards. Defaults to the cpu count.
+            resize_in_encoder (bool): Scale frames in the ffmpeg filter graph. False resizes every frame with cv2 before encoding.
+            sampler_config (dict): Options of the sampler, e.g. pool_size and batch_size of 'disagreement' and 'diversity'.
+            encoder_config (dict): The encoder profile of the videos and its overrides, see dataset_utils.encoder_profile.
+            frame_config (dict): Options of the images of 'visual' and 'keypoint' queries, see dataset_utils.FrameWriter.
         """
-        super().__init__()
+        super().__init__(sampler_config, encoder_config, frame_config)
         self.project_id = project_id
         self.domain = domain
         self.task = task  # smarts
@@ -52,12 +65,14 @@ class Dataset(BaseOfflineDataset):
         self.width = video_width
         self.height = video_height
         self.save_dir = save_dir
+        self.resize_in_encoder = resize_in_encoder
+        self.num_workers = os.cpu_count() if num_workers is None else num_workers
 
         if not os.path.exists(os.path.join(self.save_dir, self.project_id)):
             os.makedirs(os.path.join(self.save_dir, self.project_id))
 
         # split episode
-        self.trj_idx_list = []
+        self.episode_index = None
 
         if self.feedback_type in ['comparative', 'attribute']:
             self.sample_num = 2
@@ -75,95 +90,59 @@ class Dataset(BaseOfflineDataset):
         base_url = str(pathlib.Path(__file__).parent) + "/dataset_resource"
         print(base_url)
         self.dataset_path = os.path.join(base_url, self.task, self.environment_name)
-        
-        self.query_length = min(self.query_length, 50)  # todo 
+        self.source_paths = [self.dataset_path]
 
     def load_offline_dataset(self):
         assert self.task in ['smarts']
-        num_steps = 0
-        datasets = {}
-        filenames = sorted(os.listdir(self.dataset_path), key=lambda x:int(x.split('_')[0]))  # todo: rename dataset to match unsorted order
-        raw_datasets = []
-        for file in filenames:
-            with open(os.path.join(self.dataset_path, file), 'rb') as f:
-                data = pickle.load(f)
-                if isinstance(data, list):
-                    raw_datasets.extend(data)
-                    length = len(data)
-                    num_steps += length
-                    print("Loaded {} offline timesteps so far...".format(int(num_steps)))
-                else:
-                    print(f"The data in {file} is not a list and cannot be extended.")
-
-        self.datasets = qlearning_smarts_dataset(raw_datasets)
         self.max_episode_steps = 500  # todo, default
-        print("Finished, loaded {} timesteps. Max episode steps {}".format(int(self.datasets["rewards"].shape[0]), self.max_episode_steps))
+        self.datasets, self.episode_index = registry.get(self.registry_key(), self._convert_offline_dataset)
+        self.datasets.preload(self.required_columns())
+        print("Finished, loaded {} timesteps. Max episode steps {}".format(int(self.datasets["terminals"].shape[0]), self.max_episode_steps))
         print("Datasets keys: ", self.datasets.keys())
 
+    def _convert_offline_dataset(self):
+        dataset_cache = DatasetCache(self.domain, self.task, self.environment_name, self.source_paths)
+        # pickled row shards are converted once to a columnar hdf5 file next to the dataset directory
+        columnar_path = self.dataset_path.rstrip(os.sep) + ".columnar.hdf5"
+        if not is_columnar_up_to_date(self.dataset_path, columnar_path):
+            convert_smarts_to_columnar(self.dataset_path, columnar_path, num_workers=self.num_workers)
+        columns = dataset_utils.ShardedHDF5Dataset([columnar_path])
+
+        self.datasets = qlearning_smarts_dataset(columns)
+        self.datasets.resources.append(columns)
+        cached = dataset_cache.load()
+        if cached is not None:
+            cached_columns, self.episode_index = cached
+            self.datasets.update(cached_columns)
+        self.datasets.preload(self.required_columns())
+        if cached is None:
+            self.get_episode_boundaries()
+            dataset_cache.save(self.datasets, self.episode_index)
+        return self.datasets, self.episode_index
+
     def get_episode_boundaries(self):
-        trj_idx_list = []
-        N = self.datasets['rewards'].shape[0]
-        
-        episode_step = 0
-        start_idx, data_idx = 0, 0
-        trj_idx_list = []
-        for i in range(N - 1):
-            done_bool = bool(self.datasets['terminals'][i])
-            if done_bool:
-                episode_step = 0
-                trj_idx_list.append([start_idx, data_idx])
-                start_idx = data_idx + 1
-            episode_step += 1
-            data_idx += 1
-        
-        trj_idx_list.append([start_idx, data_idx])
-        #print(trj_idx_list)
-        #print(len(trj_idx_list))
-        return trj_idx_list
-    
-    def sample(self, trj_idx_list):
+        if self.episode_index is None:
+            N = self.datasets['terminals'].shape[0]
+            self.episode_index = dataset_utils.EpisodeIndex.from_terminals(self.datasets['terminals'], N)
+        return self.episode_index.trj_idx_list
+
+    def sample(self, trj_idx_list, segment_indices=None):
         '''
-            sample query_num*query_length sequences
+            sample query_num*query_length sequences, or wrap the (start_indices, end_indices) of one batch
         '''
-        trj_idx_list = np.array(trj_idx_list)
-        trj_len_list = trj_idx_list[:, 1] - trj_idx_list[:, 0] + 1  # len(trj_len_list) = dataset episode num
-        # print(trj_len_list)
-        
-        assert max(trj_len_list) > self.query_length
-        total_sample_num = self.query_num * self.sample_num
-        start_indices, end_indices = np.zeros(total_sample_num), np.zeros(total_sample_num)
-        
-        for query_count in range(total_sample_num):
-            temp_count = 0
-            while temp_count < 1:
-                trj_idx = np.random.choice(np.arange(len(trj_idx_list) - 1))
-                len_trj = trj_len_list[trj_idx]
-                
-                if len_trj > self.query_length:
-                    if not self.over_sample:
-                        time_idx = np.random.choice(len_trj - self.query_length + 1)
-                    else:
-                        time_idx = np.random.choice(len_trj + 1)
-                        if time_idx > len_trj - self.query_length:
-                            time_idx = len_trj - self.query_length
-                    start_idx = trj_idx_list[trj_idx][0] + time_idx
-                    end_idx = start_idx + self.query_length
-                    
-                    assert end_idx <= trj_idx_list[trj_idx][1] + 1
-                    
-                    if temp_count == 0:
-                        start_indices[query_count] = start_idx
-                        end_indices[query_count] = end_idx
-                    
-                    temp_count += 1
-        
-        print(f"Sample query indices {self.query_num} x {self.sample_num} successfully.")
+        if segment_indices is None:
+            total_sample_num = self.query_num * self.sample_num
+            segment_indices = self.sample_segment_indices(trj_idx_list, total_sample_num)
+        start_indices, end_indices = segment_indices
+        query_num = len(start_indices) // self.sample_num
+
+        print(f"Sample query indices {query_num} x {self.sample_num} successfully.")
 
         if self.sample_num == 2:
-            start_indices_1 = np.array(start_indices[:self.query_num], dtype=np.int32)
-            start_indices_2 = np.array(start_indices[self.query_num:], dtype=np.int32)
-            end_indices_1 = np.array(end_indices[:self.query_num], dtype=np.int32)
-            end_indices_2 = np.array(end_indices[self.query_num:], dtype=np.int32)
+            start_indices_1 = np.array(start_indices[:query_num], dtype=np.int32)
+            start_indices_2 = np.array(start_indices[query_num:], dtype=np.int32)
+            end_indices_1 = np.array(end_indices[:query_num], dtype=np.int32)
+            end_indices_2 = np.array(end_indices[query_num:], dtype=np.int32)
             return {"start_indices_1": start_indices_1,
                     "end_indices_1": end_indices_1,
                     "start_indices_2": start_indices_2,
@@ -176,73 +155,83 @@ class Dataset(BaseOfflineDataset):
                     "end_indices": end_indices,
                     "query_id": [str(uuid.uuid4().hex) for _ in range(len(start_indices))]}
 
+    def read_frames(self, start, stop):
+        return np.asarray(self.datasets["pictures"][start:stop])
+
     def visualize_query(self, video_info):
         video_url_list = []
-        for seg_idx in trange(self.query_num):
-            frames = []
-            frames_2 = []
-            if self.feedback_type in ['comparative', 'attribute']:			
-                start_1, start_2, end_1, end_2, query_id = (
-                    video_info["start_indices_1"][seg_idx],
-                    video_info["start_indices_2"][seg_idx],
-                    video_info["end_indices_1"][seg_idx],
-                    video_info["end_indices_2"][seg_idx],
-                    video_info["query_id"][seg_idx],
-                )
-                start_indices = range(start_1, end_1)
-                start_indices_2 = range(start_2, end_2)
-            elif self.feedback_type in ['evaluative', 'visual', 'keypoint']:
-                start, end, query_id = (
-                    video_info["start_indices"][seg_idx],
-                    video_info["end_indices"][seg_idx],
-                    video_info["query_id"][seg_idx],
-                )
-                start_indices = range(start, end)
-            else:
-                raise ValueError("The dataset does not support this feedback type.")
-
-            for t in trange(self.query_length, leave=False):
-                pic = self.datasets["pictures"][start_indices[t]]
-                frame = cv2.resize(pic, dsize=(self.width, self.height), interpolation=cv2.INTER_CUBIC)
-                frames.append(frame)
-    
-            if self.feedback_type in ['comparative', 'attribute']:	
-                for t in trange(self.query_length, leave=False):
-                    pic_2 = self.datasets["pictures"][start_indices_2[t]]
-                    frame = cv2.resize(pic_2, dsize=(self.width, self.height), interpolation=cv2.INTER_CUBIC)
-                    frames_2.append(frame)
-            
-            if self.feedback_type in ['comparative', 'attribute']:	
-                video = np.concatenate((np.array(frames), np.array(frames_2)), axis=2)
-            else:
-                video = np.array(frames)
-            writer = imageio.get_writer(
-                os.path.join(self.save_dir, self.project_id, f"{self.environment_name}_{query_id}.mp4"), fps=self.fps)
-            for i, fra in tqdm(enumerate(video), leave=False):
-                writer.append_data(fra)
-            writer.close()
-            video_url = os.path.join(self.save_dir, self.project_id, f"{self.environment_name}_{query_id}.mp4")
-            video_url_list.append(video_url)
-
-            if self.feedback_type in ['visual', 'keypoint']:
-                dataset_utils.video_to_frames(video_url, os.path.join(self.save_dir, self.project_id, f"{self.environment_name}_{query_id}_img"))
+        for seg_idx in trange(len(video_info["query_id"])):
+            query_id = video_info["query_id"][seg_idx]
+            video_name = os.path.join(self.save_dir, self.project_id, f"{self.environment_name}_{query_id}")
+            frames_dir = f"{video_name}_img" if self.feedback_type in ['visual', 'keypoint'] else None
+            self.write_query_video(f"{video_name}.mp4", self.query_segments(video_info, seg_idx), frames_dir)
+            video_url_list.append(f"{video_name}.mp4")
     
+        self.report_render_stats()
         return video_url_list
 
-    def generate_video_resources(self):
-        # 1: load offline dataset
-        self.load_offline_dataset()
-        # 2: get episode boundaries
-        trj_idx_list = self.get_episode_boundaries()
-        # 3: get sample indices
-        indices_info = self.sample(trj_idx_list)
-        query_id_list = indices_info['query_id']
-        # 4: visualize query
-        video_url_list = self.visualize_query(indices_info)
-        # 5: get video info
-        video_info_list = dataset_utils.reformat_video_info(indices_info)
 
-        return video_info_list, video_url_list, query_id_list
+def smarts_rows_to_columns(rows):
+    """Stacks pickled (picture, obs, action, reward, done) rows into column arrays."""
+    return {
+        "pictures": np.array([row[0] for row in rows]),
+        "observations": np.array([np.asarray(row[1]).astype(np.float32) for row in rows]),
+        "actions": np.array([row[2] for row in rows]),
+        "rewards": np.array([row[3] for row in rows]),
+        "terminals": np.array([bool(row[4]) for row in rows]),
+    }
+
+
+def is_columnar_up_to_date(dataset_path, columnar_path):
+    if not os.path.exists(columnar_path):
+        return False
+    with h5py.File(columnar_path, 'r') as f:
+        return f.attrs.get('source_fingerprint') == source_fingerprint([dataset_path])
+
+
+def load_smarts_shard(file_path):
+    """Unpickles one shard into column arrays. Returns None if it does not hold a row list."""
+    with open(file_path, 'rb') as f:
+        data = pickle.load(f)
+    if not isinstance(data, list):
+        return None
+    return smarts_rows_to_columns(data) if data else {}
+
+
+def convert_smarts_to_columnar(dataset_path, columnar_path, num_workers=1):
+    """
+    Streams the pickled SMARTS shards of dataset_path into one columnar hdf5 file.
+    Shards are unpickled by num_workers processes and appended in order to resizable
+    datasets, with at most 2 * num_workers decoded shards in memory. Later loads read
+    the hdf5 file and never unpickle.
+    """
+    filenames = sorted(os.listdir(dataset_path), key=lambda x:int(x.split('_')[0]))  # todo: rename dataset to match unsorted order
+    file_paths = [os.path.join(dataset_path, file) for file in filenames]
+    tmp_path = f"{columnar_path}.tmp-{uuid.uuid4().hex}"
+    num_steps = 0
+    try:
+        with h5py.File(tmp_path, 'w') as columnar:
+            columnar.attrs['source_fingerprint'] = source_fingerprint([dataset_path])
+            for file, columns in zip(filenames, dataset_utils.map_shards(load_smarts_shard, file_paths, num_workers)):
+                if columns is None:
+                    print(f"The data in {file} is not a list and cannot be extended.")
+                    continue
+                if not columns:
+                    continue
+                for key, column in columns.items():
+                    if key not in columnar:
+                        columnar.create_dataset(key, data=column, maxshape=(None,) + column.shape[1:], chunks=True)
+                    else:
+                        columnar[key].resize(num_steps + len(column), axis=0)
+                        columnar[key][num_steps:] = column
+                num_steps += len(columns["terminals"])
+                print("Converted {} offline timesteps so far...".format(int(num_steps)))
+        if num_steps == 0:
+            raise ValueError(f"No SMARTS timesteps were found in {dataset_path}, every shard is empty or not a list of rows.")
+        os.replace(tmp_path, columnar_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
 
 def qlearning_smarts_dataset(dataset=None):
@@ -251,62 +240,34 @@ def qlearning_smarts_dataset(dataset=None):
     with observations, actions, next_observations, rewards, and a terminal
     flag.
     Args:
-        category: category name.
-        dataset: An optional dataset to pass in for processing. If None,
-            the dataset will default to env.get_dataset()
-        terminate_on_end (bool): Set done=True on the last timestep
-            in a trajectory. Default is False, and will discard the
-            last timestep in each trajectory.
-        **kwargs: Arguments to pass to env.get_dataset().
+        dataset: Columns (pictures, observations, actions, rewards, terminals) as
+            arrays or a dataset_utils.ShardedHDF5Dataset over the columnar file,
+            or the legacy list of pickled (picture, obs, action, reward, done) rows.
+            Pictures are passed through untouched so they can stay lazy.
     Returns:
-        A dictionary containing keys:
+        A dataset_utils.LazyColumns where everything but pictures and terminals is
+        read on first access, containing keys:
+            pictures: An N x H x W x 3 array (or lazy view) of rendered pictures.
             observations: An N x dim_obs array of observations.
             actions: An N x dim_action array of actions.
             next_observations: An N x dim_obs array of next observations.
             rewards: An N-dim float array of rewards.
             terminals: An N-dim boolean array of "done" or episode termination flags.
     """
-    N = len(dataset)
-    pic_ = []
-    obs_ = []
-    next_obs_ = []
-    action_ = []
-    reward_ = []
-    done_ = []
-
-    episode_step = 0
-    for i in range(N):
-        pic = dataset[i][0]
-        obs = dataset[i][1].astype(np.float32)
-        if i < N - 1:
-            new_obs = dataset[i + 1][1].astype(np.float32)
-        else:
-            new_obs = obs  # place holder
-        action = dataset[i][2]
-        reward = dataset[i][3]
-        done_bool = bool(dataset[i][4])
-
-        if done_bool:
-            episode_step = 0
-
-        pic_.append(pic)
-        obs_.append(obs)
-        next_obs_.append(new_obs)
-        action_.append(action)
-        reward_.append(reward)
-        done_.append(done_bool)
-
-        episode_step += 1
+    if isinstance(dataset, list):
+        dataset = smarts_rows_to_columns(dataset)
+    datasets = dataset_utils.LazyColumns()
+    datasets["pictures"] = dataset["pictures"]
+    datasets.set_loader("observations", lambda: np.asarray(dataset["observations"][:], dtype=np.float32))
+    datasets.set_loader("actions", lambda: np.asarray(dataset["actions"][:]))
+    datasets.set_loader("next_observations", lambda: _next_observation_view(datasets["observations"]))
+    datasets.set_loader("rewards", lambda: np.asarray(dataset["rewards"][:]))
+    datasets["terminals"] = np.asarray(dataset["terminals"][:], dtype=bool)
+    return datasets
 
-    return {
-        "pictures": np.array(pic_),
-        "observations": np.array(obs_),
-        "actions": np.array(action_),
-        "next_observations": np.array(next_obs_),
-        "rewards": np.array(reward_),
-        "terminals": np.array(done_),
-    }
 
-
-    
-    
\ No newline at end of file
+def _next_observation_view(observations):
+    # the last row has no successor and is its own place holder
+    N = observations.shape[0]
+    patch_rows = [N - 1] if N else []
+    return dataset_utils.NextObservationView(observations, patch_rows, observations[N - 1:])
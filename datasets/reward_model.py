@@ -0,0 +1,84 @@
+import numpy as np
+
+
+def step_features(observations, indices, batch_size=4096, pool_size=8, transform=None):
+    """Per-step reward model inputs for the rows `indices` of an observation column.
+
+    Vector observations are used as they are. Image observations, (N, C, H, W) or
+    (N, H, W, C), are area-pooled to `pool_size` x `pool_size` per channel so that
+    features stay small whatever the frame size. Rows are read `batch_size` at a time
+    and `transform`, if given, is applied to each batch of features.
+
+    Returns:
+        np.ndarray: float32 array of shape (len(indices), feature_dim).
+    """
+    indices = np.asarray(indices, dtype=np.int64)
+    features = []
+    for batch_start in range(0, len(indices), batch_size):
+        batch = np.asarray(observations[indices[batch_start:batch_start + batch_size]], dtype=np.float32)
+        if batch.ndim == 3:
+            batch = batch[:, None]
+        if batch.ndim == 4:
+            if batch.shape[1] > 4:
+                batch = batch.transpose(0, 3, 1, 2)
+            n, c, h, w = batch.shape
+            ph, pw = min(pool_size, h), min(pool_size, w)
+            batch = batch[:, :, :h // ph * ph, :w // pw * pw].reshape(n, c, ph, h // ph, pw, w // pw).mean(axis=(3, 5))
+        batch = batch.reshape(len(batch), -1)
+        features.append(batch if transform is None else transform(batch))
+    return np.concatenate(features) if features else np.zeros((0, 0), dtype=np.float32)
+
+
+class RewardEnsemble(object):
+    def __init__(self, input_dim, num_members=5, hidden_dim=128, seed=None):
+        """Ensemble of random-feature reward models r_k(s) = tanh(s W_k + b_k) v_k on the CPU.
+
+        Every member has its own random hidden layer. `fit` solves the output weights
+        by ridge regression on a bootstrap sample of labelled steps; without labels
+        the members keep random output weights and act as a prior ensemble.
+
+        Args:
+            input_dim (int): Feature dimension.
+            num_members (int): Number of reward models.
+            hidden_dim (int): Random features per model.
+            seed (int): Seed of the random weights and bootstrap samples.
+        """
+        self.rng = np.random.default_rng(seed)
+        self.weights = (self.rng.standard_normal((num_members, input_dim, hidden_dim)) / np.sqrt(max(input_dim, 1))).astype(np.float32)
+        self.biases = self.rng.uniform(-1, 1, (num_members, 1, hidden_dim)).astype(np.float32)
+        self.heads = (self.rng.standard_normal((num_members, hidden_dim)) / np.sqrt(hidden_dim)).astype(np.float32)
+        self.mean = np.zeros(input_dim, dtype=np.float32)
+        self.std = np.ones(input_dim, dtype=np.float32)
+
+    @property
+    def num_members(self):
+        return len(self.heads)
+
+    def _hidden(self, features, member=None):
+        x = (features - self.mean) / self.std
+        if member is None:
+            return np.tanh(np.einsum('nd,kdh->knh', x, self.weights) + self.biases)
+        return np.tanh(x @ self.weights[member] + self.biases[member])
+
+    def fit(self, features, rewards=None, ridge=1.0):
+        features = np.asarray(features, dtype=np.float32)
+        self.mean = features.mean(axis=0)
+        self.std = features.std(axis=0) + 1e-6
+        if rewards is None:
+            return self
+        rewards = np.asarray(rewards, dtype=np.float32).reshape(-1)
+        for member in range(self.num_members):
+            sample = self.rng.integers(0, len(features), len(features))
+            hidden = self._hidden(features[sample], member)
+            gram = hidden.T @ hidden + ridge * np.eye(hidden.shape[1], dtype=np.float32)
+            self.heads[member] = np.linalg.solve(gram, hidden.T @ rewards[sample])
+        return self
+
+    def predict(self, features, batch_size=4096):
+        """Returns the (num_members, len(features)) reward predictions, `batch_size` rows at a time."""
+        features = np.asarray(features, dtype=np.float32)
+        predictions = np.empty((self.num_members, len(features)), dtype=np.float32)
+        for batch_start in range(0, len(features), batch_size):
+            hidden = self._hidden(features[batch_start:batch_start + batch_size])
+            predictions[:, batch_start:batch_start + batch_size] = np.einsum('knh,kh->kn', hidden, self.heads)
+        return predictions
@@ -0,0 +1,228 @@
+import time
+import numpy as np
+
+from datasets import dataset_utils
+from datasets.dataset_utils import sample_segments
+from datasets.reward_model import RewardEnsemble, step_features
+
+
+def disagreement_sample(datasets, trj_idx_list, query_length, query_num, sample_num, over_sample=False,
+                        pool_size=1000, batch_size=4096, num_members=5, steps_per_segment=8, seed=None):
+    """Keeps the `query_num` candidate queries a reward model ensemble disagrees on most.
+
+    A pool of `pool_size` candidate queries (pairs when `sample_num` is 2) is drawn
+    uniformly over valid windows and duplicate candidates are dropped. Every segment is scored on `steps_per_segment`
+    evenly spaced steps. Pairs are ranked by the variance of the members' preference
+    probability sigmoid(R_1 - R_2), single segments by the variance of their return.
+    The ensemble is fitted to the dataset rewards when the dataset has them.
+
+    Returns:
+        tuple: (start_indices, end_indices) laid out like `sample_segments`, first
+            segments of every query first.
+    """
+    pool_size = max(pool_size, query_num)
+    starts, _ = sample_segments(trj_idx_list, query_length, pool_size * sample_num, over_sample=over_sample)
+    starts = starts.reshape(sample_num, pool_size)
+    # the same candidate drawn twice would fill two of the top slots, keep its first draw
+    _, first = np.unique(starts.T, axis=0, return_index=True)
+    starts = starts[:, np.sort(first)]
+    pool_size = starts.shape[1]
+
+    start_time = time.perf_counter()
+    offsets = np.linspace(0, query_length - 1, min(steps_per_segment, query_length)).astype(np.int64)
+    steps = (starts[..., None] + offsets).reshape(-1)
+    # read every step once, in increasing order
+    unique_steps, inverse = np.unique(steps, return_inverse=True)
+    features = step_features(datasets['observations'], unique_steps, batch_size=batch_size)
+    rewards = np.asarray(datasets['rewards'][unique_steps]) if 'rewards' in datasets else None
+    ensemble = RewardEnsemble(features.shape[1], num_members=num_members, seed=seed).fit(features, rewards)
+    predictions = ensemble.predict(features, batch_size=batch_size)[:, inverse]
+    returns = predictions.reshape(num_members, sample_num, pool_size, len(offsets)).mean(axis=-1) * query_length
+    if sample_num == 2:
+        scores = (1 / (1 + np.exp(-np.clip(returns[:, 0] - returns[:, 1], -50, 50)))).var(axis=0)
+    else:
+        scores = returns[:, 0].var(axis=0)
+    elapsed = time.perf_counter() - start_time
+    print(f"Scored {pool_size} candidate {'pairs' if sample_num == 2 else 'segments'} with {num_members} reward models "
+          f"in {elapsed:.2f}s ({pool_size / max(elapsed, 1e-9):.0f}/s)")
+
+    top = np.argsort(-scores, kind='stable')[:query_num]
+    if len(top) < query_num:
+        # fewer distinct candidates than queries: the repeats overlap in the batch and are redrawn by the caller
+        top = np.resize(top, query_num)
+    start_indices = starts[:, top].reshape(-1)
+    return start_indices, start_indices + query_length
+
+
+def k_center_greedy(embeddings, k, batch_size=4096, seed=None):
+    """Greedy k-center: repeatedly picks the point farthest from everything picked so far.
+
+    Distances to the newest center are computed `batch_size` rows at a time, so memory
+    stays O(len(embeddings)) and the cost is O(k * len(embeddings) * dim).
+
+    Returns:
+        np.ndarray: Indices of the `k` picked rows, in pick order.
+    """
+    rng = np.random.default_rng(seed)
+    num_points = len(embeddings)
+    k = min(k, num_points)
+    min_distances = np.full(num_points, np.inf, dtype=np.float32)
+    selected = np.empty(k, dtype=np.int64)
+    selected[0] = rng.integers(num_points)
+    for i in range(1, k):
+        center = embeddings[selected[i - 1]]
+        for batch_start in range(0, num_points, batch_size):
+            batch = embeddings[batch_start:batch_start + batch_size]
+            distances = np.einsum('nd,nd->n', batch - center, batch - center)
+            np.minimum(min_distances[batch_start:batch_start + batch_size], distances, out=min_distances[batch_start:batch_start + batch_size])
+        selected[i] = np.argmax(min_distances)
+    return selected
+
+
+def diversity_sample(datasets, trj_idx_list, query_length, query_num, sample_num, over_sample=False,
+                     pool_size=10000, batch_size=4096, steps_per_segment=8, embedding_dim=32, seed=None):
+    """Picks a maximally spread set of segments out of `pool_size` candidate windows.
+
+    Every candidate is embedded by randomly projecting the features of
+    `steps_per_segment` evenly spaced steps to `embedding_dim` dimensions each, and
+    projecting their concatenation to `embedding_dim` again. `k_center_greedy` then
+    picks `query_num * sample_num` segments; pairs are formed from the picks in order.
+
+    Returns:
+        tuple: (start_indices, end_indices) laid out like `sample_segments`.
+    """
+    rng = np.random.default_rng(seed)
+    total_sample_num = query_num * sample_num
+    pool_size = max(pool_size, total_sample_num)
+    starts, _ = sample_segments(trj_idx_list, query_length, pool_size, over_sample=over_sample)
+
+    start_time = time.perf_counter()
+    offsets = np.linspace(0, query_length - 1, min(steps_per_segment, query_length)).astype(np.int64)
+    unique_steps, inverse = np.unique((starts[:, None] + offsets).reshape(-1), return_inverse=True)
+    projection = {}
+
+    def project(features):
+        # center and scale with the statistics of the first batch, then a gaussian random projection;
+        # a single scale keeps near-constant features from being blown up to unit variance
+        if not projection:
+            projection['mean'] = features.mean(axis=0)
+            projection['std'] = features.std() + 1e-6
+            projection['matrix'] = (rng.standard_normal((features.shape[1], embedding_dim)) / np.sqrt(embedding_dim)).astype(np.float32)
+        return ((features - projection['mean']) / projection['std']) @ projection['matrix']
+
+    step_embeddings = step_features(datasets['observations'], unique_steps, batch_size=batch_size, transform=project)
+    # a second projection of the concatenated steps keeps the index at pool_size x embedding_dim
+    inverse = inverse.reshape(pool_size, len(offsets))
+    segment_projection = (rng.standard_normal((len(offsets) * embedding_dim, embedding_dim)) / np.sqrt(embedding_dim)).astype(np.float32)
+    embeddings = np.empty((pool_size, embedding_dim), dtype=np.float32)
+    for batch_start in range(0, pool_size, batch_size):
+        batch = step_embeddings[inverse[batch_start:batch_start + batch_size]]
+        embeddings[batch_start:batch_start + batch_size] = batch.reshape(len(batch), -1) @ segment_projection
+    selected = k_center_greedy(embeddings, total_sample_num, batch_size=batch_size, seed=seed)
+    elapsed = time.perf_counter() - start_time
+    print(f"Picked {total_sample_num} diverse segments out of {pool_size} candidates in {elapsed:.2f}s")
+
+    start_indices = starts[selected]
+    return start_indices, start_indices + query_length
+
+
+def window_starts(trj_idx_list, query_length, return_positions=False):
+    """Start of every valid window of `query_length` steps, with the eligibility rules of `sample_segments`.
+
+    With `return_positions`, also returns each window's relative position in its
+    trajectory, 0 for the first window and 1 for the last.
+    """
+    trj_idx_list = np.asarray(trj_idx_list, dtype=np.int64).reshape(-1, 2)[:-1]
+    lengths = trj_idx_list[:, 1] - trj_idx_list[:, 0] + 1
+    eligible = lengths > query_length
+    if not eligible.any():
+        raise ValueError(f"No trajectory is longer than the query length {query_length}.")
+    starts, counts = trj_idx_list[eligible, 0], lengths[eligible] - query_length + 1
+    first = np.repeat(np.cumsum(counts) - counts, counts)
+    offsets = np.arange(counts.sum()) - first
+    if return_positions:
+        return np.repeat(starts, counts) + offsets, offsets / np.maximum(np.repeat(counts, counts) - 1, 1)
+    return np.repeat(starts, counts) + offsets
+
+
+def stratified_sample(datasets, trj_idx_list, query_length, query_num, sample_num, over_sample=False,
+                      num_buckets=10, min_gap=1, max_gap=3, seed=None):
+    """Draws queries stratified by segment return, and pairs by return gap.
+
+    The return of every valid window is read off a prefix sum of `datasets['rewards']`
+    in O(1), and windows are split into `num_buckets` return quantiles. First segments
+    cycle through the buckets so every bucket gets the same share of queries; the
+    second segment of a pair comes from a bucket `min_gap` to `max_gap` buckets away.
+
+    Returns:
+        tuple: (start_indices, end_indices) laid out like `sample_segments`.
+    """
+    if 'rewards' not in datasets:
+        raise ValueError("The stratified sampler needs a 'rewards' column.")
+    rng = np.random.default_rng(seed)
+    start_time = time.perf_counter()
+    prefix = dataset_utils.prefix_sums(datasets['rewards'])
+    starts = window_starts(trj_idx_list, query_length)
+    returns = prefix[starts + query_length] - prefix[starts]
+
+    edges = np.quantile(returns, np.linspace(0, 1, num_buckets + 1)[1:-1])
+    buckets = np.searchsorted(edges, returns, side='right')
+    order = np.argsort(buckets, kind='stable')
+    bucket_offsets = np.searchsorted(buckets[order], np.arange(num_buckets + 1))
+    bucket_sizes = np.diff(bucket_offsets)
+    nonempty = np.flatnonzero(bucket_sizes)
+
+    def draw(bucket_ids):
+        picks = bucket_offsets[bucket_ids] + (rng.random(len(bucket_ids)) * bucket_sizes[bucket_ids]).astype(np.int64)
+        return starts[order[picks]]
+
+    first = nonempty[rng.permutation(np.arange(query_num) % len(nonempty))]
+    start_indices = [draw(first)]
+    if sample_num == 2:
+        gaps = rng.integers(min_gap, max_gap + 1, query_num) * rng.choice([-1, 1], query_num)
+        second = first + gaps
+        # mirror gaps that leave the bucket range, then fall back to the nearest non-empty bucket
+        second = np.where((second < 0) | (second >= num_buckets), first - gaps, second).clip(0, num_buckets - 1)
+        second = nonempty[np.abs(nonempty[None, :] - second[:, None]).argmin(axis=1)]
+        start_indices.append(draw(second))
+    start_indices = np.concatenate(start_indices)
+    print(f"Stratified {len(starts)} windows into {num_buckets} return buckets in {time.perf_counter() - start_time:.2f}s")
+    return start_indices, start_indices + query_length
+
+
+def schedule_sample(datasets, trj_idx_list, query_length, query_num, sample_num, over_sample=False,
+                    schedule='position', queries_per_batch=8, seed=None):
+    """Yields query batches lazily, following a curriculum over the valid windows.
+
+    Windows are ordered by their relative position in the trajectory ('position') or
+    by their return ('return', from a prefix sum of `datasets['rewards']`) and split
+    into one stage per batch; every batch draws its segments from its own stage, so
+    early batches come from the start of episodes (or the lowest returns). Batches can
+    be rendered while the next ones are still being drawn.
+
+    Yields:
+        tuple: (start_indices, end_indices) of `queries_per_batch` queries (fewer in
+            the last batch), laid out like `sample_segments`, and a function drawing
+            (start_indices, end_indices) of any number of other queries of the same stage.
+    """
+    rng = np.random.default_rng(seed)
+    if schedule == 'position':
+        starts, keys = window_starts(trj_idx_list, query_length, return_positions=True)
+    elif schedule == 'return':
+        if 'rewards' not in datasets:
+            raise ValueError("The 'return' schedule needs a 'rewards' column.")
+        prefix = dataset_utils.prefix_sums(datasets['rewards'])
+        starts = window_starts(trj_idx_list, query_length)
+        keys = prefix[starts + query_length] - prefix[starts]
+    else:
+        raise ValueError(f"Unknown schedule {schedule}.")
+    order = np.argsort(keys, kind='stable')
+    num_batches = -(-query_num // queries_per_batch)
+    for batch in range(num_batches):
+        batch_queries = min(queries_per_batch, query_num - batch * queries_per_batch)
+        lo, hi = len(order) * batch // num_batches, max(len(order) * (batch + 1) // num_batches, len(order) * batch // num_batches + 1)
+
+        def draw(num_queries, lo=lo, hi=hi):
+            start_indices = starts[order[rng.integers(lo, hi, num_queries * sample_num)]]
+            return start_indices, start_indices + query_length
+        yield draw(batch_queries) + (draw,)
@@ -0,0 +1,122 @@
+import os
+import uuid
+import threading
+import numpy as np
+
+from datasets.dataset_cache import DEFAULT_CACHE_DIR
+
+
+DEFAULT_INDEX_DIR = os.path.join(DEFAULT_CACHE_DIR, "segment_index")
+
+
+def _overlap_fractions(starts, ends, other_starts, other_ends):
+    inter = np.minimum(ends, other_ends) - np.maximum(starts, other_starts)
+    return np.maximum(inter, 0) / np.minimum(ends - starts, other_ends - other_starts)
+
+
+def _max_overlap(sorted_starts, sorted_ends, max_length, starts, ends):
+    result = np.zeros(len(starts))
+    if not len(sorted_starts) or not len(starts):
+        return result
+    lo = np.searchsorted(sorted_starts, starts - max_length + 1, side='left')
+    hi = np.searchsorted(sorted_starts, ends, side='left')
+    counts = np.maximum(hi - lo, 0)
+    hit = np.flatnonzero(counts)
+    if not len(hit):
+        return result
+    # expand every candidate into the issued rows in its search range
+    rows = np.repeat(hit, counts[hit])
+    first = np.repeat(np.cumsum(counts[hit]) - counts[hit], counts[hit])
+    issued = np.repeat(lo[hit], counts[hit]) + np.arange(len(rows)) - first
+    fractions = _overlap_fractions(starts[rows], ends[rows], sorted_starts[issued], sorted_ends[issued])
+    result[hit] = np.maximum.reduceat(fractions, np.cumsum(counts[hit]) - counts[hit])
+    return result
+
+
+def _sorted_by_start(starts, ends):
+    order = np.argsort(starts, kind='stable')
+    return starts[order], ends[order]
+
+
+def _merge(starts, ends, other_starts, other_ends):
+    # one linear merge of two arrays sorted by start
+    positions = np.searchsorted(starts, other_starts, side='right')
+    return np.insert(starts, positions, other_starts), np.insert(ends, positions, other_ends)
+
+
+class SegmentIndex(object):
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, path):
+        """Every segment already issued on one dataset, kept sorted by start and saved to `path`.
+
+        Overlap queries binary-search the sorted starts: a segment [s, e) can only
+        intersect issued segments starting in [s - max_length + 1, e). Segments added
+        since the last `save` are kept apart and merged in once by `save`. Use `open` so
+        that every project in the process shares one instance per file.
+
+        Args:
+            path (str): The .npy file holding the (n, 2) array of issued [start, end) rows.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        segments = np.load(path) if os.path.exists(path) else np.zeros((0, 2), dtype=np.int64)
+        self.starts = np.ascontiguousarray(segments[:, 0], dtype=np.int64)
+        self.ends = np.ascontiguousarray(segments[:, 1], dtype=np.int64)
+        self.max_length = int((self.ends - self.starts).max()) if len(segments) else 0
+        self.new_starts = np.zeros(0, dtype=np.int64)
+        self.new_ends = np.zeros(0, dtype=np.int64)
+
+    @classmethod
+    def open(cls, path):
+        with cls._instances_lock:
+            if path not in cls._instances:
+                cls._instances[path] = cls(path)
+            return cls._instances[path]
+
+    def __len__(self):
+        return len(self.starts) + len(self.new_starts)
+
+    def max_overlap(self, starts, ends):
+        """Largest overlap of every [starts[i], ends[i]) with an issued segment, as a fraction of the shorter one."""
+        starts, ends = np.asarray(starts, dtype=np.int64), np.asarray(ends, dtype=np.int64)
+        return np.maximum(_max_overlap(self.starts, self.ends, self.max_length, starts, ends),
+                          _max_overlap(self.new_starts, self.new_ends, self.max_length, starts, ends))
+
+    def add(self, starts, ends):
+        starts, ends = np.asarray(starts, dtype=np.int64), np.asarray(ends, dtype=np.int64)
+        # the saved segments stay untouched until `save` merges these in
+        self.new_starts, self.new_ends = _merge(self.new_starts, self.new_ends, *_sorted_by_start(starts, ends))
+        if len(starts):
+            self.max_length = max(self.max_length, int((ends - starts).max()))
+
+    def save(self):
+        if len(self.new_starts):
+            self.starts, self.ends = _merge(self.starts, self.ends, self.new_starts, self.new_ends)
+            self.new_starts, self.new_ends = self.new_starts[:0], self.new_ends[:0]
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp-{uuid.uuid4().hex}.npy"
+        np.save(tmp_path, np.stack([self.starts, self.ends], axis=1))
+        os.replace(tmp_path, self.path)
+
+
+def overlapping_in_batch(starts, ends, max_overlap):
+    """Marks segments of one batch overlapping an earlier one (by start) by more than `max_overlap`.
+
+    Sorted by start, the earlier segment a segment intersects most is the one with the
+    largest end so far, so one running maximum of the ends checks the whole batch.
+    """
+    starts, ends = np.asarray(starts, dtype=np.int64), np.asarray(ends, dtype=np.int64)
+    rejected = np.zeros(len(starts), dtype=bool)
+    if len(starts) < 2:
+        return rejected
+    order = np.argsort(starts, kind='stable')
+    sorted_starts, sorted_ends = starts[order], ends[order]
+    positions = np.arange(len(order))
+    # position of the segment holding the largest end among the earlier ones
+    holder = np.maximum.accumulate(np.where(sorted_ends == np.maximum.accumulate(sorted_ends), positions, 0))
+    previous = holder[:-1]
+    fractions = _overlap_fractions(sorted_starts[1:], sorted_ends[1:], sorted_starts[previous], sorted_ends[previous])
+    rejected[order[1:]] = fractions > max_overlap
+    return rejected
@@ -25,6 +25,8 @@ def setup_project(data_dir, project_dir):
         query_info = []
         for row in csv_reader:
             query_info.append(row)
+    # counted, the csv also has the queries added by extending the project
+    project_info['query_num'] = len(query_info)
     return project_info, query_info
 
 st.set_page_config(page_title='Mini-Uni-RLHF (Annotate)', layout='wide')
@@ -8,6 +8,9 @@ import json
 import csv
 
 sys.path.append(str(pathlib.Path(__file__).parent.parent))
+import datasets.dataset_utils as dataset_utils
+
+UPLOAD_DIR = str(pathlib.Path(__file__).parent.parent / "datasets" / "dataset_resource" / "customization")
 
 def generate_video(project_id, 
                 domain, 
@@ -21,12 +24,18 @@ def generate_video(project_id,
                 fps=30,
                 video_width=100,
                 video_height=100,
-                save_dir="./videos"):
+                save_dir="./videos",
+                file_path=None,
+                sampler_config=None,
+                encoder_config=None,
+                frame_config=None):
     
     context = {}
     exec(f"from datasets.{mode}_{domain} import Dataset", context)
     Dataset = context['Dataset']
     
+    # only the customization dataset reads a user file
+    dataset_kwargs = {} if file_path is None else {'file_path': file_path}
     # Instantiate the Dataset with the provided configuration
     dataset = Dataset(
         project_id=project_id,
@@ -41,7 +50,11 @@ def generate_video(project_id,
         fps=fps,
         video_width=video_width,
         video_height=video_height,
-        save_dir=save_dir
+        save_dir=save_dir,
+        sampler_config=sampler_config,
+        encoder_config=encoder_config,
+        frame_config=frame_config,
+        **dataset_kwargs
     )
 
     # Generate video resources
@@ -74,6 +87,36 @@ def save_video(project_info, save_dir="./data"):
             # print(info, url, query_id)
             writer.writerow([info, url, query_id, project_info['task'], None,0])
         
+def append_video(project_info, video_info_list, video_url_list, query_id_list, save_dir="./data"):
+    """Appends new queries to an existing project without rewriting its JSON/CSV.
+
+    The CSV gets one row per query; the JSON is left as written and the new lists are
+    appended as one line to the project's .jsonl log, which the export page merges back.
+    """
+    base_path = os.path.join(save_dir, f"{project_info['project_name']}@{project_info['project_id']}")
+    with open(base_path + '.jsonl', 'a') as jsonl_file:
+        jsonl_file.write(json.dumps({"video_info": video_info_list, "video_url": video_url_list, "query_id": query_id_list}) + "\n")
+    with open(base_path + '.csv', 'a', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        for info, url, query_id in zip(video_info_list, video_url_list, query_id_list):
+            writer.writerow([info, url, query_id, project_info['task'], None, 0])
+
+def extend_project(project_file, query_num, data_dir="./data"):
+    """Samples and renders query_num more queries with the stored configuration of a project."""
+    with open(os.path.join(data_dir, project_file), 'r') as json_file:
+        project_info = json.load(json_file)
+    # projects stored without their video settings were rendered with the defaults of generate_video
+    video_config = {key: project_info[key] for key in ('fps', 'video_width', 'video_height')} if 'video_width' in project_info else {}
+    # same project id, so the videos land next to the existing ones and the dataset stays resident
+    video_info_list, video_url_list, query_id_list = generate_video(project_id=project_info['project_id'], domain=project_info['domain'], task=project_info['task'],
+                                                                    environment_name=project_info['environment_name'], sampler_type=project_info['sampler_type'],
+                                                                    feedback_type=project_info['feedback_type'], query_num=query_num, query_length=project_info['query_length'],
+                                                                    file_path=project_info.get('dataset_path'), sampler_config=project_info.get('sampler_config'),
+                                                                    encoder_config=project_info.get('encoder_config'), frame_config=project_info.get('frame_config'),
+                                                                    **video_config)
+    append_video(project_info, video_info_list, video_url_list, query_id_list, save_dir=data_dir)
+    return len(query_id_list)
+
 st.set_page_config(page_title='🔨 Mini-Uni-RLHF (Create)', layout='wide')
 
 domain_task_map = {
@@ -117,23 +160,55 @@ with st.expander('🔍 Create Project', expanded=True):
         fps_options = [10, 15, 25, 30, 50]  
         fps = st.select_slider('FPS', options=fps_options)
 
+        # encoder: a profile, with its CRF, keyframe interval and threads overridable
+        encoder_profile = st.selectbox('Encoder Profile', options=list(dataset_utils.ENCODER_PROFILES))
+        encoder_defaults = dataset_utils.ENCODER_PROFILES[encoder_profile]
+        encoder_config = {'profile': encoder_profile}
+        encoder_config['crf'] = st.slider('CRF (lower is better quality, larger files)', min_value=0, max_value=51, value=encoder_defaults['crf'])
+        encoder_config['keyint'] = st.number_input('Keyframe Interval (frames, 0 for the codec default)', min_value=0, value=encoder_defaults['keyint'] or 0) or None
+        encoder_config['threads'] = st.number_input('Encoder Threads (0 for automatic)', min_value=0, value=encoder_defaults['threads'] or 0) or None
+
     with col2:
         # sampler_type: select_box
-        sampler_type_options = ['random', 'disagreement']
+        sampler_type_options = ['random', 'disagreement', 'diversity', 'stratified', 'schedule']
         sampler_type = st.selectbox('Sampler Type', options=sampler_type_options)
+        sampler_config = {}
+        if sampler_type in ['disagreement', 'diversity']:
+            sampler_config['pool_size'] = st.number_input('Candidate Pool Size', min_value=1, value=1000 if sampler_type == 'disagreement' else 10000, step=100)
+            sampler_config['batch_size'] = st.number_input('Scoring Batch Size', min_value=64, value=4096, step=64)
+        if sampler_type == 'stratified':
+            sampler_config['num_buckets'] = st.number_input('Return Buckets', min_value=2, value=10)
+            max_gap = int(sampler_config['num_buckets']) - 1
+            sampler_config['min_gap'], sampler_config['max_gap'] = st.slider('Return Gap (buckets)', min_value=0, max_value=max_gap, value=(1, min(3, max_gap)))
+        if sampler_type == 'schedule':
+            sampler_config['schedule'] = st.selectbox('Curriculum', options=['position', 'return'])
+            sampler_config['queries_per_batch'] = st.number_input('Queries per Batch', min_value=1, value=8)
+        # segments overlapping one issued to an earlier project on the same dataset by more than this are redrawn
+        sampler_config['max_overlap'] = st.slider('Max Segment Overlap', min_value=0.0, max_value=1.0, value=0.5, step=0.05)
         
         # feedback_type: select_box
         feedback_type_options = ['comparative', 'attribute', 'evaluative', 'visual', 'keypoint']
         feedback_type = st.selectbox('Feedback Type', options=feedback_type_options)
+        frame_config = {}
+        if feedback_type in ['visual', 'keypoint']:
+            frame_config['image_format'] = st.selectbox('Frame Image Format', options=list(dataset_utils.IMAGE_FORMATS))
+            if frame_config['image_format'] == 'png':
+                frame_config['quality'] = st.slider('PNG Compression', min_value=0, max_value=9, value=dataset_utils.IMAGE_FORMATS['png'][1])
+            else:
+                frame_config['quality'] = st.slider('Image Quality', min_value=1, max_value=100, value=dataset_utils.IMAGE_FORMATS[frame_config['image_format']][1])
+            frame_config['stride'] = st.number_input('Frame Stride (write every n-th frame)', min_value=1, value=1)
         
         # query_num: number_input
         query_num = st.number_input('Query Number', min_value=1, max_value=10)
         
         # query_length: number_input
-        query_length = st.number_input('Query Length', min_value=10, max_value=100)
+        query_length = st.number_input('Query Length', min_value=10, max_value=10000)
         
         # own_dataset: file_uploader 
-        own_dataset = st.file_uploader("Upload your own hdf5 dataset (Optional)")
+        own_dataset = st.file_uploader("Upload your own hdf5 dataset (Optional)", type=['hdf5', 'h5'])
+        # multi-GB datasets already on the server skip the upload entirely
+        own_dataset_path = st.text_input("Or path to an hdf5 dataset on the server (Optional)", value="",
+                                         help=f"Must be under {' or '.join(dataset_utils.SERVER_DATASET_DIRS)}.")
 
     with col3:
         # instruction: text_area
@@ -182,14 +257,40 @@ with st.expander('🔍 Create Project', expanded=True):
         generate_button = st.button('Generate', type="primary")
         
     if generate_button:
+        project_id = str(shortuuid.uuid())
+        file_path = None
+        error = None
         if not project_name or not environment_name:
-            info_placeholder.error("Project ID and Environment Name cannot be empty.")
+            error = "Project ID and Environment Name cannot be empty."
+        elif own_dataset is not None:
+            # streamlit already holds the upload in memory (up to server.maxUploadSize), copying it in chunks
+            # avoids a second copy from getvalue(); the project id prefix keeps uploads with the same file
+            # name from replacing another project's dataset
+            file_path = dataset_utils.save_upload(own_dataset, os.path.join(UPLOAD_DIR, f"{project_id}_{os.path.basename(own_dataset.name)}"))
+        elif own_dataset_path:
+            file_path = own_dataset_path
+        if file_path is not None:
+            try:
+                if own_dataset is None:
+                    file_path = dataset_utils.server_dataset_path(file_path)
+                dataset_utils.check_hdf5_schema(file_path)
+            except ValueError as e:
+                error = f"Invalid dataset: {e}"
+                # a rejected upload is never referenced by a project
+                if own_dataset is not None:
+                    os.remove(file_path)
+
+        if error is not None:
+            info_placeholder.error(error)
         else:
+            if file_path is not None:
+                domain, task = 'customization_dataset', 'customization'
             with st.spinner('Wait for generation...'):
                 info_placeholder.info("Start generating videos...")
-                project_id = str(shortuuid.uuid())
+                video_width, video_height = 100, 100
                 video_info_list, video_url_list, query_id_list = generate_video(project_id=project_id, domain=domain, task=task, environment_name=environment_name, sampler_type=sampler_type, feedback_type=feedback_type, query_num=query_num,
-                query_length=query_length)
+                query_length=query_length, fps=fps, video_width=video_width, video_height=video_height, file_path=file_path, sampler_config=sampler_config,
+                encoder_config=encoder_config, frame_config=frame_config)
                 # print(video_info_list, video_url_list, query_id_list)
                 
                 project_info_dict = {
@@ -199,9 +300,14 @@ with st.expander('🔍 Create Project', expanded=True):
                     "task": task,
                     "environment_name": environment_name,
                     "fps": fps,
+                    "video_width": video_width,
+                    "video_height": video_height,
                     "sampler_type": sampler_type,
+                    "sampler_config": sampler_config,
+                    "encoder_config": encoder_config,
+                    "frame_config": frame_config,
+                    "dataset_path": file_path,
                     "feedback_type": feedback_type,
-                    "query_num": query_num,
                     "query_length": query_length,
                     "instruction": instruction,
                     "question": question,
@@ -218,6 +324,16 @@ with st.expander('🔍 Create Project', expanded=True):
             st.write('Full project info:')
             st.write(project_info_dict)
     
+with st.expander('➕ Extend Project', expanded=False):
+    os.makedirs("./data", exist_ok=True)
+    project_files = sorted(f for f in os.listdir("./data") if f.endswith('.json') and '@' in f)
+    extend_file = st.selectbox('Project', options=project_files)
+    extend_query_num = st.number_input('New Query Number', min_value=1, value=10)
+    if st.button('Extend') and extend_file:
+        with st.spinner('Wait for generation...'):
+            added = extend_project(extend_file, extend_query_num)
+        st.success(f"Added {added} queries to {extend_file}.")
+
 with st.expander('🔍 Your input', expanded=True):
     st.json({
         'Project Name': project_name,
@@ -225,6 +341,9 @@ with st.expander('🔍 Your input', expanded=True):
         'Task': task,
         'Environment Name': environment_name,
         'Sampler Type': sampler_type,
+        'Sampler Config': sampler_config,
+        'Encoder Config': encoder_config,
+        'Frame Config': frame_config,
         'Feedback Type': feedback_type,
         'Query Number': query_num,
         'Query Length': query_length,
@@ -42,6 +42,15 @@ if st.session_state.view:
     project_dir = os.path.join("./data", project_info[selected_project_name])
     with open(project_dir, 'r') as jsonfile:
         full_project_info = json.load(jsonfile)
+    # queries added by extending the project are logged next to the json
+    if os.path.exists(project_dir[:-5] + '.jsonl'):
+        with open(project_dir[:-5] + '.jsonl', 'r') as jsonlfile:
+            for line in jsonlfile:
+                extension = json.loads(line)
+                for key in ['video_info', 'video_url', 'query_id']:
+                    full_project_info[key] = full_project_info[key] + extension[key]
+    # extensions only append to the log, so the query number is counted instead of stored
+    full_project_info['query_num'] = len(full_project_info['query_id'])
     df = pd.read_csv(project_dir[:-5]+'.csv')
     
     with st.expander('🔍 Full Project infomation', expanded=False):
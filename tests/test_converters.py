@@ -0,0 +1,121 @@
+import sys
+from pathlib import Path
+import numpy as np
+import pytest
+
+from datasets import dataset_utils
+
+
+def legacy_episode_boundaries(terminals, num_steps):
+    # the per-row loop of get_episode_boundaries
+    trj_idx_list, start = [], 0
+    for i in range(num_steps - 1):
+        if terminals[i]:
+            trj_idx_list.append([start, i])
+            start = i + 1
+    trj_idx_list.append([start, num_steps - 1])
+    return np.array(trj_idx_list)
+
+
+def test_episode_index_matches_legacy_loop():
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        num_steps = int(rng.integers(1, 80))
+        terminals = rng.random(num_steps) < rng.random()
+        index = dataset_utils.EpisodeIndex.from_terminals(terminals)
+        np.testing.assert_array_equal(index.trj_idx_list, legacy_episode_boundaries(terminals, num_steps))
+        for k, (start, end) in enumerate(index.trj_idx_list):
+            assert np.all(index.episode_ids[start:end + 1] == k)
+
+
+def test_next_observation_view_matches_copy():
+    rng = np.random.default_rng(1)
+    observations = rng.standard_normal((30, 3)).astype(np.float32)
+    patch_rows = np.array([4, 17, 29])
+    patch_values = rng.standard_normal((3, 3)).astype(np.float32)
+    expected = np.concatenate((observations[1:], observations[:1]))
+    expected[patch_rows] = patch_values
+    view = dataset_utils.NextObservationView(observations, patch_rows, patch_values)
+    np.testing.assert_array_equal(np.asarray(view), expected)
+    np.testing.assert_array_equal(view[[29, 3, 4]], expected[[29, 3, 4]])
+    np.testing.assert_array_equal(view[17], expected[17])
+
+
+def test_qlearning_smarts_matches_legacy_loop():
+    from datasets.offline_smarts import qlearning_smarts_dataset
+    rng = np.random.default_rng(2)
+    rows = [(rng.integers(0, 255, (4, 4, 3), dtype=np.uint8), rng.standard_normal(5), rng.standard_normal(2),
+             float(rng.standard_normal()), rng.random() < 0.1) for _ in range(50)]
+    converted = qlearning_smarts_dataset(rows)
+    for i, (picture, obs, action, reward, done) in enumerate(rows):
+        next_obs = rows[i + 1][1] if i < len(rows) - 1 else obs
+        np.testing.assert_array_equal(converted['pictures'][i], picture)
+        np.testing.assert_array_equal(converted['observations'][i], obs.astype(np.float32))
+        np.testing.assert_array_equal(converted['next_observations'][i], next_obs.astype(np.float32))
+        np.testing.assert_array_equal(converted['actions'][i], action)
+        assert converted['rewards'][i] == reward and converted['terminals'][i] == bool(done)
+
+
+def test_qlearning_vd4rl_matches_legacy_loop():
+    pytest.importorskip("gym")
+    from datasets.offline_vd4rl import qlearning_vd4rl_dataset
+    rng = np.random.default_rng(3)
+    num_steps, max_episode_steps = 40, 6
+    dataset = {'observation': rng.integers(0, 255, (num_steps, 3, 4, 4), dtype=np.uint8),
+               'action': rng.standard_normal((num_steps, 2)), 'reward': rng.standard_normal(num_steps)}
+    converted = qlearning_vd4rl_dataset(dataset, max_episode_steps=max_episode_steps)
+    episode_step = 0
+    for i in range(num_steps - 1):
+        done = episode_step == max_episode_steps
+        np.testing.assert_array_equal(converted['observations'][i], dataset['observation'][i])
+        np.testing.assert_array_equal(converted['next_observations'][i], dataset['observation'][i + 1])
+        np.testing.assert_array_equal(converted['actions'][i], dataset['action'][i].astype(np.float32))
+        assert converted['rewards'][i] == np.float32(dataset['reward'][i]) and converted['terminals'][i] == done
+        episode_step = 0 if done else episode_step + 1
+
+
+def legacy_episode_steps(terminals, timeouts, max_episode_steps, terminate_on_end):
+    # the counter of the per-row qlearning_* loops, read at the top of every iteration
+    steps, episode_step = np.zeros(len(terminals), dtype=np.int64), 0
+    for i in range(len(terminals)):
+        steps[i] = episode_step
+        done_bool = bool(terminals[i]) or episode_step == max_episode_steps - 1
+        final_timestep = timeouts[i] if timeouts is not None else episode_step == max_episode_steps - 1
+        if (not terminate_on_end) and final_timestep:
+            episode_step = 0
+            continue
+        if done_bool or final_timestep:
+            episode_step = 0
+        episode_step += 1
+    return steps
+
+
+@pytest.mark.parametrize("use_timeouts", [False, True])
+@pytest.mark.parametrize("terminate_on_end", [False, True])
+def test_d4rl_conversion_matches_legacy_loop(use_timeouts, terminate_on_end):
+    pytest.importorskip("gym")
+    pytest.importorskip("d4rl")
+    from datasets.offline_d4rl import qlearning_ant_dataset, _episode_steps
+    sys.path.append(str(Path(__file__).parent.parent / "benchmarks"))
+    from bench_d4rl_conversion import SyntheticEnv, legacy_qlearning_ant_dataset
+
+    rng = np.random.default_rng(4)
+    for _ in range(200):
+        num_steps, max_episode_steps = int(rng.integers(2, 60)), int(rng.integers(2, 8))
+        dataset = {"observations": rng.standard_normal((num_steps, 3)).astype(np.float32),
+                   "actions": rng.standard_normal((num_steps, 2)).astype(np.float32),
+                   "rewards": rng.standard_normal(num_steps).astype(np.float32),
+                   "terminals": rng.random(num_steps) < rng.random() * 0.5,
+                   "infos/qpos": rng.standard_normal((num_steps, 4)), "infos/qvel": rng.standard_normal((num_steps, 3)),
+                   "infos/goal": rng.standard_normal((num_steps, 2)).astype(np.float32)}
+        if use_timeouts:
+            dataset["timeouts"] = rng.random(num_steps) < 0.2
+        timeouts = dataset.get("timeouts")
+        np.testing.assert_array_equal(_episode_steps(dataset["terminals"][:-1], timeouts, max_episode_steps, terminate_on_end),
+                                      legacy_episode_steps(dataset["terminals"][:-1], timeouts, max_episode_steps, terminate_on_end))
+
+        env = SyntheticEnv(max_episode_steps)
+        expected = legacy_qlearning_ant_dataset(env, dataset, terminate_on_end=terminate_on_end)
+        converted = qlearning_ant_dataset(env, dataset=dataset, terminate_on_end=terminate_on_end)
+        for key, value in expected.items():
+            np.testing.assert_array_equal(np.asarray(converted[key]).reshape(value.shape), value, err_msg=key)
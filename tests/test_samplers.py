@@ -0,0 +1,109 @@
+import numpy as np
+import pytest
+
+from datasets import samplers
+from datasets.dataset_utils import sample_segments
+
+QUERY_LENGTH = 20
+# the last trajectory may be cut off by the end of the dataset and is never sampled
+TRJ_IDX_LIST = np.array([[0, 9], [10, 109], [110, 159], [160, 399], [400, 449]])
+
+
+def make_datasets(num_steps=450, seed=0):
+    rng = np.random.default_rng(seed)
+    return {'observations': rng.standard_normal((num_steps, 6)).astype(np.float32),
+            'rewards': rng.standard_normal(num_steps).astype(np.float32)}
+
+
+def valid_windows(trj_idx_list, query_length):
+    return [start for trj_start, trj_end in trj_idx_list[:-1] if trj_end - trj_start + 1 > query_length
+            for start in range(trj_start, trj_end - query_length + 2)]
+
+
+def assert_valid(start_indices, end_indices, num_segments):
+    assert len(start_indices) == len(end_indices) == num_segments
+    np.testing.assert_array_equal(end_indices - start_indices, QUERY_LENGTH)
+    assert set(start_indices) <= set(valid_windows(TRJ_IDX_LIST, QUERY_LENGTH))
+
+
+def test_window_starts_matches_brute_force():
+    starts, positions = samplers.window_starts(TRJ_IDX_LIST, QUERY_LENGTH, return_positions=True)
+    assert list(starts) == valid_windows(TRJ_IDX_LIST, QUERY_LENGTH)
+    for (trj_start, trj_end) in TRJ_IDX_LIST[:-1]:
+        inside = (starts >= trj_start) & (starts <= trj_end)
+        if inside.any():
+            assert positions[inside][0] == 0 and positions[inside][-1] == 1
+
+
+def test_sample_segments_covers_every_window():
+    np.random.seed(0)
+    start_indices, end_indices = sample_segments(TRJ_IDX_LIST, QUERY_LENGTH, 20000)
+    assert_valid(start_indices, end_indices, 20000)
+    assert set(start_indices) == set(valid_windows(TRJ_IDX_LIST, QUERY_LENGTH))
+
+
+@pytest.mark.parametrize("sample_num", [1, 2])
+def test_disagreement_sample(sample_num):
+    np.random.seed(0)
+    start_indices, end_indices = samplers.disagreement_sample(make_datasets(), TRJ_IDX_LIST, QUERY_LENGTH, 8, sample_num,
+                                                              pool_size=200, seed=0)
+    assert_valid(start_indices, end_indices, 8 * sample_num)
+    queries = start_indices.reshape(sample_num, -1).T
+    assert len({tuple(query) for query in queries}) == len(queries)
+
+
+@pytest.mark.parametrize("sample_num", [1, 2])
+def test_diversity_sample(sample_num):
+    np.random.seed(0)
+    start_indices, end_indices = samplers.diversity_sample(make_datasets(), TRJ_IDX_LIST, QUERY_LENGTH, 8, sample_num,
+                                                           pool_size=200, seed=0)
+    assert_valid(start_indices, end_indices, 8 * sample_num)
+
+
+def test_k_center_greedy_matches_brute_force():
+    rng = np.random.default_rng(0)
+    points = rng.standard_normal((300, 4)).astype(np.float32)
+    selected = samplers.k_center_greedy(points, 10, batch_size=64, seed=0)
+    expected = [selected[0]]
+    for _ in range(9):
+        distances = ((points[:, None] - points[expected][None]) ** 2).sum(axis=-1).min(axis=1)
+        expected.append(int(distances.argmax()))
+    np.testing.assert_array_equal(selected, expected)
+
+
+def test_stratified_sample_covers_every_bucket():
+    datasets = make_datasets()
+    num_buckets = 5
+    start_indices, end_indices = samplers.stratified_sample(datasets, TRJ_IDX_LIST, QUERY_LENGTH, num_buckets, 2,
+                                                            num_buckets=num_buckets, seed=0)
+    assert_valid(start_indices, end_indices, 2 * num_buckets)
+    windows = np.array(valid_windows(TRJ_IDX_LIST, QUERY_LENGTH))
+    returns = np.array([datasets['rewards'][start:start + QUERY_LENGTH].astype(np.float64).sum() for start in windows])
+    edges = np.quantile(returns, np.linspace(0, 1, num_buckets + 1)[1:-1])
+
+    def bucket(start):
+        return int(np.searchsorted(edges, datasets['rewards'][start:start + QUERY_LENGTH].astype(np.float64).sum(), side='right'))
+    first, second = start_indices.reshape(2, -1)
+    assert sorted(bucket(start) for start in first) == list(range(num_buckets))
+    gaps = [abs(bucket(a) - bucket(b)) for a, b in zip(first, second)]
+    assert all(1 <= gap <= 3 for gap in gaps)
+
+
+@pytest.mark.parametrize("schedule", ['position', 'return'])
+def test_schedule_sample_follows_the_curriculum(schedule):
+    datasets = make_datasets()
+    batches = list(samplers.schedule_sample(datasets, TRJ_IDX_LIST, QUERY_LENGTH, 10, 2, schedule=schedule, queries_per_batch=4, seed=0))
+    assert [len(start_indices) for start_indices, _, _ in batches] == [8, 8, 4]
+    starts, positions = samplers.window_starts(TRJ_IDX_LIST, QUERY_LENGTH, return_positions=True)
+    if schedule == 'position':
+        key = dict(zip(starts, positions))
+    else:
+        key = {start: datasets['rewards'][start:start + QUERY_LENGTH].astype(np.float64).sum() for start in starts}
+    previous_max = -np.inf
+    for start_indices, end_indices, draw in batches:
+        assert_valid(start_indices, end_indices, len(start_indices))
+        redrawn, _ = draw(3)
+        keys = [key[start] for start in np.concatenate((start_indices, redrawn))]
+        # every batch, redraws included, comes from a later stage than the previous one
+        assert min(keys) >= previous_max - 1e-9
+        previous_max = max(keys)
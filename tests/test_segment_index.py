@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+from datasets.segment_index import SegmentIndex, overlapping_in_batch
+
+
+def overlap(start, end, other_start, other_end):
+    inter = max(0, min(end, other_end) - max(start, other_start))
+    return inter / min(end - start, other_end - other_start)
+
+
+def random_segments(rng, num, max_start=5000, min_length=5, max_length=200):
+    starts = rng.integers(0, max_start, num)
+    return starts, starts + rng.integers(min_length, max_length, num)
+
+
+def test_max_overlap_matches_brute_force(tmp_path):
+    rng = np.random.default_rng(0)
+    index = SegmentIndex(str(tmp_path / "index.npy"))
+    issued = []
+    for batch in range(6):
+        starts, ends = random_segments(rng, 40)
+        index.add(starts, ends)
+        issued += list(zip(starts, ends))
+        if batch == 2:
+            index.save()
+        query_starts, query_ends = random_segments(rng, 200)
+        expected = [max([overlap(s, e, a, b) for a, b in issued]) for s, e in zip(query_starts, query_ends)]
+        np.testing.assert_allclose(index.max_overlap(query_starts, query_ends), expected)
+
+
+def test_save_merges_every_segment(tmp_path):
+    rng = np.random.default_rng(1)
+    path = str(tmp_path / "index.npy")
+    index = SegmentIndex(path)
+    for _ in range(3):
+        index.add(*random_segments(rng, 25))
+    index.save()
+    reloaded = SegmentIndex(path)
+    assert len(reloaded) == 75
+    assert np.all(np.diff(reloaded.starts) >= 0)
+    np.testing.assert_array_equal(reloaded.starts, index.starts)
+    np.testing.assert_array_equal(reloaded.ends, index.ends)
+
+
+def legacy_overlapping_in_batch(starts, ends, max_overlap):
+    # the per-segment loop, comparing every segment with the last kept one
+    rejected = np.zeros(len(starts), dtype=bool)
+    last = None
+    for i in np.argsort(starts, kind='stable'):
+        if last is not None and overlap(starts[i], ends[i], *last) > max_overlap:
+            rejected[i] = True
+        else:
+            last = starts[i], ends[i]
+    return rejected
+
+
+@pytest.mark.parametrize("max_overlap", [0.0, 0.25, 0.5, 0.9])
+def test_overlapping_in_batch_matches_brute_force(max_overlap):
+    rng = np.random.default_rng(2)
+    for _ in range(50):
+        # queries have one segment length, for which the vectorized check is exact
+        starts = rng.integers(0, 2000, 60)
+        ends = starts + 50
+        order = np.argsort(starts, kind='stable')
+        expected = np.zeros(len(starts), dtype=bool)
+        for rank, i in enumerate(order):
+            expected[i] = any(overlap(starts[i], ends[i], starts[j], ends[j]) > max_overlap for j in order[:rank])
+        rejected = overlapping_in_batch(starts, ends, max_overlap)
+        np.testing.assert_array_equal(rejected, expected)
+        assert np.all(rejected[legacy_overlapping_in_batch(starts, ends, max_overlap)])